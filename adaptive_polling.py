@@ -0,0 +1,145 @@
+"""
+Adaptive Per-City Polling
+Learns how often each city's upstream observation (`dt` in the API response)
+actually changes and how volatile temp/humidity are, then picks a poll
+interval per city between POLL_MIN_SECONDS and POLL_MAX_SECONDS.
+
+Controller, per successful poll:
+- `dt` unchanged  -> the call was wasted, grow the base interval
+- `dt` changed    -> we may be undersampling, shrink the base interval a little
+The effective interval is the base interval divided by a volatility factor
+built from the exponentially weighted variance of temp/humidity changes, but
+never shorter than the learned upstream cadence (EWMA of the gaps between
+new `dt` values): polling faster than the city publishes only fetches the
+same observation again.
+"""
+
+import math
+import time
+
+# Multiplicative steps for the base interval
+GROW_FACTOR = 1.25
+SHRINK_FACTOR = 0.9
+
+# Weight of the newest sample in exponentially weighted averages
+EWMA_ALPHA = 0.3
+
+# Change rates (per hour) that double the poll frequency
+TEMP_RATE_REF = 1.0
+HUMIDITY_RATE_REF = 5.0
+
+
+def ensure_poll_state_table(conn):
+    """Create the poll_state table"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS poll_state (
+            city TEXT PRIMARY KEY,
+            last_dt INTEGER,
+            last_temp REAL,
+            last_humidity REAL,
+            last_polled_epoch INTEGER,
+            cadence_s REAL,
+            temp_rate_var REAL DEFAULT 0,
+            humidity_rate_var REAL DEFAULT 0,
+            base_interval_s REAL,
+            interval_s REAL,
+            next_due_epoch INTEGER,
+            polls INTEGER DEFAULT 0,
+            unchanged_polls INTEGER DEFAULT 0
+        )
+    """)
+    conn.commit()
+
+
+def ewma(previous, sample, alpha=EWMA_ALPHA):
+    return sample if previous is None else (1 - alpha) * previous + alpha * sample
+
+
+def observe(conn, city, dt, temp, humidity, min_interval, max_interval, now=None):
+    """
+    Feed one successful poll into the city's state and schedule its next poll.
+    Returns (upstream_changed, interval_seconds).
+    """
+    now = int(time.time() if now is None else now)
+    row = conn.execute("""
+        SELECT last_dt, last_temp, last_humidity, cadence_s, temp_rate_var,
+               humidity_rate_var, base_interval_s
+        FROM poll_state WHERE city = ?
+    """, (city,)).fetchone()
+
+    if row is None:
+        # First sighting: start in the middle of the allowed range
+        changed = True
+        cadence, temp_var, hum_var = None, 0.0, 0.0
+        base = math.sqrt(min_interval * max_interval)
+    else:
+        last_dt, last_temp, last_hum, cadence, temp_var, hum_var, base = row
+        base = base or min_interval
+        changed = last_dt is None or dt > last_dt
+        if not changed:
+            base *= GROW_FACTOR
+        else:
+            base *= SHRINK_FACTOR
+            if last_dt is not None:
+                gap_hours = max((dt - last_dt) / 3600.0, 1 / 60)
+                cadence = ewma(cadence, dt - last_dt)
+                temp_rate = (temp - last_temp) / gap_hours
+                hum_rate = (humidity - last_hum) / gap_hours
+                temp_var = ewma(temp_var, temp_rate ** 2)
+                hum_var = ewma(hum_var, hum_rate ** 2)
+
+    base = min(max(base, min_interval), max_interval)
+    volatility = 1 + math.sqrt(temp_var) / TEMP_RATE_REF + math.sqrt(hum_var) / HUMIDITY_RATE_REF
+    interval = base / volatility
+    if cadence:
+        interval = max(interval, cadence)
+    interval = min(max(interval, min_interval), max_interval)
+
+    conn.execute("""
+        INSERT INTO poll_state (city, last_dt, last_temp, last_humidity, last_polled_epoch,
+                                cadence_s, temp_rate_var, humidity_rate_var,
+                                base_interval_s, interval_s, next_due_epoch, polls, unchanged_polls)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+        ON CONFLICT(city) DO UPDATE SET
+            last_dt = excluded.last_dt,
+            last_temp = excluded.last_temp,
+            last_humidity = excluded.last_humidity,
+            last_polled_epoch = excluded.last_polled_epoch,
+            cadence_s = excluded.cadence_s,
+            temp_rate_var = excluded.temp_rate_var,
+            humidity_rate_var = excluded.humidity_rate_var,
+            base_interval_s = excluded.base_interval_s,
+            interval_s = excluded.interval_s,
+            next_due_epoch = excluded.next_due_epoch,
+            polls = poll_state.polls + 1,
+            unchanged_polls = poll_state.unchanged_polls + excluded.unchanged_polls
+    """, (city, dt, temp, humidity, now, cadence, temp_var, hum_var,
+          base, interval, now + int(interval), 0 if changed else 1))
+    conn.commit()
+    return changed, interval
+
+
+def get_due_offsets(conn, cities, window_seconds, now=None):
+    """
+    Poll times inside the coming window, as {city: [offset_seconds, ...]}.
+    Cities without state are due immediately; cities with an interval shorter
+    than the window get several slots. Cities not due in this window are left out.
+    """
+    now = time.time() if now is None else now
+    rows = conn.execute("SELECT city, next_due_epoch, interval_s FROM poll_state").fetchall()
+    state = {city: (due, interval) for city, due, interval in rows}
+
+    offsets = {}
+    for city in cities:
+        if city not in state or state[city][0] is None:
+            offsets[city] = [0.0]
+            continue
+        due, interval = state[city]
+        offset = max(0.0, due - now)
+        slots = []
+        while offset < window_seconds:
+            slots.append(offset)
+            offset += max(interval or window_seconds, 1)
+        if slots:
+            offsets[city] = slots
+    return offsets
@@ -4,13 +4,26 @@ SQL Analysis of Weather Data
 Demonstrates practical SQL skills using your collected weather data
 """
 
-import sqlite3
-import pandas as pd
+import csv
+import heapq
+import operator
+import os
+import sys
 from datetime import datetime, timedelta
+from daily_export import read_export, refresh_export
+from run_ledger import get_run_latency_trend
+from settings import DB_PATH, OUTPUT_DIR
+from sketches import percentiles
+from storage import ensure_schema
+from sharding import database_paths, fan_out, federated_connection
+
+EXPORT_PATH = os.path.join(OUTPUT_DIR, "weather_analysis.csv")
+EXPORT_HEADER = ["date", "avg_temp", "max_temp", "min_temp", "avg_humidity", "weather"]
 
 def connect_to_database():
-    """Connect to your weather database"""
-    return sqlite3.connect("output/weather.db")
+    """Read-only connection to your weather database and its shards (shared per thread, don't close it)"""
+    ensure_schema(DB_PATH)
+    return federated_connection()
 
 def basic_sql_analysis():
     """Basic SQL queries every data engineer should know"""
@@ -40,21 +53,32 @@ def basic_sql_analysis():
     print(f"   Lowest: {result[1]}°C")
     
     # Query 4: Weather conditions breakdown
+    # Groups on the integer condition_id and joins the few names in afterwards
     print("\n4. Weather conditions breakdown:")
-    results = conn.execute("""
+    results = {}
+    for rows in fan_out(lambda conn: conn.execute("""
         SELECT 
-            weather, 
-            COUNT(*) as count,
-            AVG(temp) as avg_temp
-        FROM weather_data 
-        GROUP BY weather
-        ORDER BY count DESC
-    """).fetchall()
+            d.name as weather,
+            s.count,
+            s.temp_sum,
+            s.temp_count
+        FROM (
+            SELECT condition_id, COUNT(*) as count, SUM(temp) as temp_sum, COUNT(temp) as temp_count
+            FROM weather_fact
+            GROUP BY condition_id
+        ) s
+        LEFT JOIN dim_condition d ON d.id = s.condition_id
+    """).fetchall(), database_paths()):
+        # Shards number their conditions independently, so merge by name
+        for weather, count, temp_sum, temp_count in rows:
+            total = results.setdefault(weather, [0, 0.0, 0])
+            total[0] += count
+            total[1] += temp_sum or 0
+            total[2] += temp_count
     
-    for weather, count, avg_temp in results:
+    for weather, (count, temp_sum, temp_count) in sorted(results.items(), key=lambda item: -item[1][0]):
+        avg_temp = temp_sum / temp_count if temp_count else float("nan")
         print(f"   {weather}: {count} times (avg temp: {avg_temp:.1f}°C)")
-    
-    conn.close()
 
 def intermediate_sql_analysis():
     """Intermediate SQL queries for job interviews"""
@@ -118,8 +142,6 @@ def intermediate_sql_analysis():
     print(f"   Missing humidity: {missing_humidity}")
     print(f"   Missing timestamps: {missing_timestamp}")
     print(f"   Data range: {oldest} to {newest}")
-    
-    conn.close()
 
 def advanced_sql_analysis():
     """Advanced SQL for senior roles (you'll learn this later)"""
@@ -145,34 +167,108 @@ def advanced_sql_analysis():
     for timestamp, temp, moving_avg in results:
         print(f"   {timestamp[:16]}: {temp}°C (3-point avg: {moving_avg:.1f}°C)")
     
-    conn.close()
+    # Query 9: ETL run latency trend (from the run ledger)
+    print("\n9. ETL run latency (last 7 days):")
+    results = get_run_latency_trend(conn, days=7)
+    if not results:
+        print("   No runs recorded yet")
+    for date, runs, avg_duration, max_duration, failures in results:
+        print(f"   {date}: {runs} runs, avg {avg_duration or 0:.2f}s, max {max_duration or 0:.2f}s, {failures} failed")
+    
+    # Query 10: Percentiles from the per-hour quantile sketches (no raw rows read)
+    print("\n10. Temperature percentiles by city (p5 / median / p95):")
+    rows = percentiles(conn, quantiles=(0.05, 0.5, 0.95))
+    if not rows:
+        print("   No sketches yet")
+    for city, count, (p5, median, p95) in rows:
+        print(f"   {city}: {p5:.1f} / {median:.1f} / {p95:.1f}°C ({count} readings)")
+
+    # Query 11: Spells and transitions from the per-day condition runs (only new days recomputed)
+    from transitions import condition_analytics, refresh_all_transitions
+    print("\n11. Condition spells and most likely next condition:")
+    refresh_all_transitions()
+    results = condition_analytics(conn)
+    if not results:
+        print("   No condition runs yet")
+    for city, stats in results.items():
+        for i, condition in enumerate(stats["conditions"]):
+            spell = stats["spells"][condition]
+            counts = stats["counts"][i].copy()
+            counts[i] = 0
+            following = stats["conditions"][counts.argmax()] if counts.any() else "-"
+            print(f"   {city} / {condition}: {spell['spells']} spells, median {spell['median_hours']:.1f}h, "
+                  f"longest {spell['max_hours']:.1f}h, then usually {following}")
+
+def merge_export_rows(days=None):
+    """
+    Final export rows for some days (every day when None), merged across
+    databases by condition name: {date: [[date, avg_temp, max, min, avg_humidity, weather], ...]}
+    """
+    def combine(a, b, pick):
+        return b if a is None else a if b is None else pick(a, b)
+
+    # Shards number their conditions independently, so merge by name
+    merged = {}
+    for db_name in database_paths():
+        for date, *partial, weather in read_export(ensure_schema(db_name), days):
+            total = merged.get((date, weather))
+            if total is None:
+                merged[(date, weather)] = partial
+                continue
+            for i, pick in enumerate((operator.add, operator.add, max, min, operator.add, operator.add)):
+                total[i] = combine(total[i], partial[i], pick)
+
+    def cell(value):
+        return "" if value is None else value
+
+    rows = {}
+    # Conditions in name order within a day, missing condition last (as the CSV always had them)
+    for (date, weather), (temp_sum, temp_count, max_temp, min_temp, hum_sum, hum_count) in \
+            sorted(merged.items(), key=lambda item: (item[0][0], item[0][1] is None, item[0][1] or "")):
+        rows.setdefault(date, []).append([
+            date, cell(temp_sum / temp_count if temp_count else None), cell(max_temp), cell(min_temp),
+            cell(hum_sum / hum_count if hum_count else None), cell(weather),
+        ])
+    return rows
 
 def export_for_visualization():
-    """Export data for visualization step"""
-    conn = connect_to_database()
+    """
+    Export daily summaries for the visualization step. Backed by the
+    materialized export_daily tables: only days with new or changed rows are
+    recomputed and read back; every other day's lines are copied from the
+    existing CSV as they are. The CSV is replaced atomically, and only when
+    something changed. Returns the days that changed
+    """
+    changed_days = set()
+    for db_name in database_paths():
+        changed_days.update(refresh_export(ensure_schema(db_name)))
     
-    # Export daily summaries for charts
-    df = pd.read_sql_query("""
-        SELECT 
-            DATE(timestamp) as date,
-            AVG(temp) as avg_temp,
-            MAX(temp) as max_temp,
-            MIN(temp) as min_temp,
-            AVG(humidity) as avg_humidity,
-            weather
-        FROM weather_data 
-        GROUP BY DATE(timestamp), weather
-        ORDER BY date DESC
-    """, conn)
+    exists = os.path.exists(EXPORT_PATH)
+    if not changed_days and exists:
+        print(f"\n📊 {EXPORT_PATH} is up to date")
+        return []
     
-    df.to_csv("output/weather_analysis.csv", index=False)
-    print(f"\n📊 Exported analysis data to output/weather_analysis.csv")
-    print(f"📈 Ready for visualization step!")
+    # A first export reads every day; afterwards only the changed ones
+    fresh = merge_export_rows(changed_days if exists else None)
     
-    conn.close()
-    return df
+    # Both sides are newest day first, so one merge pass keeps the file's order;
+    # write then rename, so a reader never sees a half-written file
+    tmp_path = f"{EXPORT_PATH}.tmp"
+    with open(tmp_path, "w", newline="") as out, \
+            open(EXPORT_PATH if exists else os.devnull, newline="") as existing:
+        reader = csv.reader(existing)
+        next(reader, None)
+        kept = (row for row in reader if row and row[0] not in changed_days)
+        new_rows = (row for date in sorted(fresh, reverse=True) for row in fresh[date])
+        writer = csv.writer(out, lineterminator="\n")
+        writer.writerow(EXPORT_HEADER)
+        writer.writerows(heapq.merge(kept, new_rows, key=lambda row: row[0], reverse=True))
+    os.replace(tmp_path, EXPORT_PATH)
+    print(f"\n📊 Exported analysis data to {EXPORT_PATH} ({len(changed_days)} day(s) recomputed)")
+    print(f"📈 Ready for visualization step!")
+    return sorted(changed_days)
 
-if __name__ == "__main__":
+def main():
     print("🔍 ANALYZING YOUR WEATHER DATA WITH SQL")
     print("=" * 50)
     
@@ -182,7 +278,7 @@ if __name__ == "__main__":
         advanced_sql_analysis()
         
         print("\n" + "=" * 50)
-        export_data = export_for_visualization()
+        export_for_visualization()
         
         print(f"\n🎉 SQL Analysis Complete!")
         print(f"📋 This demonstrates SQL skills employers want:")
@@ -191,8 +287,18 @@ if __name__ == "__main__":
         print(f"   ✅ Date operations")
         print(f"   ✅ Data quality checks")
         print(f"   ✅ Window functions (advanced)")
+        print(f"   ✅ Percentiles from mergeable sketches")
+        print(f"   ✅ Run lengths and transition matrices")
         
     except Exception as e:
         print(f"❌ Error: {e}")
-        print("💡 Make sure you have weather data in output/weather.db")
-        print("Run your ETL script first: python3 etl_production.py") 
\ No newline at end of file
+        print(f"💡 Make sure you have weather data in {DB_PATH}")
+        print("Run your ETL script first: python3 etl_production.py")
+
+if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        from profiling import profile_run
+        with profile_run("analyze"):
+            main()
+    else:
+        main()
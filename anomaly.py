@@ -0,0 +1,148 @@
+"""
+Streaming Anomaly Detection
+Replaces the fixed temperature range check. Every reading is scored against
+running statistics for its city and hour of day (UTC), kept in
+`anomaly_stats` so they survive between cron runs:
+- Welford mean/variance -> classic z-score
+- a median/MAD sketch (stochastic approximation, O(1) state) -> robust z-score,
+  which one extreme reading cannot drag along the way it drags the mean
+
+A reading is flagged when its robust z-score exceeds the threshold after the
+bucket has seen enough samples. Flags are counted in anomaly_stats (so the
+dashboard never rescans history) and written to `anomaly_log`.
+"""
+
+import math
+import time
+
+# Scale factor that makes MAD comparable to a standard deviation (normal data)
+MAD_TO_SIGMA = 0.6745
+
+# Median/MAD sketch step, as a fraction of the current MAD
+SKETCH_STEP = 0.05
+
+# Floor for the spread (°C) so a bucket with constant readings doesn't flag tiny changes
+MIN_SPREAD = 0.5
+
+
+def ensure_anomaly_tables(conn):
+    """Create the anomaly_stats and anomaly_log tables"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_stats (
+            city TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            samples INTEGER NOT NULL,
+            mean REAL NOT NULL,
+            m2 REAL NOT NULL,
+            median REAL NOT NULL,
+            mad REAL NOT NULL,
+            anomalies INTEGER NOT NULL DEFAULT 0,
+            last_z REAL,
+            last_robust_z REAL,
+            updated_at INTEGER,
+            PRIMARY KEY (city, hour)
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS anomaly_log (
+            id INTEGER PRIMARY KEY,
+            city TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            temp REAL NOT NULL,
+            z REAL,
+            robust_z REAL,
+            expected REAL
+        )
+    """)
+    conn.commit()
+
+
+def score(state, value, threshold, min_samples):
+    """
+    Score value against a bucket state (samples, mean, m2, median, mad) and
+    return (z, robust_z, flagged, new_state). The score uses the state before
+    this value is added.
+    """
+    samples, mean, m2, median, mad = state
+    z = robust_z = None
+    if samples >= 2:
+        std = math.sqrt(m2 / (samples - 1))
+        z = (value - mean) / max(std, MIN_SPREAD)
+        robust_z = MAD_TO_SIGMA * (value - median) / max(mad, MIN_SPREAD * MAD_TO_SIGMA)
+    flagged = samples >= min_samples and robust_z is not None and abs(robust_z) > threshold
+
+    # Welford update
+    samples += 1
+    delta = value - mean
+    mean += delta / samples
+    m2 += delta * (value - mean)
+
+    if samples <= min_samples:
+        # Warm-up: seed the sketch from the exact moments (normal approximation)
+        median = mean
+        mad = MAD_TO_SIGMA * math.sqrt(m2 / (samples - 1)) if samples > 1 else 0.0
+    else:
+        # Nudge median and MAD one step towards this value (frugal streaming quantiles)
+        step = SKETCH_STEP * max(mad, MIN_SPREAD)
+        median += math.copysign(step, value - median) if value != median else 0.0
+        deviation = abs(value - median)
+        mad += math.copysign(step, deviation - mad) if deviation != mad else 0.0
+        mad = max(mad, 0.0)
+
+    return z, robust_z, flagged, (samples, mean, m2, median, mad)
+
+
+def observe(conn, city, timestamp, epoch, temp, threshold, min_samples, now=None):
+    """
+    Score one reading and fold it into its city/hour bucket.
+    Returns (z, robust_z, flagged).
+    """
+    now = int(time.time() if now is None else now)
+    hour = epoch // 3600 % 24
+    # Read and write under one write lock, so concurrent pollers of the same
+    # city can't both start from the same state and lose an update
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute("""
+            SELECT samples, mean, m2, median, mad FROM anomaly_stats WHERE city = ? AND hour = ?
+        """, (city, hour)).fetchone()
+        state = row or (0, 0.0, 0.0, 0.0, 0.0)
+        z, robust_z, flagged, (samples, mean, m2, median, mad) = score(state, temp, threshold, min_samples)
+
+        conn.execute("""
+            INSERT INTO anomaly_stats (city, hour, samples, mean, m2, median, mad,
+                                       anomalies, last_z, last_robust_z, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(city, hour) DO UPDATE SET
+                samples = excluded.samples,
+                mean = excluded.mean,
+                m2 = excluded.m2,
+                median = excluded.median,
+                mad = excluded.mad,
+                anomalies = anomaly_stats.anomalies + excluded.anomalies,
+                last_z = excluded.last_z,
+                last_robust_z = excluded.last_robust_z,
+                updated_at = excluded.updated_at
+        """, (city, hour, samples, mean, m2, median, mad, int(flagged), z, robust_z, now))
+        if flagged:
+            conn.execute("""
+                INSERT INTO anomaly_log (city, timestamp, temp, z, robust_z, expected)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (city, timestamp, temp, z, robust_z, state[3]))
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return z, robust_z, flagged
+
+
+def get_anomaly_counts(conn):
+    """Flagged readings per city, from the running counters ([] before the first scored reading)"""
+    exists = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'anomaly_stats'"
+    ).fetchone()
+    if not exists:
+        return []
+    return conn.execute("""
+        SELECT city, SUM(anomalies) FROM anomaly_stats GROUP BY city ORDER BY city
+    """).fetchall()
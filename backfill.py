@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Backfill weather_data from a CSV export
+Loads rows that are in the CSV but missing from SQLite (matched on city and
+timestamp) with batched inserts. Useful after a database restore or when
+SQLite writes failed while CSV writes succeeded.
+
+Rows older than the raw retention cutoff are skipped: compaction has already
+rolled them into weather_hourly, and inserting them again would count them
+twice.
+"""
+
+import csv
+import sys
+
+from etl_production import insert_batch
+from retention import raw_cutoff_epoch
+from run_ledger import timestamp_to_epoch
+from settings import CSV_PATH, DB_PATH
+from storage import ensure_schema
+from sharding import city_db_path, federated_connection
+from weather_batch import WeatherBatch, canonical_timestamp
+
+
+def read_csv_rows(filename):
+    """Yield (epoch, city, temp, humidity, weather) from a weather CSV, skipping bad rows"""
+    with open(filename, newline="") as file:
+        reader = csv.reader(file)
+        header = [name.strip().lower() for name in next(reader, [])]
+        columns = {name: i for i, name in enumerate(header)}
+        for row in reader:
+            try:
+                yield (
+                    timestamp_to_epoch(row[columns["timestamp"]]),
+                    row[columns["city"]],
+                    float(row[columns["temp"]]),
+                    int(float(row[columns["humidity"]])),
+                    row[columns["weather"]],
+                )
+            except (KeyError, IndexError, ValueError):
+                continue
+
+
+def backfill_from_csv(filename=CSV_PATH, db_name=None, batch_size=5000):
+    """
+    Insert CSV rows missing from weather_data. Returns the number of rows added.
+    Rows go to db_name, or to each city's own database when it is not given.
+    Rows older than the raw retention cutoff are never inserted.
+    """
+    ensure_schema(DB_PATH)
+    cutoff = raw_cutoff_epoch()
+    # A day early on the ISO timestamp covers offsets; the exact check is on the epoch below
+    since = canonical_timestamp(cutoff - 86400)[:10]
+    conn = federated_connection() if db_name is None else ensure_schema(db_name)
+    existing_rows = conn.execute("SELECT city, timestamp FROM weather_data WHERE timestamp >= ?", (since,))
+
+    existing = set()
+    for city, timestamp in existing_rows:
+        if timestamp:
+            existing.add((city, timestamp_to_epoch(timestamp)))
+
+    # Pending rows per target database, as columns (see weather_batch.py)
+    added = 0
+    batches = {}
+    for epoch, city, temp, humidity, weather in read_csv_rows(filename):
+        if epoch < cutoff or (city, epoch) in existing:
+            continue
+        existing.add((city, epoch))
+        target = db_name or city_db_path(city)
+        batch = batches.get(target)
+        if batch is None:
+            batch = batches[target] = WeatherBatch()
+        batch.append(epoch, city, temp, humidity, weather)
+        added += 1
+        if len(batch) >= batch_size:
+            # Each flush also advances last_ingest for its cities in the same transaction
+            insert_batch(target, batches.pop(target))
+    for target, batch in batches.items():
+        insert_batch(target, batch)
+    return added
+
+
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else CSV_PATH
+    rows = backfill_from_csv(source)
+    print(f"✅ Backfilled {rows} rows from {source}")
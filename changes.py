@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Change Feed
+Downstream jobs used to find new data by rescanning weather_data. Instead,
+triggers on weather_fact append every insert, update and delete to
+`change_log` with a sequence number that only ever grows (AUTOINCREMENT, so
+a number is never reused even after pruning). Each entry carries the row
+image (the old values for a delete), so a consumer never has to re-read
+weather_data to apply it.
+
+- changes_since(seq, limit): the next page of one database's log
+- read_feed(cursor, limit): every database (weather.db and its shards)
+  behind one opaque cursor string; pass back the returned cursor
+- follow(): read_feed in a loop, waking on a notification datagram
+
+Notifications are optional: with CHANGES_NOTIFY_DIR set, each listener binds
+a Unix datagram socket there and writers send it a few bytes after every
+commit. They are only a hint; follow() still polls, so a missed datagram
+costs latency, never data.
+
+A consumer's cursor is valid while the log still holds the entries after
+it; retention prunes entries older than CHANGE_LOG_DAYS, and an older
+cursor raises ValueError (re-snapshot and start from current_cursor()).
+Reading without a cursor starts at the oldest entry still retained.
+"""
+
+import base64
+import glob
+import json
+import os
+import socket
+import sys
+import time
+
+from settings import DB_PATH, CHANGES_NOTIFY_DIR, CHANGES_PAGE_SIZE
+from storage import get_connection
+
+ROW_COLUMNS = "timestamp, city_id, temp, humidity, condition_id"
+
+
+def ensure_change_log(conn):
+    """Create change_log and the weather_fact triggers that fill it"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS change_log (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            op TEXT NOT NULL,               -- I / U / D
+            fact_id INTEGER NOT NULL,
+            timestamp TEXT,
+            city_id INTEGER,
+            temp REAL,
+            humidity INTEGER,
+            condition_id INTEGER,
+            changed_at INTEGER NOT NULL
+        )
+    """)
+    for op, event, image in (("I", "INSERT", "NEW"), ("U", "UPDATE", "NEW"), ("D", "DELETE", "OLD")):
+        values = ", ".join(f"{image}.{column.strip()}" for column in ROW_COLUMNS.split(","))
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS change_log_{event.lower()}
+            AFTER {event} ON weather_fact
+            BEGIN
+                INSERT INTO change_log (op, fact_id, {ROW_COLUMNS}, changed_at)
+                VALUES ('{op}', {image}.id, {values}, CAST(strftime('%s', 'now') AS INTEGER));
+            END
+        """)
+    conn.commit()
+
+
+def _check_seq(conn, seq):
+    """ValueError if entries after seq have already been pruned"""
+    oldest = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+    if oldest is None:
+        newest = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+        oldest = newest[0] + 1 if newest else 1
+    if seq < oldest - 1:
+        raise ValueError(f"Cursor at {seq} is older than the change log (starts at {oldest}); re-snapshot")
+
+
+def changes_since(seq, limit=CHANGES_PAGE_SIZE, db_name=DB_PATH):
+    """Up to `limit` changes after seq in one database, oldest first, as dicts"""
+    conn = get_connection(db_name, readonly=True)
+    _check_seq(conn, seq)
+    rows = conn.execute("""
+        SELECT l.seq, l.op, l.fact_id, l.timestamp, c.name, l.temp, l.humidity, d.name, l.changed_at
+        FROM change_log l
+        LEFT JOIN dim_city c ON c.id = l.city_id
+        LEFT JOIN dim_condition d ON d.id = l.condition_id
+        WHERE l.seq > ?
+        ORDER BY l.seq
+        LIMIT ?
+    """, (seq, limit)).fetchall()
+    return [
+        {"seq": s, "op": op, "id": fact_id, "timestamp": ts, "city": city, "temp": temp,
+         "humidity": humidity, "weather": weather, "changed_at": changed_at}
+        for s, op, fact_id, ts, city, temp, humidity, weather, changed_at in rows
+    ]
+
+
+def latest_seq(conn):
+    """Newest sequence number handed out in this database (0 if none)"""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'change_log'").fetchone()
+    return row[0] if row else 0
+
+
+def oldest_seq(conn):
+    """Position just before the oldest retained entry (where a reader without a cursor starts)"""
+    oldest = conn.execute("SELECT MIN(seq) FROM change_log").fetchone()[0]
+    return latest_seq(conn) if oldest is None else oldest - 1
+
+
+def encode_feed_cursor(positions):
+    return base64.urlsafe_b64encode(json.dumps(positions, sort_keys=True).encode()).decode()
+
+
+def decode_feed_cursor(cursor):
+    if not cursor:
+        return {}
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise ValueError("Malformed change feed cursor")
+
+
+def current_cursor():
+    """Cursor at the end of every database's log (start here after taking a snapshot)"""
+    from sharding import database_paths
+    return encode_feed_cursor({os.path.basename(path): latest_seq(get_connection(path, readonly=True))
+                               for path in database_paths()})
+
+
+def read_feed(cursor=None, limit=CHANGES_PAGE_SIZE):
+    """
+    Changes after `cursor` from weather.db and every shard, at most `limit`
+    in total. Returns (changes, next_cursor); each change names its "db".
+    Order is by sequence within a database; databases are read in turn.
+    Databases the cursor doesn't mention start at their oldest retained entry
+    """
+    from sharding import database_paths
+
+    positions = decode_feed_cursor(cursor)
+    changes = []
+    for path in database_paths():
+        name = os.path.basename(path)
+        if len(changes) >= limit:
+            break
+        seq = positions.get(name)
+        if seq is None:
+            seq = oldest_seq(get_connection(path, readonly=True))
+        page = changes_since(seq, limit - len(changes), path)
+        if page:
+            positions[name] = page[-1]["seq"]
+        changes.extend({"db": name, **change} for change in page)
+    return changes, encode_feed_cursor(positions)
+
+
+def prune_changes(conn, cutoff_epoch):
+    """Delete log entries older than the cutoff. Returns how many"""
+    with conn:
+        return conn.execute("DELETE FROM change_log WHERE changed_at < ?", (cutoff_epoch,)).rowcount
+
+
+def notify_changes(db_name, notify_dir=CHANGES_NOTIFY_DIR):
+    """Best-effort datagram to every listener socket in notify_dir (no-op when unset)"""
+    if not notify_dir:
+        return 0
+    sent = 0
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for path in glob.glob(os.path.join(notify_dir, "*.sock")):
+            try:
+                sock.sendto(os.path.basename(db_name).encode(), path)
+                sent += 1
+            except OSError:
+                # Listener gone or its queue full: it will catch up on its next poll
+                pass
+    return sent
+
+
+def follow(handler, cursor=None, name=None, poll_seconds=30, limit=CHANGES_PAGE_SIZE,
+           notify_dir=CHANGES_NOTIFY_DIR):
+    """
+    Call handler(changes, cursor) for every new page of changes, forever.
+    Starts at `cursor` (None = the current end of the log). Sleeps until a
+    notification arrives or poll_seconds pass. The listener socket is named
+    after `name` and the process id, so several followers never share one
+    """
+    cursor = cursor or current_cursor()
+    listener = None
+    if notify_dir:
+        os.makedirs(notify_dir, exist_ok=True)
+        path = os.path.join(notify_dir, f"{name}-{os.getpid()}.sock" if name else f"{os.getpid()}.sock")
+        if os.path.exists(path):
+            os.unlink(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        listener.bind(path)
+    try:
+        while True:
+            changes, cursor = read_feed(cursor, limit)
+            if changes:
+                handler(changes, cursor)
+            if len(changes) == limit:
+                continue
+            if listener is None:
+                time.sleep(poll_seconds)
+                continue
+            listener.settimeout(poll_seconds)
+            try:
+                listener.recv(256)
+                # Drain queued notifications; one read covers them all
+                listener.setblocking(False)
+                while True:
+                    listener.recv(256)
+            except (socket.timeout, BlockingIOError):
+                pass
+    finally:
+        if listener is not None:
+            os.unlink(listener.getsockname())
+            listener.close()
+
+
+if __name__ == "__main__":
+    def print_changes(changes, cursor):
+        for change in changes:
+            print(json.dumps(change))
+        print(f"# cursor {cursor}", file=sys.stderr)
+
+    follow(print_changes, sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Startup Budget Check
+`weather-etl run` is what cron starts every window, so its imports must stay
+light. This imports the CLI and the ETL module in a fresh interpreter and
+fails if any heavy dependency gets loaded or the imports take longer than
+the budget.
+
+    python check_startup.py [BUDGET_MS]
+"""
+
+import os
+import subprocess
+import sys
+
+HEAVY_MODULES = ("numpy", "pandas", "matplotlib")
+BUDGET_MS = 150
+
+PROBE = f"""
+import sys, time
+start = time.perf_counter()
+import weather_etl, etl_production
+elapsed = (time.perf_counter() - start) * 1000
+print(elapsed, *[name for name in {HEAVY_MODULES!r} if name in sys.modules])
+"""
+
+
+def check_startup(budget_ms=BUDGET_MS, attempts=3):
+    """Returns a list of problems (empty when the run path is within budget)"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    timings = []
+    for _ in range(attempts):
+        output = subprocess.run([sys.executable, "-c", PROBE], cwd=here, check=True,
+                                capture_output=True, text=True).stdout.split()
+        timings.append(float(output[0]))
+        if output[1:]:
+            return [f"importing the run path loads {', '.join(output[1:])}"]
+    # Best of a few runs, so a busy machine doesn't fail the check
+    if min(timings) > budget_ms:
+        return [f"importing the run path took {min(timings):.0f} ms (budget {budget_ms} ms)"]
+    return []
+
+
+if __name__ == "__main__":
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET_MS
+    problems = check_startup(budget)
+    for problem in problems:
+        print(f"❌ {problem}")
+    if not problems:
+        print(f"✅ weather_etl and etl_production import without {', '.join(HEAVY_MODULES)} within {budget:.0f} ms")
+    sys.exit(1 if problems else 0)
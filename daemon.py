@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Long-Running ETL Daemon
+Alternative to the cron entry: runs one ETL window after another in a single
+process, runs retention once a day, and can serve the query API alongside.
+When it does, the API's hot window of recent readings is brought up to date
+after every window, so dashboard queries never wait on the catch-up.
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+
+from etl_production import log_message, run_etl
+from settings import DB_PATH, SCHEDULE_WINDOW_SECONDS
+
+
+def start_query_api(db_name=DB_PATH):
+    """Run the read-only query API in a background thread"""
+    from query_api import QueryServer
+    from settings import QUERY_API_HOST, QUERY_API_PORT
+
+    server = QueryServer((QUERY_API_HOST, QUERY_API_PORT), db_name)
+    thread = threading.Thread(target=server.serve_forever, name="query-api", daemon=True)
+    thread.start()
+    cities, readings, size = server.hot_window.stats()
+    log_message(f"🌐 Query API on http://{QUERY_API_HOST}:{QUERY_API_PORT} "
+                f"(hot window: {readings} readings, {cities} cities, {size / 2 ** 20:.1f} MiB)")
+    return server
+
+
+def run_daemon(serve_api=False, compact_daily=True):
+    """Run ETL windows back to back until interrupted"""
+    log_message("⚡ Weather ETL daemon starting")
+    server = start_query_api() if serve_api else None
+    last_compaction_day = None
+
+    try:
+        while True:
+            window_start = time.monotonic()
+            run_etl()
+            if server is not None:
+                server.hot_window.refresh()
+
+            today = datetime.now(timezone.utc).date()
+            if compact_daily and today != last_compaction_day:
+                from retention import run_compaction_all
+                run_compaction_all()
+                last_compaction_day = today
+
+            # Sleep until the next window so the cadence matches the cron schedule
+            elapsed = time.monotonic() - window_start
+            time.sleep(max(0, SCHEDULE_WINDOW_SECONDS - elapsed))
+    except KeyboardInterrupt:
+        log_message("🛑 Daemon stopped by user")
+    finally:
+        if server is not None:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    run_daemon()
@@ -0,0 +1,138 @@
+"""
+Materialized Daily Export
+Backs export_for_visualization() with a per-database table of partial daily
+aggregates per condition (`export_daily`) instead of a GROUP BY over all of
+weather_fact on every call.
+
+Triggers on weather_fact add the day of every inserted, updated or deleted
+row to `export_dirty_days`, whichever code path wrote it (ETL, backfill,
+retention, shard migration). A refresh recomputes only those days, in the
+same transaction that clears them, so an export costs O(changed days).
+"""
+
+import json
+
+from storage import table_exists
+
+# Rows for one day: an index range on timestamp, widened by a day on each side
+# because DATE() normalizes "+hh:mm" offsets to UTC. Used with CROSS JOIN, which
+# makes SQLite keep the few dirty days as the outer loop instead of scanning facts
+DAY_ROWS_SQL = """
+    f.timestamp >= date(d.day, '-1 day') AND f.timestamp < date(d.day, '+2 days')
+    AND DATE(f.timestamp) = d.day
+"""
+
+
+def _create_export_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS export_daily (
+            date TEXT NOT NULL,
+            condition_id INTEGER,
+            temp_sum REAL,
+            temp_count INTEGER NOT NULL,
+            max_temp REAL,
+            min_temp REAL,
+            humidity_sum REAL,
+            humidity_count INTEGER NOT NULL
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_export_daily_date ON export_daily (date)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS export_dirty_days (
+            day TEXT PRIMARY KEY
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS export_dirty_insert
+        AFTER INSERT ON weather_fact
+        WHEN DATE(NEW.timestamp) IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO export_dirty_days (day) VALUES (DATE(NEW.timestamp));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS export_dirty_delete
+        AFTER DELETE ON weather_fact
+        WHEN DATE(OLD.timestamp) IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO export_dirty_days (day) VALUES (DATE(OLD.timestamp));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS export_dirty_update
+        AFTER UPDATE ON weather_fact
+        BEGIN
+            INSERT OR IGNORE INTO export_dirty_days (day)
+            SELECT DATE(OLD.timestamp) WHERE DATE(OLD.timestamp) IS NOT NULL;
+            INSERT OR IGNORE INTO export_dirty_days (day)
+            SELECT DATE(NEW.timestamp) WHERE DATE(NEW.timestamp) IS NOT NULL;
+        END
+    """)
+
+
+def ensure_export_tables(conn):
+    """
+    Create the materialized export and its dirty-day triggers. On first
+    creation every day already in weather_fact is marked dirty, so the first
+    refresh builds the whole view.
+    """
+    if table_exists(conn, "export_dirty_days"):
+        return False
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _create_export_tables(conn)
+        conn.execute("""
+            INSERT OR IGNORE INTO export_dirty_days (day)
+            SELECT DISTINCT DATE(timestamp) FROM weather_fact WHERE DATE(timestamp) IS NOT NULL
+        """)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
+
+
+def refresh_export(conn):
+    """Recompute the dirty days of one database. Returns the days that changed"""
+    ensure_export_tables(conn)
+    if conn.execute("SELECT 1 FROM export_dirty_days LIMIT 1").fetchone() is None:
+        return []
+    # Take the write lock before reading the dirty set, so no writer can slip a day in between
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        days = [day for (day,) in conn.execute("SELECT day FROM export_dirty_days ORDER BY day")]
+        conn.execute("DELETE FROM export_daily WHERE date IN (SELECT day FROM export_dirty_days)")
+        conn.execute(f"""
+            INSERT INTO export_daily (date, condition_id, temp_sum, temp_count, max_temp,
+                                      min_temp, humidity_sum, humidity_count)
+            SELECT d.day, f.condition_id, SUM(f.temp), COUNT(f.temp), MAX(f.temp),
+                   MIN(f.temp), SUM(f.humidity), COUNT(f.humidity)
+            FROM export_dirty_days d
+            CROSS JOIN weather_fact f ON {DAY_ROWS_SQL}
+            GROUP BY d.day, f.condition_id
+        """)
+        conn.execute("DELETE FROM export_dirty_days")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return days
+
+
+def read_export(conn, days=None):
+    """
+    Materialized rows of one database with condition names, for the given
+    days (every day when None):
+    [(date, temp_sum, temp_count, max_temp, min_temp, humidity_sum, humidity_count, weather)]
+    """
+    if days is None:
+        where, params = "", ()
+    else:
+        where, params = "WHERE e.date IN (SELECT value FROM json_each(?))", (json.dumps(sorted(days)),)
+    return conn.execute(f"""
+        SELECT e.date, e.temp_sum, e.temp_count, e.max_temp, e.min_temp,
+               e.humidity_sum, e.humidity_count, c.name AS weather
+        FROM export_daily e
+        LEFT JOIN dim_condition c ON c.id = e.condition_id
+        {where}
+    """, params).fetchall()
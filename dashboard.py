@@ -1,200 +1,370 @@
-import matplotlib.pyplot as plt
-import sqlite3
-from datetime import datetime, timedelta
-
-def get_last_update():
-    conn = sqlite3.connect("/usr/local/weather-etl/output/weather.db")
-    result = conn.execute("SELECT MAX(timestamp) FROM weather_data").fetchone()
-    conn.close()
-    
-    if result[0]:
-        from datetime import timezone, timedelta
-        # Parse the UTC timestamp
-        dt = datetime.fromisoformat(result[0].replace('+00:00', ''))
-        # Convert to UTC+3
-        local_dt = dt + timedelta(hours=3)
-        return local_dt.strftime("%b %d, %Y %I:%M %p")
-    return "No data"
-
-def get_temperature_trend():
-    conn = sqlite3.connect("/usr/local/weather-etl/output/weather.db")
-    # Get last 5 days of data
-    result = conn.execute("""
-        SELECT DATE(timestamp) as date, AVG(temp) as avg_temp
-        FROM weather_data 
-        WHERE timestamp >= datetime('now', '-5 days')
-        GROUP BY DATE(timestamp)
-        ORDER BY date
-    """).fetchall()
-    conn.close()
-    return result
-
-def get_today_summary():
-    conn = sqlite3.connect("/usr/local/weather-etl/output/weather.db")
-    result = conn.execute("""
-        SELECT MIN(temp) as min_temp, MAX(temp) as max_temp, COUNT(*) as readings
-        FROM weather_data 
-        WHERE DATE(timestamp) = DATE('now')
-    """).fetchone()
-    conn.close()
-    return result
-
-def check_data_freshness():
-    conn = sqlite3.connect("/usr/local/weather-etl/output/weather.db")
-    result = conn.execute("""
-        SELECT timestamp FROM weather_data 
-        ORDER BY timestamp DESC LIMIT 1
-    """).fetchone()
-    conn.close()
-    
-    if result:
-        from datetime import datetime, timedelta
-        # Parse UTC timestamp
-        last_update = datetime.fromisoformat(result[0].replace('+00:00', ''))
-        # Convert to UTC+3
-        last_update_local = last_update + timedelta(hours=3)
-        
-        # Get current local time
-        now_local = datetime.utcnow() + timedelta(hours=3)
-        
-        # Calculate difference
-        minutes_ago = (now_local - last_update_local).total_seconds() / 60
-        return minutes_ago <= 30
-    return False
-
-def get_data_quality_report():
-    conn = sqlite3.connect("/usr/local/weather-etl/output/weather.db")
+"""
+Dashboard
+render_dashboard() draws the six-panel dashboard for all cities or for one.
+render_all_dashboards() writes one PNG per city plus a small-multiples
+overview into DASHBOARD_DIR, drawing them in a process pool (matplotlib holds
+the GIL, so threads would not help). Each artifact is cached under its city's
+data version (last ingest, row count, anomaly count, day and freshness), so
+a refresh only redraws cities with new data.
+
+The last update, today's summary, the 5-day trend and freshness come from
+the hot window (see hot_window.py), loaded once per process; the pool's
+workers inherit it when they fork.
+"""
+
+import hashlib
+import json
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+
+from anomaly import get_anomaly_counts
+from hot_window import get_hot_window
+from run_ledger import get_last_ingest
+from storage import count_duplicate_readings, ensure_schema
+from sharding import federated_connection
+from settings import DASHBOARD_DIR, DASHBOARD_WORKERS, DB_PATH, HOT_WINDOW_DAYS, LOCAL_TIMEZONE, STALE_AFTER_MINUTES
+
+OVERVIEW_FILE = "overview.png"
+MANIFEST_FILE = "manifest.json"
+
+
+def _city_filter(city, keyword="AND"):
+    """Extra condition restricting a weather_data query to one city ("" for all cities)"""
+    return (f"{keyword} city = ?", (city,)) if city else ("", ())
+
+def get_last_update(city=None):
+    # Newest reading in the hot window; the ledger only when nothing arrived within it
+    latest = get_hot_window().latest(city)
+    if latest:
+        last_epoch = max(row[1] for row in latest)
+    else:
+        result = get_last_ingest(federated_connection(), city)
+        if not result:
+            return "No data"
+        last_epoch = result[2]
+
+    # last_epoch is UTC; show it in the configured local timezone
+    local_dt = datetime.fromtimestamp(last_epoch, tz=timezone.utc).astimezone(ZoneInfo(LOCAL_TIMEZONE))
+    return local_dt.strftime("%b %d, %Y %I:%M %p")
+
+def get_temperature_trend(city=None):
+    # Daily averages for the last 5 days, from the in-memory hot window
+    return get_hot_window().daily_trend(city, 5)
+
+def get_today_summary(city=None):
+    # (min temp, max temp, readings) for the current UTC day
+    return get_hot_window().today_summary(city)
+
+def check_data_freshness(city=None):
+    # Minutes since each city's newest reading in the hot window (None: nothing within the window)
+    freshness = get_hot_window().freshness([city] if city else None)
+
+    for stale_city, age_minutes, stale in freshness:
+        if age_minutes is None:
+            print(f"⚠️ {stale_city} is stale: no readings in the last {HOT_WINDOW_DAYS} days")
+        elif stale:
+            print(f"⚠️ {stale_city} is stale: last update {age_minutes:.0f} minutes ago")
+
+    return bool(freshness) and not any(stale for _, _, stale in freshness)
+
+def get_data_quality_report(city=None):
+    conn = federated_connection()
+    where, params = _city_filter(city, "WHERE")
     
     # Check 1: Missing values
-    missing_check = conn.execute("""
+    missing_check = conn.execute(f"""
         SELECT 
             COUNT(*) as total_records,
             COUNT(CASE WHEN temp IS NULL THEN 1 END) as missing_temp,
             COUNT(CASE WHEN humidity IS NULL THEN 1 END) as missing_humidity
         FROM weather_data
-    """).fetchone()
+        {where}
+    """, params).fetchone()
     
-    # Check 2: Outliers 
-    outlier_check = conn.execute("""
-        SELECT COUNT(*) as outliers
-        FROM weather_data 
-        WHERE temp < 0 OR temp > 50
-    """).fetchone()
+    # Check 2: Outliers (running anomaly counters, no history scan)
+    outliers = sum(count for name, count in get_anomaly_counts(conn) if city is None or name == city)
     
-    # Check 3: Duplicate records (same timestamp)
-    duplicate_check = conn.execute("""
-        SELECT COUNT(*) - COUNT(DISTINCT timestamp) as duplicates
-        FROM weather_data
-    """).fetchone()
-    
-    conn.close()
+    # Check 3: Duplicate records (same city and timestamp)
+    duplicates = count_duplicate_readings(conn, city)
     
     return {
         'total_records': missing_check[0],
         'missing_temp': missing_check[1],
         'missing_humidity': missing_check[2],
-        'outliers': outlier_check[0],
-        'duplicates': duplicate_check[0]
+        'outliers': outliers,
+        'duplicates': duplicates
     }
 
-# Create dashboard
-fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6)) = plt.subplots(3, 2, figsize=(12, 10))
-
-
-last_update = get_last_update()
-ax1.text(0.5, 0.5, f"Last Update: {last_update}", 
-         ha='center', va='center', fontsize=12, fontweight='bold')
-ax1.set_xlim(0, 1)
-ax1.set_ylim(0, 1)
-ax1.axis('off')
-
-# Panel 2: Temperature Trend
-trend_data = get_temperature_trend()
-if trend_data:
-    dates = [row[0] for row in trend_data]
-    temps = [row[1] for row in trend_data]
-    ax2.plot(dates, temps, marker='o', linewidth=2)
-    ax2.set_title('Temperature Trend (5 Days)')
-    ax2.set_ylabel('Temperature (°C)')
-    ax2.tick_params(axis='x', rotation=45)
-
-# Panel 3: Today's Summary
-today_data = get_today_summary()
-if today_data and today_data[0]:
-    min_temp, max_temp, readings = today_data
-    ax3.bar(['Min', 'Max'], [min_temp, max_temp], color=['lightblue', 'lightcoral'])
-    ax3.set_title(f"Today's Temperature ({readings} readings)")
-    ax3.set_ylabel('Temperature (°C)')
-    
-    # Add padding above the highest bar
-    max_value = max(min_temp, max_temp)
-    padding = max_value * 0.15  # 15% padding above highest bar
-    ax3.set_ylim(0, max_value + padding)
-    
-    # Position text labels with proper spacing
-    for i, v in enumerate([min_temp, max_temp]):
-        ax3.text(i, v + (padding * 0.3), f'{v:.1f}°C', ha='center', fontweight='bold')
-    
-    # Add explanation when min = max (if needed)
-    if abs(min_temp - max_temp) < 0.01:
-        ax3.text(0.5, min_temp - (padding * 0.6), f"Same value: Only {readings} reading(s) collected today", 
-                ha='center', fontsize=9, style='italic', color='gray')
-
-# Panel 4: Data Freshness
-is_fresh = check_data_freshness()
-if is_fresh:
-    color = 'green'
-    status = 'FRESH'
-    symbol = '●'
-else:
-    color = 'red'
-    status = 'STALE'
-    symbol = '●'
-
-ax4.text(0.5, 0.6, f"{symbol} Data Status:\n{status}", 
-         ha='center', va='center', fontsize=12, fontweight='bold', color=color)
-ax4.set_xlim(0, 1)
-ax4.set_ylim(0, 1)
-ax4.axis('off')
-
-# Panel 5: Data Quality Report
-quality_report = get_data_quality_report()
-quality_text = f"""Data Quality Report:
-Total Records: {quality_report['total_records']}
-Missing Temp: {quality_report['missing_temp']}
-Missing Humidity: {quality_report['missing_humidity']}
-Outliers: {quality_report['outliers']}
-Duplicates: {quality_report['duplicates']}"""
-
-ax5.text(0.5, 0.5, quality_text, ha='center', va='center', fontsize=11, 
-         bbox=dict(boxstyle="round,pad=0.5", facecolor="lightgray", alpha=0.8))
-ax5.set_title("Data Quality")
-ax5.set_xlim(0, 1)
-ax5.set_ylim(0, 1)
-ax5.axis('off')
-
-# Panel 6: Overall Quality Status
-quality_report = get_data_quality_report()
-total_issues = (quality_report['missing_temp'] + 
-                quality_report['missing_humidity'] + 
-                quality_report['outliers'] + 
-                quality_report['duplicates'])
-
-if total_issues == 0:
-    symbol = '●'
-    color = 'green'
-    message = f"{symbol} PERFECT\nDATA QUALITY"
-else:
-    symbol = '●'
-    color = 'orange'
-    message = f"{symbol} {total_issues} ISSUES\nFOUND"
-
-ax6.text(0.5, 0.6, message, 
-         ha='center', va='center', fontsize=12, fontweight='bold', color=color)
-ax6.set_xlim(0, 1)
-ax6.set_ylim(0, 1)
-ax6.axis('off')
-ax6.set_title("Overall Quality")
-
-plt.tight_layout()
-plt.show()
\ No newline at end of file
+def get_hourly_trends(days=5):
+    """{city: [(hour, avg_temp), ...]} for the overview, in one GROUP BY"""
+    conn = federated_connection()
+    trends = {}
+    for city, hour, avg_temp in conn.execute("""
+        SELECT city, strftime('%Y-%m-%d %H:00', timestamp) AS hour, AVG(temp)
+        FROM weather_data
+        WHERE timestamp >= datetime('now', ?) AND city IS NOT NULL
+        GROUP BY city, hour
+        ORDER BY city, hour
+    """, (f"-{int(days)} days",)):
+        trends.setdefault(city, []).append((hour, avg_temp))
+    return trends
+
+def city_data_versions():
+    """
+    {city: version}. The version changes whenever a dashboard for the city
+    would look different: new rows, new anomalies, a new day or a change
+    between fresh and stale.
+    """
+    conn = federated_connection()
+    anomalies = dict(get_anomaly_counts(conn))
+    now = datetime.now(timezone.utc)
+    stale_before = now.timestamp() - STALE_AFTER_MINUTES * 60
+    return {
+        city: f"{last_epoch}:{rows_total}:{anomalies.get(city, 0)}:{now.date()}:{int(last_epoch < stale_before)}"
+        for city, last_epoch, rows_total in conn.execute(
+            "SELECT city, last_epoch, rows_total FROM last_ingest ORDER BY city"
+        )
+    }
+
+def render_dashboard(output=None, city=None):
+    """
+    Build the six-panel dashboard (for one city, or all of them). Shows it,
+    or saves it when output is a file path
+    """
+    # matplotlib is only imported when a dashboard is actually drawn
+    import matplotlib
+    if output:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # Make sure the ledger tables exist; every query below uses a read-only connection
+    ensure_schema(DB_PATH)
+
+    # Create dashboard
+    fig, ((ax1, ax2), (ax3, ax4), (ax5, ax6)) = plt.subplots(3, 2, figsize=(12, 10))
+    if city:
+        fig.suptitle(city, fontsize=14, fontweight='bold')
+
+    last_update = get_last_update(city)
+    ax1.text(0.5, 0.5, f"Last Update: {last_update}", 
+             ha='center', va='center', fontsize=12, fontweight='bold')
+    ax1.set_xlim(0, 1)
+    ax1.set_ylim(0, 1)
+    ax1.axis('off')
+
+    # Panel 2: Temperature Trend
+    trend_data = get_temperature_trend(city)
+    if trend_data:
+        dates = [row[0] for row in trend_data]
+        temps = [row[1] for row in trend_data]
+        ax2.plot(dates, temps, marker='o', linewidth=2)
+        ax2.set_title('Temperature Trend (5 Days)')
+        ax2.set_ylabel('Temperature (°C)')
+        ax2.tick_params(axis='x', rotation=45)
+
+    # Panel 3: Today's Summary
+    today_data = get_today_summary(city)
+    if today_data and today_data[0]:
+        min_temp, max_temp, readings = today_data
+        ax3.bar(['Min', 'Max'], [min_temp, max_temp], color=['lightblue', 'lightcoral'])
+        ax3.set_title(f"Today's Temperature ({readings} readings)")
+        ax3.set_ylabel('Temperature (°C)')
+
+        # Add padding above the highest bar
+        max_value = max(min_temp, max_temp)
+        padding = max_value * 0.15  # 15% padding above highest bar
+        ax3.set_ylim(0, max_value + padding)
+
+        # Position text labels with proper spacing
+        for i, v in enumerate([min_temp, max_temp]):
+            ax3.text(i, v + (padding * 0.3), f'{v:.1f}°C', ha='center', fontweight='bold')
+
+        # Add explanation when min = max (if needed)
+        if abs(min_temp - max_temp) < 0.01:
+            ax3.text(0.5, min_temp - (padding * 0.6), f"Same value: Only {readings} reading(s) collected today", 
+                    ha='center', fontsize=9, style='italic', color='gray')
+
+    # Panel 4: Data Freshness
+    is_fresh = check_data_freshness(city)
+    if is_fresh:
+        color = 'green'
+        status = 'FRESH'
+        symbol = '●'
+    else:
+        color = 'red'
+        status = 'STALE'
+        symbol = '●'
+
+    ax4.text(0.5, 0.6, f"{symbol} Data Status:\n{status}", 
+             ha='center', va='center', fontsize=12, fontweight='bold', color=color)
+    ax4.set_xlim(0, 1)
+    ax4.set_ylim(0, 1)
+    ax4.axis('off')
+
+    # Panel 5: Data Quality Report
+    quality_report = get_data_quality_report(city)
+    quality_text = (f"Data Quality Report:\n"
+                    f"Total Records: {quality_report['total_records']}\n"
+                    f"Missing Temp: {quality_report['missing_temp']}\n"
+                    f"Missing Humidity: {quality_report['missing_humidity']}\n"
+                    f"Outliers: {quality_report['outliers']}\n"
+                    f"Duplicates: {quality_report['duplicates']}")
+
+    ax5.text(0.5, 0.5, quality_text, ha='center', va='center', fontsize=11, 
+             bbox=dict(boxstyle="round,pad=0.5", facecolor="lightgray", alpha=0.8))
+    ax5.set_title("Data Quality")
+    ax5.set_xlim(0, 1)
+    ax5.set_ylim(0, 1)
+    ax5.axis('off')
+
+    # Panel 6: Overall Quality Status
+    total_issues = (quality_report['missing_temp'] + 
+                    quality_report['missing_humidity'] + 
+                    quality_report['outliers'] + 
+                    quality_report['duplicates'])
+
+    if total_issues == 0:
+        symbol = '●'
+        color = 'green'
+        message = f"{symbol} PERFECT\nDATA QUALITY"
+    else:
+        symbol = '●'
+        color = 'orange'
+        message = f"{symbol} {total_issues} ISSUES\nFOUND"
+
+    ax6.text(0.5, 0.6, message, 
+             ha='center', va='center', fontsize=12, fontweight='bold', color=color)
+    ax6.set_xlim(0, 1)
+    ax6.set_ylim(0, 1)
+    ax6.axis('off')
+    ax6.set_title("Overall Quality")
+
+    plt.tight_layout()
+    if output:
+        # Write then rename, so a reader never sees a half-written PNG
+        tmp_path = f"{output}.tmp"
+        fig.savefig(tmp_path, dpi=100, format="png")
+        os.replace(tmp_path, output)
+        plt.close(fig)
+        print(f"📊 Dashboard saved to {output}")
+    else:
+        plt.show()
+
+def render_overview(output, days=5, columns=4):
+    """Small multiples: one hourly temperature line per city, on a shared y axis"""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    trends = get_hourly_trends(days)
+    count = max(len(trends), 1)
+    columns = min(columns, count)
+    rows = -(-count // columns)
+    fig, axes = plt.subplots(rows, columns, figsize=(3.2 * columns, 2.4 * rows),
+                             sharey=True, squeeze=False)
+    for ax, (city, points) in zip(axes.flat, trends.items()):
+        temps = [temp for _, temp in points]
+        ax.plot(range(len(temps)), temps, linewidth=1.2, marker=".", markersize=3)
+        ax.set_title(f"{city} ({temps[-1]:.1f}°C)", fontsize=9)
+        ax.set_xticks([])
+        ax.tick_params(labelsize=7)
+    for ax in list(axes.flat)[len(trends):]:
+        ax.axis('off')
+    fig.suptitle(f"Hourly Temperature, Last {days} Days", fontweight='bold')
+
+    plt.tight_layout()
+    tmp_path = f"{output}.tmp"
+    fig.savefig(tmp_path, dpi=100, format="png")
+    os.replace(tmp_path, output)
+    plt.close(fig)
+
+
+def _slug(city):
+    return re.sub(r"[^a-z0-9]+", "-", city.lower()).strip("-") or "city"
+
+
+def _render_job(city, output):
+    """Process pool entry point: city None = the overview"""
+    import matplotlib
+    matplotlib.use("Agg")
+    if city is None:
+        render_overview(output)
+    else:
+        render_dashboard(output, city)
+    return city, output
+
+
+def _load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def render_all_dashboards(output_dir=DASHBOARD_DIR, workers=DASHBOARD_WORKERS, force=False):
+    """
+    Write <city>.png for every city with data plus the overview, redrawing
+    only artifacts whose data version changed. Returns (rendered, cached).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import multiprocessing
+
+    ensure_schema(DB_PATH)
+    # Warm the hot window before forking, so every worker inherits it
+    get_hot_window()
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = os.path.join(output_dir, MANIFEST_FILE)
+    manifest = {} if force else _load_manifest(manifest_path)
+
+    versions = city_data_versions()
+    artifacts = {city: (f"{_slug(city)}.png", version) for city, version in versions.items()}
+    overview_version = hashlib.sha1(json.dumps(versions, sort_keys=True).encode()).hexdigest()[:16]
+    artifacts[None] = (OVERVIEW_FILE, overview_version)
+
+    jobs = []
+    for city, (filename, version) in artifacts.items():
+        key = city if city is not None else ""
+        cached = manifest.get(key)
+        path = os.path.join(output_dir, filename)
+        if cached == {"file": filename, "version": version} and os.path.exists(path):
+            continue
+        jobs.append((city, path))
+
+    if jobs:
+        # fork: workers inherit settings and imports, and storage drops its pooled
+        # connections in the child, so each worker opens its own
+        context = multiprocessing.get_context("fork")
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), mp_context=context) as pool:
+            for city, path in pool.map(_render_job, *zip(*jobs)):
+                filename, version = artifacts[city]
+                manifest[city if city is not None else ""] = {"file": filename, "version": version}
+
+    # Forget cities that no longer have data
+    manifest = {key: entry for key, entry in manifest.items() if key == "" or key in versions}
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+    rendered = len(jobs)
+    print(f"📊 Dashboards in {output_dir}: {rendered} rendered, {len(artifacts) - rendered} cached")
+    return rendered, len(artifacts) - rendered
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "--all":
+        render_all_dashboards()
+    else:
+        render_dashboard(sys.argv[1] if len(sys.argv) > 1 else None)
+
+if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        from profiling import profile_run
+        with profile_run("dashboard"):
+            main()
+    else:
+        main()
@@ -0,0 +1,209 @@
+"""
+Star Schema: Dimension Tables
+Readings are stored in `weather_fact` with integer keys into two small
+dimension tables instead of repeating the city and condition strings:
+
+    dim_city       (id, name, lat, lon, utc_offset)
+    dim_condition  (id, name)
+    weather_fact   (id, timestamp, city_id, temp, humidity, condition_id)
+
+`weather_data` is a view that joins them back into the original five columns
+(plus `id`), with an INSTEAD OF INSERT/DELETE trigger, so existing queries
+and ad-hoc INSERTs keep working. The write path resolves names to ids through
+a process-wide cache, so a steady-state insert touches only weather_fact.
+"""
+
+import os
+import threading
+
+INSERT_WEATHER_FACT_SQL = """
+    INSERT INTO weather_fact (timestamp, city_id, temp, humidity, condition_id)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+_interners = {}
+_interners_lock = threading.Lock()
+
+
+def _create_star_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dim_city (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            lat REAL,
+            lon REAL,
+            utc_offset INTEGER          -- seconds east of UTC, as reported by the API
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dim_condition (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS weather_fact (
+            id INTEGER PRIMARY KEY,
+            timestamp TEXT,
+            city_id INTEGER REFERENCES dim_city (id),
+            temp REAL,
+            humidity INTEGER,
+            condition_id INTEGER REFERENCES dim_condition (id)
+        )
+    """)
+
+
+def _create_compatibility_view(conn):
+    conn.execute("""
+        CREATE VIEW IF NOT EXISTS weather_data AS
+        SELECT f.timestamp, c.name AS city, f.temp, f.humidity, d.name AS weather, f.id
+        FROM weather_fact f
+        LEFT JOIN dim_city c ON c.id = f.city_id
+        LEFT JOIN dim_condition d ON d.id = f.condition_id
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS weather_data_insert
+        INSTEAD OF INSERT ON weather_data
+        BEGIN
+            INSERT OR IGNORE INTO dim_city (name) SELECT NEW.city WHERE NEW.city IS NOT NULL;
+            INSERT OR IGNORE INTO dim_condition (name) SELECT NEW.weather WHERE NEW.weather IS NOT NULL;
+            INSERT INTO weather_fact (timestamp, city_id, temp, humidity, condition_id)
+            VALUES (NEW.timestamp,
+                    (SELECT id FROM dim_city WHERE name = NEW.city),
+                    NEW.temp, NEW.humidity,
+                    (SELECT id FROM dim_condition WHERE name = NEW.weather));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS weather_data_delete
+        INSTEAD OF DELETE ON weather_data
+        BEGIN
+            DELETE FROM weather_fact WHERE id = OLD.id;
+        END
+    """)
+
+
+def _migrate_legacy_table(conn):
+    """Move rows from a pre-star-schema weather_data table (keeping rowids as ids)"""
+    conn.execute("""
+        INSERT OR IGNORE INTO dim_city (name)
+        SELECT DISTINCT city FROM weather_data WHERE city IS NOT NULL
+    """)
+    conn.execute("""
+        INSERT OR IGNORE INTO dim_condition (name)
+        SELECT DISTINCT weather FROM weather_data WHERE weather IS NOT NULL
+    """)
+    conn.execute("""
+        INSERT INTO weather_fact (id, timestamp, city_id, temp, humidity, condition_id)
+        SELECT w.rowid, w.timestamp, c.id, w.temp, w.humidity, d.id
+        FROM weather_data w
+        LEFT JOIN dim_city c ON c.name = w.city
+        LEFT JOIN dim_condition d ON d.name = w.weather
+        ORDER BY w.rowid
+    """)
+    conn.execute("DROP TABLE weather_data")
+
+
+def ensure_star_schema(conn):
+    """Create the fact and dimension tables and the weather_data view, migrating old databases"""
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name = 'weather_data'").fetchone()
+    if kind == ("view",):
+        return False
+    legacy = kind == ("table",)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _create_star_tables(conn)
+        if legacy:
+            _migrate_legacy_table(conn)
+        _create_compatibility_view(conn)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_weather_fact_city_timestamp ON weather_fact (city_id, timestamp)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_weather_fact_timestamp ON weather_fact (timestamp)")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return legacy
+
+
+class Interner:
+    """
+    Name -> id cache for one database's dimension tables. Ids are never
+    reused, so entries stay valid for the life of the process.
+    """
+
+    def __init__(self):
+        self.ids = {"dim_city": {}, "dim_condition": {}}
+        self.city_details = {}
+        self.lock = threading.Lock()
+
+    def lookup(self, conn, table, name):
+        """
+        Id for name, inserting it on first sight. A miss commits its own small
+        transaction (so a rolled-back caller can't leave a cached id behind);
+        call it outside any open transaction.
+        """
+        if name is None:
+            return None
+        found = self.ids[table].get(name)
+        if found is not None:
+            return found
+        with self.lock:
+            with conn:
+                conn.execute(f"INSERT OR IGNORE INTO {table} (name) VALUES (?)", (name,))
+            found = conn.execute(f"SELECT id FROM {table} WHERE name = ?", (name,)).fetchone()[0]
+            self.ids[table][name] = found
+        return found
+
+    def fact_rows(self, conn, readings):
+        """[(timestamp, city, temp, humidity, weather), ...] -> rows for INSERT_WEATHER_FACT_SQL"""
+        return [
+            (timestamp, self.lookup(conn, "dim_city", city), temp, humidity,
+             self.lookup(conn, "dim_condition", weather))
+            for timestamp, city, temp, humidity, weather in readings
+        ]
+
+    def batch_fact_rows(self, conn, batch):
+        """
+        Rows for INSERT_WEATHER_FACT_SQL from a WeatherBatch. Ids are resolved
+        once per distinct city/condition up front (so no lookup runs inside the
+        caller's transaction); the rows themselves are generated lazily. Only
+        codes that occur in the batch are resolved: batches from take() share
+        their parent's name tables, which also list other databases' cities.
+        """
+        from weather_batch import NO_CODE, canonical_timestamp
+
+        city_ids = {code: self.lookup(conn, "dim_city", batch.cities[code])
+                    for code in set(batch.city_codes) if code != NO_CODE}
+        condition_ids = {code: self.lookup(conn, "dim_condition", batch.conditions[code])
+                         for code in set(batch.condition_codes) if code != NO_CODE}
+        return (
+            (canonical_timestamp(batch.epochs[i]),
+             None if city == NO_CODE else city_ids[city],
+             batch.temp(i), batch.humidity_at(i),
+             None if condition == NO_CODE else condition_ids[condition])
+            for i, (city, condition) in enumerate(zip(batch.city_codes, batch.condition_codes))
+        )
+
+    def set_city_details(self, conn, name, lat, lon, utc_offset):
+        """Store coordinates and UTC offset for a city (writes only when they change)"""
+        details = (lat, lon, utc_offset)
+        if self.city_details.get(name) == details:
+            return False
+        city_id = self.lookup(conn, "dim_city", name)
+        with conn:
+            conn.execute(
+                "UPDATE dim_city SET lat = ?, lon = ?, utc_offset = ? WHERE id = ?",
+                (lat, lon, utc_offset, city_id),
+            )
+        self.city_details[name] = details
+        return True
+
+
+def get_interner(db_name):
+    """The process-wide Interner for a database file"""
+    key = os.path.abspath(db_name)
+    interner = _interners.get(key)
+    if interner is None:
+        with _interners_lock:
+            interner = _interners.setdefault(key, Interner())
+    return interner
@@ -6,33 +6,55 @@ Runs automatically every 10 minutes via cron job
 
 import os
 import sys
+import time
 from datetime import datetime
 
-# Set absolute paths for cron execution
-BASE_PATH = "/usr/local/weather-etl"
-
-# Add current directory to Python path
-sys.path.insert(0, BASE_PATH)
-
-# Import application modules
+# Import application modules (requests is imported lazily in extract())
 from config import API_KEY, CITY
-import requests
 import csv
-import sqlite3
+from storage import ensure_schema, get_connection
+from dimensions import get_interner, INSERT_WEATHER_FACT_SQL
+from sketches import update_sketches
+from changes import notify_changes
+from sharding import city_db_path, database_paths, fan_out
+from weather_batch import FIELDS, WeatherBatch, as_batch, canonical_timestamp
+from run_ledger import start_run, finish_run, record_ingest, new_run_id, timestamp_to_epoch
+from rate_limiter import ApiRateLimiter, plan_requests
+from adaptive_polling import ensure_poll_state_table, observe, get_due_offsets
+from anomaly import ensure_anomaly_tables, observe as observe_anomaly
+from settings import (DB_PATH, CSV_PATH, CITIES, CITY_PRIORITIES,
+                      API_CALLS_PER_MINUTE, API_CALLS_PER_DAY, SCHEDULE_WINDOW_SECONDS,
+                      EXTRACT_WORKERS, STALE_AFTER_MINUTES,
+                      ADAPTIVE_POLLING, POLL_MIN_SECONDS, POLL_MAX_SECONDS,
+                      TEMP_MIN_POSSIBLE, TEMP_MAX_POSSIBLE, ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES)
 
 def log_message(message):
     """Add timestamp to all log messages"""
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] {message}")
 
-def extract():
-    """Fetch weather data from OpenWeather API"""
-    url = f"https://api.openweathermap.org/data/2.5/weather?q={CITY}&appid={API_KEY}&units=metric"
+def extract(city=CITY, limiter=None, endpoint="weather"):
+    """Fetch weather data from OpenWeather API ("weather" = current, "forecast" = 5 day / 3 hour)"""
+    url = f"https://api.openweathermap.org/data/2.5/{endpoint}?q={city}&appid={API_KEY}&units=metric"
+    
+    # Every worker goes through the same limiter so the quotas hold globally
+    if limiter is not None and not limiter.acquire(timeout=SCHEDULE_WINDOW_SECONDS):
+        log_message(f"⏳ Skipping {city}: API quota exhausted")
+        return None
+    
+    import requests
     
     try:
         response = requests.get(url, timeout=10)
         data = response.json()
         
+        if response.status_code == 429:
+            retry_after = int(response.headers.get("Retry-After", 60))
+            log_message(f"⏳ Rate limited by API, pausing all workers for {retry_after}s")
+            if limiter is not None:
+                limiter.backoff(retry_after)
+            return None
+        
         if response.status_code != 200:
             log_message(f"API ERROR: {data}")
             return None
@@ -44,28 +66,28 @@ def extract():
         log_message(f"❌ API call failed: {e}")
         return None
 
-def transform(data):
-    """Extract relevant fields from API response"""
-    return {
-        "timestamp": datetime.utcnow().replace(microsecond=0).isoformat() + "+00:00",
-        "city": data["name"],
-        "temp": data["main"]["temp"],
-        "humidity": data["main"]["humidity"],
-        "weather": data["weather"][0]["main"]
-    }
-
-def load_to_csv(data, filename=f"{BASE_PATH}/output/weather_data.csv"):
-    """Save data to CSV file"""
+def transform(data, batch=None):
+    """
+    Extract relevant fields from API response into a WeatherBatch (a new
+    one-row batch unless one is given). Returns the record's row view
+    """
+    batch = WeatherBatch() if batch is None else batch
+    index = batch.append(int(time.time()), data["name"], data["main"]["temp"],
+                         data["main"]["humidity"], data["weather"][0]["main"])
+    return batch[index]
+
+def load_to_csv(data, filename=CSV_PATH):
+    """Save a reading, record or WeatherBatch to the CSV file"""
     try:
         file_exists = os.path.isfile(filename) and os.path.getsize(filename) > 0
         
         with open(filename, mode="a", newline="") as file:
-            writer = csv.DictWriter(file, fieldnames=data.keys())
+            writer = csv.writer(file)
             
             if not file_exists:
-                writer.writeheader()
+                writer.writerow(FIELDS)
             
-            writer.writerow(data)
+            writer.writerows(as_batch(data).rows())
             
         log_message(f"✅ Data saved to CSV: {filename}")
         return True
@@ -74,78 +96,140 @@ def load_to_csv(data, filename=f"{BASE_PATH}/output/weather_data.csv"):
         log_message(f"❌ CSV save failed: {e}")
         return False
 
-def load_to_sqlite(data, db_name=f"{BASE_PATH}/output/weather.db"):
-    """Save data to SQLite database"""
-    try:
-        conn = sqlite3.connect(db_name)
-        cursor = conn.cursor()
-        
-        # Create table if not exists
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS weather_data (
-                timestamp TEXT,
-                city TEXT,
-                temp REAL,
-                humidity INTEGER,
-                weather TEXT
-            )
-        """)
+def insert_batch(db_name, batch, fence=None):
+    """
+    Insert a WeatherBatch into one database and update last_ingest in the same transaction.
+    fence(conn), if given, runs first inside that transaction and raises to abort the write
+    (lease workers check that they still own the city)
+    """
+    # Creates the tables, indexes and ledger on first use only
+    conn = ensure_schema(db_name)
+    
+    # City and condition ids come from the in-process cache after the first run
+    fact_rows = get_interner(db_name).batch_fact_rows(conn, batch)
+    
+    with conn:
+        if fence is not None:
+            fence(conn)
+        conn.executemany(INSERT_WEATHER_FACT_SQL, fact_rows)
         
-        # Insert the row
-        cursor.execute("""
-            INSERT INTO weather_data (timestamp, city, temp, humidity, weather)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            data["timestamp"],
-            data["city"],
-            data["temp"],
-            data["humidity"],
-            data["weather"]
-        ))
+        # Keep the per-city freshness rows in the same transaction
+        for city, rows, newest in batch.city_summary():
+            record_ingest(conn, city, canonical_timestamp(newest), rows=rows)
         
-        conn.commit()
-        conn.close()
+        # Percentile sketches for each (city, hour) the batch touches
+        update_sketches(conn, batch)
+    
+    # Wake change-feed listeners (no-op unless CHANGES_NOTIFY_DIR is set)
+    notify_changes(db_name)
+
+def load_to_sqlite(data, db_name=None, fence=None):
+    """
+    Save a reading, record or WeatherBatch to SQLite (each city's shard when
+    sharding is enabled and db_name is not given); fence as in insert_batch
+    """
+    try:
+        targets = as_batch(data).split_by_city(lambda city: db_name or city_db_path(city))
+        for target, batch in targets.items():
+            insert_batch(target, batch, fence)
         
-        log_message(f"✅ Data saved to SQLite: {db_name}")
+        log_message(f"✅ Data saved to SQLite: {', '.join(targets)}")
         return True
         
     except Exception as e:
         log_message(f"❌ SQLite save failed: {e}")
         return False
 
-def validate_data(data):
-    """
-    Validate weather data before saving
-    Returns: (is_valid, error_message)
-    """
+def load_city_details(raw_data, db_name=None):
+    """Keep dim_city's coordinates and UTC offset in line with the API response"""
+    db_name = db_name or city_db_path(raw_data["name"])
+    try:
+        conn = ensure_schema(db_name)
+        get_interner(db_name).set_city_details(conn, raw_data["name"], raw_data["coord"]["lat"],
+                                               raw_data["coord"]["lon"], raw_data.get("timezone"))
+    except Exception as e:
+        log_message(f"⚠️ Could not update city details: {e}")
+
+def check_reading(temp, humidity, weather):
+    """The first problem with a reading's values, or None if it is valid"""
     # Check required fields
-    required_fields = ['temp', 'humidity', 'weather']
-    for field in required_fields:
-        if field not in data or data[field] is None:
-            return False, f"Missing required field: {field}"
+    for field, value in (('temp', temp), ('humidity', humidity), ('weather', weather)):
+        if value is None:
+            return f"Missing required field: {field}"
     
-    # Check temperature range for validity
-    if not (-5 <= data['temp'] <= 50):
-        return False, f"Temperature {data['temp']}°C is outside reasonable range"
+    # Reject only impossible temperatures; unusual ones are scored by check_anomaly()
+    if not (TEMP_MIN_POSSIBLE <= temp <= TEMP_MAX_POSSIBLE):
+        return f"Temperature {temp}°C is physically implausible"
     
     # Check humidity range (0-100%)
-    if not (0 <= data['humidity'] <= 100):
-        return False, f"Humidity {data['humidity']}% is outside valid range"
+    if not (0 <= humidity <= 100):
+        return f"Humidity {humidity}% is outside valid range"
     
     # Check weather field is not empty
-    if not data['weather'] or data['weather'].strip() == '':
-        return False, "Weather condition is empty"
+    if not weather or weather.strip() == '':
+        return "Weather condition is empty"
     
+    return None
+
+def validate_data(data):
+    """
+    Validate weather data (a reading dict or record) before saving
+    Returns: (is_valid, error_message)
+    """
+    error = check_reading(data.get('temp'), data.get('humidity'), data.get('weather'))
+    if error:
+        return False, error
     return True, "Data is valid"
 
-def run_etl():
-    """Main ETL process with data quality validation"""
-    log_message("🚀 Starting Weather ETL (Production Mode)")
+def validate_batch(batch):
+    """
+    Validate every row of a WeatherBatch straight from its columns
+    Returns: (valid rows as a WeatherBatch, [(row index, error_message), ...])
+    """
+    rejected = []
+    valid = []
+    for i in range(len(batch)):
+        error = check_reading(batch.temp(i), batch.humidity_at(i), batch.condition(i))
+        if error:
+            rejected.append((i, error))
+        else:
+            valid.append(i)
+    if not rejected:
+        return batch, rejected
+    return batch.take(valid), rejected
+
+def open_run_ledger(city, db_name=DB_PATH, run_id=None):
+    """Start a ledger entry for this run. Returns (conn, ledger_id) or (None, None)"""
+    try:
+        conn = ensure_schema(db_name)
+        ledger_id, _ = start_run(conn, city, run_id)
+        return conn, ledger_id
+    except Exception as e:
+        log_message(f"⚠️ Run ledger unavailable: {e}")
+        return None, None
+
+def close_run_ledger(conn, ledger_id, status, rows_written=0, message=None):
+    """Record the outcome of this run in the ledger"""
+    if conn is None:
+        return
+    try:
+        finish_run(conn, ledger_id, status, rows_written, message)
+    except Exception as e:
+        log_message(f"⚠️ Could not update run ledger: {e}")
+
+def run_city_etl(city=CITY, limiter=None, run_id=None, fence=None):
+    """
+    ETL for a single city with data quality validation. With a fence (see
+    insert_batch) SQLite is written first and the CSV only after it succeeds,
+    so a worker that has lost its lease writes nothing
+    """
+    ledger_conn, ledger_id = open_run_ledger(city, run_id=run_id)
     
     # Extract
-    raw_data = extract()
+    raw_data = extract(city, limiter)
     if raw_data is None:
-        log_message("❌ ETL failed: No data extracted")
+        log_message(f"❌ ETL failed for {city}: No data extracted")
+        close_run_ledger(ledger_conn, ledger_id, "failed", message="No data extracted")
         return False
     
     # Transform
@@ -154,30 +238,150 @@ def run_etl():
         log_message(f"✅ Data transformed: {processed_data['temp']}°C, {processed_data['humidity']}% humidity")
     except Exception as e:
         log_message(f"❌ Transform failed: {e}")
+        close_run_ledger(ledger_conn, ledger_id, "failed", message=f"Transform failed: {e}")
         return False
     
+    # Learn this city's upstream cadence for the next scheduling window
+    if ADAPTIVE_POLLING:
+        update_poll_interval(city, raw_data, processed_data)
+    
 
     # Validate
     is_valid, error_message = validate_data(processed_data)
     if not is_valid:
         log_message(f"❌ Data validation failed: {error_message}")
         log_message("⚠️ Skipping this record to maintain data quality")
+        close_run_ledger(ledger_conn, ledger_id, "rejected", message=error_message)
         return False
     
     log_message("✅ Data validation passed")
     
     # Load
-    csv_success = load_to_csv(processed_data)
-    db_success = load_to_sqlite(processed_data)
+    if fence is None:
+        csv_success = load_to_csv(processed_data)
+        db_success = load_to_sqlite(processed_data)
+    else:
+        db_success = load_to_sqlite(processed_data, fence=fence)
+        csv_success = db_success and load_to_csv(processed_data)
+    
+    if db_success and "coord" in raw_data:
+        load_city_details(raw_data)
+    if db_success:
+        check_anomaly(processed_data)
     
     if csv_success and db_success:
         log_message("🎉 ETL completed successfully!")
+        close_run_ledger(ledger_conn, ledger_id, "success", rows_written=1)
         return True
     else:
         log_message("⚠️ ETL completed with some failures")
+        close_run_ledger(ledger_conn, ledger_id, "partial",
+                         rows_written=1 if db_success else 0,
+                         message=f"csv={'ok' if csv_success else 'failed'}, sqlite={'ok' if db_success else 'failed'}")
         return False
 
+def update_poll_interval(city, raw_data, processed_data, db_name=DB_PATH):
+    """Feed the upstream observation time (`dt`) into adaptive polling"""
+    if "dt" not in raw_data:
+        return
+    try:
+        conn = get_connection(db_name)
+        ensure_poll_state_table(conn)
+        changed, interval = observe(conn, city, raw_data["dt"], processed_data["temp"],
+                                    processed_data["humidity"], POLL_MIN_SECONDS, POLL_MAX_SECONDS)
+        if not changed:
+            log_message(f"🔁 {city}: upstream observation unchanged since last poll")
+        log_message(f"⏱️ {city}: next poll in {interval / 60:.1f} min")
+    except Exception as e:
+        log_message(f"⚠️ Could not update poll interval for {city}: {e}")
+
+def check_anomaly(data, db_name=DB_PATH):
+    """Score the reading against its city/hour statistics and log it if anomalous"""
+    try:
+        conn = get_connection(db_name)
+        ensure_anomaly_tables(conn)
+        z, robust_z, flagged = observe_anomaly(conn, data["city"], data["timestamp"],
+                                               timestamp_to_epoch(data["timestamp"]), data["temp"],
+                                               ANOMALY_Z_THRESHOLD, ANOMALY_MIN_SAMPLES)
+        if flagged:
+            log_message(f"🚨 {data['city']}: {data['temp']}°C is anomalous for this hour "
+                        f"(robust z={robust_z:.1f}, z={z:.1f})")
+    except Exception as e:
+        log_message(f"⚠️ Could not score reading for anomalies: {e}")
+
+def load_due_offsets(cities, window, db_name=DB_PATH):
+    """Cities due for polling within this window, from adaptive polling state"""
+    try:
+        conn = get_connection(db_name)
+        ensure_poll_state_table(conn)
+        return get_due_offsets(conn, cities, window)
+    except Exception as e:
+        log_message(f"⚠️ Could not read poll state, polling every city: {e}")
+        return None
+
+def load_last_epochs():
+    """Last ingest time per city, used to serve stale cities first"""
+    try:
+        ensure_schema(DB_PATH)
+        last_epochs = {}
+        # Newest wins: a city can also have a row in weather.db from before sharding
+        for rows in fan_out(lambda conn: conn.execute("SELECT city, last_epoch FROM last_ingest").fetchall(),
+                            database_paths()):
+            for city, epoch in rows:
+                last_epochs[city] = max(epoch, last_epochs.get(city, epoch))
+        return last_epochs
+    except Exception as e:
+        log_message(f"⚠️ Could not read last_ingest: {e}")
+        return {}
+
+def run_etl(cities=None, poll=None):
+    """
+    Main ETL process: every configured city, spread across the scheduling window.
+    poll(city, limiter, run_id) replaces run_city_etl (lease workers claim the city first)
+    """
+    log_message("🚀 Starting Weather ETL (Production Mode)")
+    cities = cities or CITIES
+    limiter = ApiRateLimiter(DB_PATH, API_CALLS_PER_MINUTE, API_CALLS_PER_DAY)
+    run_id = new_run_id()
+    
+    # Leave a minute of slack so this run finishes before the next cron tick
+    window = max(0, SCHEDULE_WINDOW_SECONDS - 60)
+    due_offsets = load_due_offsets(cities, window) if ADAPTIVE_POLLING else None
+    if due_offsets is None and len(cities) == 1:
+        window = 0
+    plan = plan_requests(cities, load_last_epochs(), CITY_PRIORITIES,
+                         window_seconds=window, stale_after_seconds=STALE_AFTER_MINUTES * 60,
+                         due_offsets=due_offsets)
+    if not plan:
+        log_message("💤 No city is due for polling in this window")
+        return True
+    start = time.monotonic()
+    
+    def worker(item):
+        offset, city = item
+        delay = offset - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+        return (poll or run_city_etl)(city, limiter, run_id)
+    
+    if len(plan) == 1:
+        results = [worker(plan[0])]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as pool:
+            results = list(pool.map(worker, plan))
+    
+    if len(plan) > 1:
+        log_message(f"📋 {sum(results)}/{len(results)} polls loaded successfully")
+    return all(results)
+
 if __name__ == "__main__":
-    success = run_etl()
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        from profiling import profile_run
+        with profile_run("run"):
+            success = run_etl()
+    else:
+        success = run_etl()
     # Exit with proper code for cron monitoring
     sys.exit(0 if success else 1) 
\ No newline at end of file
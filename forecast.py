@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Forecast Ingestion and Scoring
+Fetches the 5 day / 3 hour forecast (about 40 timesteps per call) for every
+city and bulk-loads it into `forecasts`, keyed by city, issue time and target
+time. Forecasts live in the same database as the city's observations.
+
+Scoring joins each forecast to the observation nearest its target time
+(within MATCH_TOLERANCE_S) with NumPy: one searchsorted over all cities at
+once, then per-city / per-lead-time error metrics from bincount. The result
+replaces `forecast_scores`.
+"""
+
+import sys
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+
+from retention import EPOCH_SQL
+from settings import CITIES, DB_PATH, API_CALLS_PER_MINUTE, API_CALLS_PER_DAY
+from sharding import city_db_path, database_paths
+from storage import ensure_schema, get_connection, table_exists
+
+# An observation counts as the actual for a target time if it is this close
+MATCH_TOLERANCE_S = 1800
+
+# Lead times are reported in buckets of this many hours (the API's step)
+LEAD_BUCKET_HOURS = 3
+
+
+def log_message(message):
+    """Add timestamp to all log messages"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {message}")
+
+
+def ensure_forecast_tables(conn):
+    """Create the forecasts and forecast_scores tables"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS forecasts (
+            city TEXT NOT NULL,
+            issued_epoch INTEGER NOT NULL,
+            target_epoch INTEGER NOT NULL,
+            temp REAL,
+            humidity INTEGER,
+            weather TEXT,
+            PRIMARY KEY (city, issued_epoch, target_epoch)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS forecast_scores (
+            city TEXT NOT NULL,
+            lead_hours INTEGER NOT NULL,
+            matched INTEGER NOT NULL,
+            temp_mae REAL,
+            temp_rmse REAL,
+            temp_bias REAL,
+            humidity_mae REAL,
+            scored_at TEXT NOT NULL,
+            PRIMARY KEY (city, lead_hours)
+        )
+    """)
+    conn.commit()
+
+
+def transform_forecast(data, issued_epoch):
+    """Forecast API response -> [(city, issued, target, temp, humidity, weather), ...]"""
+    city = data["city"]["name"]
+    return [
+        (city, issued_epoch, step["dt"], step["main"]["temp"], step["main"]["humidity"],
+         step["weather"][0]["main"] if step.get("weather") else None)
+        for step in data["list"]
+    ]
+
+
+def load_forecasts(rows, db_name=None):
+    """Bulk-load forecast rows in one transaction (re-fetches of the same issue overwrite)"""
+    if not rows:
+        return 0
+    db_name = db_name or city_db_path(rows[0][0])
+    conn = ensure_schema(db_name)
+    ensure_forecast_tables(conn)
+    with conn:
+        conn.executemany("""
+            INSERT INTO forecasts (city, issued_epoch, target_epoch, temp, humidity, weather)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (city, issued_epoch, target_epoch) DO UPDATE SET
+                temp = excluded.temp,
+                humidity = excluded.humidity,
+                weather = excluded.weather
+        """, rows)
+    return len(rows)
+
+
+def run_forecast_etl(cities=None):
+    """Fetch and load the forecast for each city. Returns True if every city loaded"""
+    from etl_production import extract
+    from rate_limiter import ApiRateLimiter
+
+    limiter = ApiRateLimiter(DB_PATH, API_CALLS_PER_MINUTE, API_CALLS_PER_DAY)
+    ok = True
+    for city in cities or CITIES:
+        issued = int(time.time())
+        data = extract(city, limiter, endpoint="forecast")
+        if data is None:
+            ok = False
+            continue
+        try:
+            count = load_forecasts(transform_forecast(data, issued))
+            log_message(f"🔮 {city}: loaded {count} forecast steps")
+        except Exception as e:
+            log_message(f"❌ Forecast load failed for {city}: {e}")
+            ok = False
+    return ok
+
+
+def _fetch_arrays(conn):
+    """Forecasts and observations of one database as NumPy arrays"""
+    forecasts = conn.execute("""
+        SELECT city, issued_epoch, target_epoch, temp, humidity FROM forecasts
+        WHERE temp IS NOT NULL
+    """).fetchall()
+    observed = conn.execute(f"""
+        SELECT city, {EPOCH_SQL}, temp, humidity FROM weather_data
+        WHERE city IS NOT NULL AND timestamp IS NOT NULL AND temp IS NOT NULL
+    """).fetchall()
+    f_city, f_issued, f_target, f_temp, f_hum = (list(col) for col in zip(*forecasts)) if forecasts else ([],) * 5
+    o_city, o_epoch, o_temp, o_hum = (list(col) for col in zip(*observed)) if observed else ([],) * 4
+    return (
+        (f_city, np.array(f_issued, dtype=np.int64), np.array(f_target, dtype=np.int64),
+         np.array(f_temp, dtype=float), np.array([np.nan if h is None else h for h in f_hum], dtype=float)),
+        (o_city, np.array(o_epoch, dtype=np.int64), np.array(o_temp, dtype=float),
+         np.array([np.nan if h is None else h for h in o_hum], dtype=float)),
+    )
+
+
+def score_arrays(forecasts, observed, tolerance=MATCH_TOLERANCE_S):
+    """
+    Match every forecast to the nearest observation of the same city and
+    aggregate errors per (city, lead bucket). Returns
+    [(city, lead_hours, matched, temp_mae, temp_rmse, temp_bias, humidity_mae), ...].
+    """
+    f_city, f_issued, f_target, f_temp, f_hum = forecasts
+    o_city, o_epoch, o_temp, o_hum = observed
+    if len(f_target) == 0 or len(o_epoch) == 0:
+        return []
+
+    # One sorted key space for all cities: city index in the high bits, epoch in the low bits
+    names, codes = np.unique(np.array(list(f_city) + list(o_city), dtype=object).astype(str),
+                             return_inverse=True)
+    f_code, o_code = codes[:len(f_city)].astype(np.int64), codes[len(f_city):].astype(np.int64)
+    o_key = (o_code << 40) + o_epoch
+    order = np.argsort(o_key, kind="stable")
+    o_key, o_temp, o_hum = o_key[order], o_temp[order], o_hum[order]
+    f_key = (f_code << 40) + f_target
+
+    # Nearest observation: compare the neighbours on both sides of the insertion point
+    right = np.clip(np.searchsorted(o_key, f_key), 0, len(o_key) - 1)
+    left = np.clip(right - 1, 0, len(o_key) - 1)
+    pick = np.where(np.abs(o_key[left] - f_key) <= np.abs(o_key[right] - f_key), left, right)
+    matched = np.abs(o_key[pick] - f_key) <= tolerance   # also rules out other cities' keys
+
+    lead = (f_target - f_issued) // 3600
+    bucket = np.maximum(lead, 0) // LEAD_BUCKET_HOURS * LEAD_BUCKET_HOURS
+    temp_err = (f_temp - o_temp[pick])[matched]
+    hum_err = (f_hum - o_hum[pick])[matched]
+    groups, group_idx = np.unique(np.stack([f_code[matched], bucket[matched]], axis=1),
+                                  axis=0, return_inverse=True)
+    if len(groups) == 0:
+        return []
+    group_idx = group_idx.reshape(-1)
+    count = np.bincount(group_idx)
+    hum_ok = ~np.isnan(hum_err)
+    hum_count = np.bincount(group_idx, weights=hum_ok)
+    mae = np.bincount(group_idx, weights=np.abs(temp_err)) / count
+    rmse = np.sqrt(np.bincount(group_idx, weights=temp_err ** 2) / count)
+    bias = np.bincount(group_idx, weights=temp_err) / count
+    hum_mae = np.bincount(group_idx, weights=np.where(hum_ok, np.abs(hum_err), 0)) / np.maximum(hum_count, 1)
+    return [
+        (str(names[code]), int(lead_hours), int(n), float(m), float(r), float(b),
+         float(h) if hc else None)
+        for (code, lead_hours), n, m, r, b, h, hc in zip(groups, count, mae, rmse, bias, hum_mae, hum_count)
+    ]
+
+
+def score_forecasts():
+    """Score forecasts in weather.db and every shard and store the result in forecast_scores"""
+    scored_at = datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+    results = []
+    for db_name in database_paths():
+        conn = ensure_schema(db_name)
+        if not table_exists(conn, "forecasts"):
+            continue
+        scores = score_arrays(*_fetch_arrays(get_connection(db_name, readonly=True)))
+        with conn:
+            conn.execute("DELETE FROM forecast_scores")
+            conn.executemany("""
+                INSERT INTO forecast_scores (city, lead_hours, matched, temp_mae, temp_rmse,
+                                             temp_bias, humidity_mae, scored_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, [score + (scored_at,) for score in scores])
+        results.extend(scores)
+    return results
+
+
+def print_scores(scores):
+    print("=== FORECAST ACCURACY (temp, °C) ===")
+    if not scores:
+        print("   No forecasts with matching observations yet")
+    for city, lead_hours, matched, mae, rmse, bias, hum_mae in sorted(scores):
+        print(f"   {city} +{lead_hours:>3}h: MAE {mae:.2f}, RMSE {rmse:.2f}, bias {bias:+.2f} "
+              f"({matched} matched)")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "score":
+        print_scores(score_forecasts())
+    else:
+        sys.exit(0 if run_forecast_etl() else 1)
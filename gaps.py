@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+"""
+Gap Detection and Refill Planning
+A failed cron run leaves a hole in a city's series. detect_gaps() finds them
+with LAG() over each city's readings, walking the (city_id, timestamp)
+index, and records every interval longer than GAP_THRESHOLD_SECONDS in
+`data_gaps`. It is incremental: `gap_watermark` remembers the newest reading
+checked per city, and the next run starts from there.
+
+plan_refill() decides how each open gap can be filled:
+- "csv": the CSV has readings inside the gap (the SQLite write failed but
+  the CSV write didn't), so they are replayed in one bulk load
+- "api": the gap runs up to now, so polling the city fills it (the current
+  weather endpoint has no history); limited to GAP_REFILL_MAX_CALLS calls
+  and taken from the shared API quota
+- "none": nothing can fill it; marked unrecoverable after a refill
+
+Only raw readings are scanned, so the first run covers RETENTION_RAW_DAYS.
+Bookkeeping lives in weather.db next to the run ledger.
+"""
+
+import bisect
+import sys
+import time
+from datetime import datetime
+
+from retention import EPOCH_SQL
+from settings import (CITIES, CSV_PATH, DB_PATH, GAP_THRESHOLD_SECONDS, GAP_REFILL_MAX_CALLS,
+                      API_CALLS_PER_MINUTE, API_CALLS_PER_DAY)
+from sharding import database_paths
+from storage import ensure_schema, get_connection
+from weather_batch import WeatherBatch, canonical_timestamp
+
+
+def log_message(message):
+    """Add timestamp to all log messages"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {message}")
+
+
+def ensure_gap_tables(conn):
+    """Create the gap_watermark and data_gaps tables"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS gap_watermark (
+            city TEXT PRIMARY KEY,
+            checked_epoch INTEGER NOT NULL,
+            updated_at INTEGER NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS data_gaps (
+            city TEXT NOT NULL,
+            gap_start INTEGER NOT NULL,     -- epoch of the reading before the gap
+            gap_end INTEGER NOT NULL,       -- epoch of the reading after it
+            status TEXT NOT NULL DEFAULT 'open',   -- open / refilled / unrecoverable
+            refilled_rows INTEGER NOT NULL DEFAULT 0,
+            detected_at INTEGER NOT NULL,
+            PRIMARY KEY (city, gap_start)
+        )
+    """)
+    conn.commit()
+
+
+def find_gaps(conn, city, since_epoch=None, threshold=GAP_THRESHOLD_SECONDS):
+    """
+    Gaps in one city's readings in one database, from the reading at
+    since_epoch onwards. Returns ([(gap_start, gap_end), ...], newest_epoch)
+    """
+    # The watermark reading itself is included, so a gap right after it is found
+    since = canonical_timestamp(since_epoch)[:19] if since_epoch is not None else ""
+    rows = conn.execute(f"""
+        SELECT prev_epoch, epoch, newest FROM (
+            SELECT {EPOCH_SQL} AS epoch,
+                   LAG({EPOCH_SQL}) OVER (ORDER BY f.timestamp) AS prev_epoch,
+                   MAX({EPOCH_SQL}) OVER () AS newest
+            FROM weather_fact f
+            WHERE f.city_id = (SELECT id FROM dim_city WHERE name = ?) AND f.timestamp >= ?
+        )
+        WHERE epoch - prev_epoch > ? OR prev_epoch IS NULL
+    """, (city, since, threshold)).fetchall()
+    newest = rows[0][2] if rows else None
+    return [(prev, epoch) for prev, epoch, _ in rows if prev is not None], newest
+
+
+def detect_gaps(threshold=GAP_THRESHOLD_SECONDS, now=None):
+    """Scan every database from each city's watermark and record new gaps. Returns the new gaps"""
+    now = int(time.time() if now is None else now)
+    state = ensure_schema(DB_PATH)
+    ensure_gap_tables(state)
+    watermarks = dict(state.execute("SELECT city, checked_epoch FROM gap_watermark"))
+
+    found = []
+    newest_by_city = {}
+    for db_name in database_paths():
+        conn = get_connection(db_name, readonly=True)
+        for (city,) in conn.execute("SELECT name FROM dim_city").fetchall():
+            gaps, newest = find_gaps(conn, city, watermarks.get(city), threshold=threshold)
+            found.extend((city, start, end) for start, end in gaps)
+            if newest is not None:
+                newest_by_city[city] = max(newest, newest_by_city.get(city, newest))
+
+    with state:
+        state.executemany("""
+            INSERT OR IGNORE INTO data_gaps (city, gap_start, gap_end, detected_at) VALUES (?, ?, ?, ?)
+        """, [(city, start, end, now) for city, start, end in found])
+        state.executemany("""
+            INSERT INTO gap_watermark (city, checked_epoch, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(city) DO UPDATE SET
+                checked_epoch = MAX(checked_epoch, excluded.checked_epoch),
+                updated_at = excluded.updated_at
+        """, [(city, newest, now) for city, newest in newest_by_city.items()])
+    return found
+
+
+def _csv_rows_in_gaps(gaps, csv_path):
+    """Yield CSV rows (epoch, city, temp, humidity, weather) that fall strictly inside a gap"""
+    from backfill import read_csv_rows
+
+    by_city = {}
+    for city, start, end in sorted(gaps):
+        by_city.setdefault(city, ([], []))
+        by_city[city][0].append(start)
+        by_city[city][1].append(end)
+    for row in read_csv_rows(csv_path):
+        spans = by_city.get(row[1])
+        if spans is None:
+            continue
+        i = bisect.bisect_left(spans[0], row[0]) - 1
+        if i >= 0 and spans[0][i] < row[0] < spans[1][i]:
+            yield row, (row[1], spans[0][i])
+
+
+def plan_refill(csv_path=CSV_PATH, threshold=GAP_THRESHOLD_SECONDS, now=None):
+    """
+    Refill plan for every open gap plus cities whose series stops before now:
+    [(city, gap_start, gap_end, source, csv_rows), ...], api items last
+    """
+    from sharding import federated_connection
+
+    now = int(time.time() if now is None else now)
+    state = ensure_schema(DB_PATH)
+    ensure_gap_tables(state)
+    gaps = state.execute("SELECT city, gap_start, gap_end FROM data_gaps WHERE status = 'open'").fetchall()
+
+    csv_counts = {}
+    for _, key in _csv_rows_in_gaps(gaps, csv_path):
+        csv_counts[key] = csv_counts.get(key, 0) + 1
+    plan = [(city, start, end, "csv" if csv_counts.get((city, start)) else "none",
+             csv_counts.get((city, start), 0)) for city, start, end in gaps]
+
+    # A series that stops before now is a gap still in progress: only a poll fills it
+    for city, last_epoch in federated_connection().execute("SELECT city, last_epoch FROM last_ingest"):
+        if city in CITIES and now - last_epoch > threshold:
+            plan.append((city, last_epoch, now, "api", 0))
+    return sorted(plan, key=lambda item: (item[3] == "api", item[0], item[1]))
+
+
+def refill(plan, csv_path=CSV_PATH, max_calls=GAP_REFILL_MAX_CALLS):
+    """Carry out a refill plan. Returns (rows replayed from the CSV, cities polled)"""
+    from etl_production import load_to_sqlite, run_city_etl
+    from rate_limiter import ApiRateLimiter
+
+    state = ensure_schema(DB_PATH)
+    replay = [(city, start, end) for city, start, end, source, _ in plan if source == "csv"]
+    batch = WeatherBatch()
+    replayed = {}
+    for row, key in _csv_rows_in_gaps(replay, csv_path):
+        batch.append(*row)
+        replayed[key] = replayed.get(key, 0) + 1
+    # If the load fails the csv gaps stay open for the next run
+    settled = ("csv", "none") if not len(batch) or load_to_sqlite(batch) else ("none",)
+    with state:
+        state.executemany("""
+            UPDATE data_gaps SET status = ?, refilled_rows = refilled_rows + ? WHERE city = ? AND gap_start = ?
+        """, [("refilled" if replayed.get((city, start)) else "unrecoverable",
+               replayed.get((city, start), 0), city, start)
+              for city, start, end, source, _ in plan if source in settled])
+
+    # Open-ended gaps: poll now, through the same limiter and daily quota as the ETL
+    polled = 0
+    cities = [city for city, _, _, source, _ in plan if source == "api"][:max_calls]
+    if cities:
+        limiter = ApiRateLimiter(DB_PATH, API_CALLS_PER_MINUTE, API_CALLS_PER_DAY)
+        polled = sum(run_city_etl(city, limiter) for city in cities)
+    return len(batch), polled
+
+
+def print_plan(plan):
+    print("=== GAP REFILL PLAN ===")
+    if not plan:
+        print("   No gaps")
+    for city, start, end, source, csv_rows in plan:
+        span = (end - start) / 3600
+        detail = {"csv": f"replay {csv_rows} CSV rows", "api": "poll now",
+                  "none": "no source (will be marked unrecoverable)"}[source]
+        print(f"   {city} {canonical_timestamp(start)} -> {canonical_timestamp(end)} "
+              f"({span:.1f}h): {detail}")
+
+
+def main():
+    new_gaps = detect_gaps()
+    log_message(f"🕳️ {len(new_gaps)} new gap(s) found")
+    plan = plan_refill()
+    print_plan(plan)
+    if len(sys.argv) > 1 and sys.argv[1] == "--refill":
+        rows, polled = refill(plan)
+        log_message(f"🔧 Replayed {rows} CSV rows, polled {polled} cities")
+
+
+if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        from profiling import profile_run
+        with profile_run("gaps"):
+            main()
+    else:
+        main()
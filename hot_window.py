@@ -0,0 +1,285 @@
+"""
+Hot Window of Recent Readings
+Almost every dashboard query (today's summary, the 5-day trend, freshness)
+only looks at the last few days, yet each one went back to disk. The daemon
+and the query API keep those days in memory instead: one ring of compact
+arrays per city (epoch, temp, humidity, condition code; about 24 bytes a
+reading), holding the last HOT_WINDOW_DAYS days (from midnight UTC) in time
+order.
+
+The window is warmed from every database at startup and then kept current
+from the change log (see changes.py): refresh() applies the inserts after
+its cursor and trims readings that fell out of the window. An update or
+delete inside the window reloads that one city from every database, and a
+cursor that retention has pruned triggers a full reload, so the window always
+matches SQLite.
+"""
+
+import bisect
+import math
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+
+from changes import changes_since, latest_seq
+from retention import EPOCH_SQL
+from run_ledger import timestamp_to_epoch
+from settings import CITIES, DB_PATH, HOT_WINDOW_DAYS, STALE_AFTER_MINUTES
+from sharding import database_paths
+from storage import get_connection
+from weather_batch import canonical_timestamp
+
+HUMIDITY_MISSING = -2 ** 31
+NO_CODE = -1
+
+_windows = {}
+_windows_lock = threading.Lock()
+
+
+def _date(epoch):
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%d")
+
+
+class CityRing:
+    """One city's recent readings, oldest first. Trimming only moves `start`; the dead prefix is dropped in bulk"""
+
+    __slots__ = ("epochs", "temps", "humidity", "conditions", "start")
+
+    def __init__(self):
+        self.epochs = array("q")
+        self.temps = array("d")
+        self.humidity = array("i")
+        self.conditions = array("i")
+        self.start = 0
+
+    def __len__(self):
+        return len(self.epochs) - self.start
+
+    def add(self, epoch, temp, humidity, condition):
+        index = len(self.epochs)
+        if index > self.start and epoch < self.epochs[-1]:
+            # Late reading (backfill, gap refill): keep the time order
+            index = bisect.bisect_right(self.epochs, epoch, self.start)
+        self.epochs.insert(index, epoch)
+        self.temps.insert(index, math.nan if temp is None else temp)
+        self.humidity.insert(index, HUMIDITY_MISSING if humidity is None else humidity)
+        self.conditions.insert(index, condition)
+
+    def trim(self, cutoff_epoch):
+        self.start = bisect.bisect_left(self.epochs, cutoff_epoch, self.start)
+        if self.start > len(self.epochs) // 2:
+            for column in (self.epochs, self.temps, self.humidity, self.conditions):
+                del column[:self.start]
+            self.start = 0
+
+    def since(self, epoch):
+        """Index of the first reading at or after epoch"""
+        return bisect.bisect_left(self.epochs, epoch, self.start)
+
+
+class HotWindow:
+    """Recent readings of every city, in memory; see the module docstring"""
+
+    def __init__(self, db_name=DB_PATH, days=HOT_WINDOW_DAYS):
+        self.db_name = db_name
+        self.days = days
+        self.rings = {}
+        self.conditions, self._condition_index = [], {}
+        self.cursors = {}           # database path -> last change_log seq applied
+        self.synced_version = None
+        self.synced_cutoff = None
+        self.lock = threading.Lock()
+
+    def _paths(self):
+        return [self.db_name] + database_paths()[1:]
+
+    def _condition_code(self, name):
+        if name is None:
+            return NO_CODE
+        code = self._condition_index.get(name)
+        if code is None:
+            code = self._condition_index[name] = len(self.conditions)
+            self.conditions.append(name)
+        return code
+
+    def _cutoff(self, now=None):
+        # Whole UTC days, so the oldest day's summary isn't cut off partway
+        return (int(time.time() if now is None else now) - self.days * 86400) // 86400 * 86400
+
+    def _load(self, conn, cutoff, city=None):
+        """Add the window's readings from one database (or one city in it)"""
+        for epoch, name, temp, humidity, weather in conn.execute(f"""
+            SELECT {EPOCH_SQL}, city, temp, humidity, weather FROM weather_data
+            WHERE timestamp >= ? AND city IS NOT NULL {"AND city = ?" if city else ""}
+            ORDER BY timestamp
+        """, (canonical_timestamp(cutoff)[:19],) + ((city,) if city else ())):
+            if epoch is not None and epoch >= cutoff:
+                self.rings.setdefault(name, CityRing()).add(epoch, temp, humidity, self._condition_code(weather))
+
+    def _catch_up(self, path, conn, cutoff):
+        """
+        Apply one database's inserts after its cursor. Returns the cities an
+        update or delete touched: the caller reloads those from every database,
+        since a city can have rows in more than one (weather.db and its shard)
+        """
+        if path not in self.cursors:
+            self.cursors[path] = latest_seq(conn)
+            self._load(conn, cutoff)
+            return set()
+        seq, reload = self.cursors[path], set()
+        while True:
+            page = changes_since(seq, db_name=path)
+            if not page:
+                break
+            for change in page:
+                epoch = timestamp_to_epoch(change["timestamp"]) if change["timestamp"] else None
+                if epoch is None or epoch < cutoff or change["city"] is None:
+                    continue
+                if change["op"] == "I":
+                    self.rings.setdefault(change["city"], CityRing()).add(
+                        epoch, change["temp"], change["humidity"], self._condition_code(change["weather"]))
+                else:
+                    reload.add(change["city"])
+            seq = page[-1]["seq"]
+        self.cursors[path] = seq
+        return reload
+
+    def _catch_up_all(self, cutoff):
+        """
+        Catch up every database, each inside its own read transaction held
+        until the reloads are done, so a reloaded city is read at the same
+        snapshots as the logs (nothing is applied twice or missed)
+        """
+        conns = []
+        try:
+            for path in self._paths():
+                conn = get_connection(path, readonly=True)
+                conn.execute("BEGIN")
+                conns.append((path, conn))
+            reload = set()
+            for path, conn in conns:
+                reload |= self._catch_up(path, conn, cutoff)
+            for city in reload:
+                self.rings.pop(city, None)
+                for _, conn in conns:
+                    self._load(conn, cutoff, city)
+        finally:
+            for _, conn in conns:
+                conn.commit()
+
+    def warm(self, now=None):
+        """(Re)load the whole window from every database"""
+        with self.lock:
+            self.rings, self.cursors = {}, {}
+            self._catch_up_all(self._cutoff(now))
+
+    def refresh(self, now=None):
+        """Apply changes committed since the last refresh and drop readings that left the window"""
+        cutoff = self._cutoff(now)
+        try:
+            with self.lock:
+                self._catch_up_all(cutoff)
+                for city, ring in list(self.rings.items()):
+                    ring.trim(cutoff)
+                    if not len(ring):
+                        del self.rings[city]
+        except ValueError:
+            # Retention pruned the log past a cursor: start over from the tables
+            self.warm(now)
+
+    def sync(self, version, now=None):
+        """
+        refresh() once per data version (the query API's DataVersion token),
+        and again when midnight moves the window on, even if nothing was written
+        """
+        cutoff = self._cutoff(now)
+        if version != self.synced_version or cutoff != self.synced_cutoff:
+            self.refresh(now)
+            self.synced_version, self.synced_cutoff = version, cutoff
+
+    def _rings(self, city):
+        if city is None:
+            return sorted(self.rings.items())
+        return [(city, self.rings[city])] if city in self.rings else []
+
+    # --- queries ----------------------------------------------------------
+
+    def latest(self, city=None):
+        """[(city, epoch, temp, humidity, weather), ...] newest reading per city in the window"""
+        with self.lock:
+            rows = []
+            for name, ring in self._rings(city):
+                i = len(ring.epochs) - 1
+                condition = ring.conditions[i]
+                rows.append((name, ring.epochs[i], None if ring.temps[i] != ring.temps[i] else ring.temps[i],
+                             None if ring.humidity[i] == HUMIDITY_MISSING else ring.humidity[i],
+                             None if condition == NO_CODE else self.conditions[condition]))
+            return rows
+
+    def today_summary(self, city=None, now=None):
+        """(min temp, max temp, readings) for the current UTC day, like dashboard.get_today_summary"""
+        now = int(time.time() if now is None else now)
+        midnight = now // 86400 * 86400
+        low, high, readings = None, None, 0
+        with self.lock:
+            for _, ring in self._rings(city):
+                start, end = ring.since(midnight), ring.since(midnight + 86400)
+                temps = [t for t in ring.temps[start:end] if t == t]
+                readings += end - start
+                if temps:
+                    low = min(temps) if low is None else min(low, min(temps))
+                    high = max(temps) if high is None else max(high, max(temps))
+        return low, high, readings
+
+    def daily_trend(self, city=None, days=5, now=None):
+        """[(date, avg temp), ...] for the days touching the last `days` days, like dashboard.get_temperature_trend"""
+        if days > self.days:
+            raise ValueError(f"The hot window holds {self.days} days; ask the database for more")
+        start_epoch = (int(time.time() if now is None else now) - days * 86400) // 86400 * 86400
+        sums = {}
+        with self.lock:
+            for _, ring in self._rings(city):
+                # One slice per day: the sums run in C instead of per reading
+                start = ring.since(start_epoch)
+                while start < len(ring.epochs):
+                    day = ring.epochs[start] // 86400
+                    end = ring.since((day + 1) * 86400)
+                    temps = [t for t in ring.temps[start:end] if t == t]
+                    total = sums.setdefault(day, [0.0, 0])
+                    total[0] += sum(temps)
+                    total[1] += len(temps)
+                    start = end
+        return [(_date(day * 86400), total / count if count else None)
+                for day, (total, count) in sorted(sums.items())]
+
+    def freshness(self, cities=None, now=None, stale_after_minutes=STALE_AFTER_MINUTES):
+        """[(city, minutes since last reading or None, stale), ...] for the configured cities"""
+        now = time.time() if now is None else now
+        with self.lock:
+            last = {name: ring.epochs[-1] for name, ring in self.rings.items()}
+        rows = []
+        for city in cities or CITIES:
+            age = (now - last[city]) / 60 if city in last else None
+            rows.append((city, age, age is None or age > stale_after_minutes))
+        return rows
+
+    def stats(self):
+        """(cities, readings, approximate bytes held)"""
+        with self.lock:
+            readings = sum(len(ring) for ring in self.rings.values())
+            held = sum(len(ring.epochs) for ring in self.rings.values())
+            return len(self.rings), readings, held * 24
+
+
+def get_hot_window(db_name=DB_PATH):
+    """The process-wide HotWindow for a database (warmed on first use)"""
+    window = _windows.get(db_name)
+    if window is None:
+        with _windows_lock:
+            window = _windows.get(db_name)
+            if window is None:
+                window = HotWindow(db_name)
+                window.warm()
+                _windows[db_name] = window
+    return window
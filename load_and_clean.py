@@ -1,41 +1,88 @@
-import pandas as pd
-import sqlite3
-from datetime import datetime, timedelta   
+import io
+import os
+import sys
+from datetime import datetime, timedelta
 
-# Step 1: Load CSV
-df = pd.read_csv("output/weather_data.csv")  # Make sure the file exists in the same folder
+from settings import CSV_PATH, DB_PATH, OUTPUT_DIR
+from storage import get_connection, table_exists
 
-# Step 2: Preview the data
-print("Before cleaning:")
-print(df.head())
+CLEANED_CSV_PATH = os.path.join(OUTPUT_DIR, "weather_cleaned.csv")
 
-# Step 3: Drop completely empty rows
-df = df.dropna(how="all")
+def ensure_clean_cursor(conn):
+    """Byte offset into each raw CSV up to which rows are already cleaned"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS clean_cursor (
+            source TEXT PRIMARY KEY,
+            offset INTEGER NOT NULL
+        )
+    """)
+    conn.commit()
+
+def clean_data(input_csv=CSV_PATH, output_csv=CLEANED_CSV_PATH, db_name=DB_PATH, full=False):
+    """
+    Clean the rows appended to the raw CSV since the last run and add them to
+    weather_data_clean. The ETL only ever appends to the CSV, so a stored
+    offset is a cursor into it; without one (or when the file shrank, or
+    with full=True) everything is cleaned again and the table replaced
+    """
+    # Imported here so `weather-etl run` never pays for pandas
+    import pandas as pd
+
+    conn = get_connection(db_name)
+    ensure_clean_cursor(conn)
+    source = os.path.abspath(input_csv)
+    row = conn.execute("SELECT offset FROM clean_cursor WHERE source = ?", (source,)).fetchone()
+    offset = row[0] if row else 0
+    if full or offset > os.path.getsize(input_csv) or not table_exists(conn, "weather_data_clean") \
+            or not os.path.exists(output_csv):
+        offset = 0
+        # Forget the cursor first: a crash during the rebuild must not leave an offset behind
+        with conn:
+            conn.execute("DELETE FROM clean_cursor WHERE source = ?", (source,))
+
+    # Step 1: Load the CSV rows after the cursor (whole lines only; the ETL may be mid-append)
+    with open(input_csv, "rb") as f:
+        header = f.readline()
+        f.seek(max(offset, len(header)))
+        new_bytes = f.read()
+    new_bytes = new_bytes[:new_bytes.rfind(b"\n") + 1]
+    end = max(offset, len(header)) + len(new_bytes)
+    if offset and not new_bytes:
+        print("✅ Nothing new to clean")
+        return pd.DataFrame()
+    df = pd.read_csv(io.BytesIO(header + new_bytes))
 
-# Step 4: Convert 'Date' column to datetime (if exists)
-if 'timestamp' in df.columns:
-    # Only accept ISO format dates (the standard)
-    df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y-%m-%dT%H:%M:%S', errors='coerce')
-    # Add UTC timezone info
-    df['timestamp'] = df['timestamp'].dt.tz_localize('UTC')
+    # Step 2: Preview the data
+    print("Before cleaning:")
+    print(df.head())
 
-# Step 5: Rename columns to snake_case
-df.columns = [col.strip().lower().replace(" ", "_") for col in df.columns]
+    # Step 3: Drop completely empty rows
+    df = df.dropna(how="all")
 
-# Step 6: Save the cleaned file
-df.to_csv("output/weather_cleaned.csv", index=False)
+    # Step 4: Convert 'Date' column to datetime (if exists)
+    if 'timestamp' in df.columns:
+        # Only accept ISO format dates (the standard)
+        df['timestamp'] = pd.to_datetime(df['timestamp'], format='%Y-%m-%dT%H:%M:%S', errors='coerce')
+        # Add UTC timezone info
+        df['timestamp'] = df['timestamp'].dt.tz_localize('UTC')
 
-print("✅ Cleaning done. Saved as output/weather_cleaned.csv")
+    # Step 5: Rename columns to snake_case
+    df.columns = [col.strip().lower().replace(" ", "_") for col in df.columns]
 
-# Step 7: Load cleaned data back to database
-conn = sqlite3.connect('output/weather.db')
-df.to_sql('weather_data_clean', conn, if_exists='replace', index=False)
-conn.close()
+    # Step 6: Load the cleaned rows into the database, moving the cursor in the same transaction
+    conn.execute("INSERT OR REPLACE INTO clean_cursor (source, offset) VALUES (?, ?)", (source, end))
+    df.to_sql('weather_data_clean', conn, if_exists='append' if offset else 'replace', index=False)
+
+    # Step 7: Save the cleaned file (appending to it, like the table)
+    df.to_csv(output_csv, index=False, mode='a' if offset else 'w', header=not offset)
+
+    print(f"✅ Cleaning done: {len(df)} {'new ' if offset else ''}rows. Saved as {output_csv}")
+    return df
 
 # ✅ Query the cleaned data
-def query_cleaned_data(db_name="output/weather.db"):
+def query_cleaned_data(db_name=DB_PATH):
 
-    conn = sqlite3.connect(db_name)
+    conn = get_connection(db_name, readonly=True)
     cursor = conn.cursor()
 
     cursor.execute("""
@@ -45,11 +92,20 @@ def query_cleaned_data(db_name="output/weather.db"):
     """)
 
     rows = cursor.fetchall()
-    conn.close()
 
     print(f"\n🕒 RESULTS FROM CLEANED DATA:")
     for row in rows:
         print(row)
 
+def main(full=False):
+    clean_data(full=full)
+    query_cleaned_data()
+
 if __name__ == "__main__":
-    query_cleaned_data()
\ No newline at end of file
+    full = "--full" in sys.argv[1:]
+    if "--profile" in sys.argv[1:]:
+        from profiling import profile_run
+        with profile_run("clean"):
+            main(full)
+    else:
+        main(full)
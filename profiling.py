@@ -0,0 +1,324 @@
+"""
+Profiling Mode
+`--profile` on weather_etl.py (and on analyze_weather_data.py and
+load_and_clean.py) runs the command under:
+
+- cProfile: the top functions by cumulative time (main thread)
+- tracemalloc: peak traced memory and the top allocation sites
+- SQLite: every connection opened through storage gets a trace callback and
+  a progress handler, giving per-statement call counts and VM steps, and is
+  a TimedConnection, whose cursors time each statement: execute plus every
+  fetch, and COMMIT/ROLLBACK. Literals and placeholders are replaced by "?"
+  so the same query groups together; VM steps don't depend on machine load,
+  so they show plan regressions reliably
+
+The report goes to PROFILE_DIR/<name>.txt (the previous one is kept as
+<name>.prev.txt, so `diff` shows what changed) with a machine-readable
+<name>.json. It ends with the functions and statements that got noticeably
+slower than in the previous run.
+"""
+
+import cProfile
+import json
+import os
+import pstats
+import re
+import sqlite3
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import lru_cache
+
+from settings import BASE_PATH, PROFILE_DIR
+import storage
+
+TOP_FUNCTIONS = 30
+TOP_ALLOCATIONS = 15
+TOP_STATEMENTS = 30
+PROGRESS_OPS = 1000
+
+# A function or statement is reported as a regression when it takes this much
+# longer than in the previous run, relatively and absolutely
+REGRESSION_RATIO = 1.25
+REGRESSION_MIN_SECONDS = 0.01
+
+
+@lru_cache(maxsize=4096)
+def normalize_sql(sql):
+    """Statement text with literals and IN lists collapsed, for grouping"""
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"(?<!\w)[:@$][A-Za-z_]\w*", "?", sql)
+    sql = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?\b", "?", sql)
+    sql = re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", sql)
+    return " ".join(sql.split())[:200]
+
+
+def short_path(path):
+    """Path relative to the project or to site-packages, so reports compare across machines"""
+    if path.startswith(BASE_PATH):
+        return os.path.relpath(path, BASE_PATH)
+    marker = f"{os.sep}site-packages{os.sep}"
+    return path.split(marker, 1)[1] if marker in path else os.path.basename(path)
+
+
+class SqlTimer:
+    """
+    Per-statement counts and VM steps (from the trace callback and progress
+    handler) and time (charged by TimedCursor) for the connections it covers
+    """
+
+    def __init__(self):
+        self.stats = {}         # statement -> [calls, seconds, progress ticks]
+        self.current = {}       # connection id -> [statement, ticks]
+        self.connections = []
+        self.lock = threading.Lock()
+        self.active = True
+
+    def install(self, conn):
+        key = id(conn)
+        conn.set_trace_callback(lambda sql: self._start(key, sql))
+        conn.set_progress_handler(lambda: self._tick(key), PROGRESS_OPS)
+        self.connections.append(conn)
+
+    def _start(self, key, sql):
+        if not self.active:
+            return
+        statement = normalize_sql(sql)
+        with self.lock:
+            self._close(key)
+            self.stats.setdefault(statement, [0, 0.0, 0])[0] += 1
+            self.current[key] = [statement, 0]
+
+    def _tick(self, key):
+        entry = self.current.get(key)
+        if entry is not None:
+            entry[1] += 1
+        return 0
+
+    def _close(self, key):
+        entry = self.current.pop(key, None)
+        if entry is not None:
+            self.stats[entry[0]][2] += entry[1]
+
+    def charge(self, sql, seconds):
+        """Add time spent executing or fetching sql (called by TimedCursor)"""
+        if not self.active:
+            return
+        statement = normalize_sql(sql)
+        with self.lock:
+            self.stats.setdefault(statement, [0, 0.0, 0])[1] += seconds
+
+    def finish(self):
+        """Stop collecting and detach from the connections this thread can reach"""
+        with self.lock:
+            self.active = False
+            for key in list(self.current):
+                self._close(key)
+        for conn in self.connections:
+            try:
+                conn.set_trace_callback(None)
+                conn.set_progress_handler(None, 0)
+            except sqlite3.Error:
+                # Another thread's connection (or already closed): the callbacks are inert now
+                pass
+        self.connections = []
+
+    def rows(self):
+        return sorted(({"statement": statement, "calls": calls, "seconds": round(seconds, 6),
+                        "vm_steps": ticks * PROGRESS_OPS}
+                       for statement, (calls, seconds, ticks) in self.stats.items()),
+                      key=lambda row: (-row["seconds"], -row["vm_steps"], row["statement"]))
+
+
+# The SqlTimer of the running profile (None outside profile_run)
+_active_timer = None
+
+
+def _charge(sql, start):
+    timer = _active_timer
+    if timer is not None and sql is not None:
+        timer.charge(sql, time.perf_counter() - start)
+
+
+class TimedCursor(sqlite3.Cursor):
+    """
+    Charges the time spent in execute and in fetching rows to the statement,
+    so a statement's time ends when SQLite hands back its last row, not at its
+    last progress tick (which missed short statements entirely)
+    """
+
+    _sql = None
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            _charge(self._sql, start)
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        return self._timed(super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        return self._timed(super().executemany, sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        self._sql = sql_script
+        return self._timed(super().executescript, sql_script)
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self._timed(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __next__(self):
+        return self._timed(super().__next__)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection whose statements run on TimedCursors; commits and rollbacks are timed too"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def executescript(self, sql_script):
+        return self.cursor().executescript(sql_script)
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            _charge("COMMIT", start)
+
+    def rollback(self):
+        start = time.perf_counter()
+        try:
+            return super().rollback()
+        finally:
+            _charge("ROLLBACK", start)
+
+    def __exit__(self, exc_type, exc, tb):
+        # `with conn:` commits or rolls back without calling commit()/rollback()
+        start = time.perf_counter()
+        try:
+            return super().__exit__(exc_type, exc, tb)
+        finally:
+            _charge("COMMIT" if exc_type is None else "ROLLBACK", start)
+
+
+def _function_rows(profiler):
+    stats = pstats.Stats(profiler).stats
+    rows = []
+    for (path, line, func), (_, calls, tottime, cumtime, _) in stats.items():
+        site = f"{short_path(path)}:{line}({func})" if line else func
+        rows.append({"site": site, "calls": calls, "tottime": round(tottime, 6), "cumtime": round(cumtime, 6)})
+    rows.sort(key=lambda row: (-row["cumtime"], row["site"]))
+    return rows[:TOP_FUNCTIONS]
+
+
+def _allocation_rows(snapshot):
+    snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    return [{"site": f"{short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+             "kib": round(stat.size / 1024, 1), "blocks": stat.count}
+            for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]]
+
+
+def find_regressions(previous, current):
+    """[(kind, name, old seconds, new seconds), ...] that got slower than REGRESSION_RATIO allows"""
+    found = []
+    for kind, section, key, measure in (("function", "functions", "site", "cumtime"),
+                                        ("sql", "sql", "statement", "seconds")):
+        before = {row[key]: row[measure] for row in previous.get(section, [])}
+        for row in current[section]:
+            old, new = before.get(row[key]), row[measure]
+            if old is not None and new > old * REGRESSION_RATIO and new - old > REGRESSION_MIN_SECONDS:
+                found.append((kind, row[key], old, new))
+    return found
+
+
+def format_report(report, regressions):
+    lines = [
+        f"PROFILE {report['name']}",
+        f"wall time: {report['wall_s']:.3f}s",
+        f"peak traced memory: {report['peak_kib'] / 1024:.1f} MiB",
+        "",
+        "TOP FUNCTIONS BY CUMULATIVE TIME (main thread)",
+        f"{'cumtime':>10} {'tottime':>10} {'calls':>9}  site",
+    ]
+    lines += [f"{row['cumtime']:>10.4f} {row['tottime']:>10.4f} {row['calls']:>9}  {row['site']}"
+              for row in report["functions"]]
+    lines += ["", "TOP ALLOCATION SITES (live at exit)", f"{'KiB':>10} {'blocks':>9}  site"]
+    lines += [f"{row['kib']:>10.1f} {row['blocks']:>9}  {row['site']}" for row in report["allocations"]]
+    lines += ["", "SQL STATEMENTS", f"{'seconds':>10} {'vm steps':>12} {'calls':>7}  statement"]
+    lines += [f"{row['seconds']:>10.4f} {row['vm_steps']:>12} {row['calls']:>7}  {row['statement']}"
+              for row in report["sql"][:TOP_STATEMENTS]]
+    lines += ["", "SLOWER THAN THE PREVIOUS RUN"]
+    lines += [f"   {kind} {name}: {old:.4f}s -> {new:.4f}s" for kind, name, old, new in regressions] or ["   none"]
+    return "\n".join(lines) + "\n"
+
+
+def write_report(report, output_dir=PROFILE_DIR):
+    """Write <name>.txt and .json (keeping the previous pair). Returns (text path, regressions)"""
+    os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, report["name"])
+    previous = {}
+    if os.path.exists(f"{base}.json"):
+        with open(f"{base}.json") as f:
+            previous = json.load(f)
+        for ext in ("json", "txt"):
+            if os.path.exists(f"{base}.{ext}"):
+                os.replace(f"{base}.{ext}", f"{base}.prev.{ext}")
+    regressions = find_regressions(previous, report)
+    with open(f"{base}.json", "w") as f:
+        json.dump(report, f, indent=1)
+    with open(f"{base}.txt", "w") as f:
+        f.write(format_report(report, regressions))
+    return f"{base}.txt", regressions
+
+
+@contextmanager
+def profile_run(name, output_dir=PROFILE_DIR):
+    """
+    Profile the body and write the report when it finishes (even if it raises).
+    Connections opened before it started are counted but not timed
+    """
+    global _active_timer
+    sql = _active_timer = SqlTimer()
+    storage.connection_factory = TimedConnection
+    storage.add_connect_hook(sql.install)
+    tracemalloc.start()
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        wall = time.perf_counter() - start
+        snapshot = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        storage.remove_connect_hook(sql.install)
+        storage.connection_factory = sqlite3.Connection
+        sql.finish()
+        _active_timer = None
+        report = {"name": name, "wall_s": round(wall, 6), "peak_kib": round(peak / 1024, 1),
+                  "functions": _function_rows(profiler), "allocations": _allocation_rows(snapshot),
+                  "sql": sql.rows()}
+        path, regressions = write_report(report, output_dir)
+        print(f"⏱️ Profile written to {path} ({wall:.2f}s, peak {peak / 2 ** 20:.1f} MiB, "
+              f"{len(regressions)} regression(s))")
@@ -0,0 +1,526 @@
+#!/usr/bin/env python3
+"""
+Local Read-Only Query API
+Small HTTP service over weather.db so dashboards and ad-hoc consumers stop
+opening the database file themselves.
+
+Endpoints (all GET, JSON):
+  /latest?city=X                      latest reading per city (or one city)
+  /series?city=X&start=..&end=..      readings in a time range, keyset-paginated
+          &limit=N&cursor=..          (pass back `next_cursor` for the next page)
+  /daily?city=X&start=..&end=..       daily summaries (raw + hourly/daily rollups)
+  /quality                            data quality metrics
+  /nearest?lat=..&lon=..&k=N          closest cities (in-memory spatial index)
+  /region?min_lat=..&min_lon=..       per-city and overall aggregates for the cities
+          &max_lat=..&max_lon=..      in a bounding box (raw + rollups)
+          &start=..&end=..
+  /resample?city=X[,Y]&freq=hourly    series on a regular grid (10min/hourly/daily/seconds)
+          &agg=mean&fill=linear       with aggregation, optional ffill/linear fill
+          &limit=N&start=..&end=..    (at most N filled slots in a row)
+  /changes?cursor=..&limit=N          change feed: inserts/updates/deletes after the
+                                      cursor (pass back `next_cursor`; omit to start
+                                      at the oldest change still retained)
+  /today?city=X                       today's min/max temperature and reading count
+  /trend?city=X&days=N                daily average temperature over the last N days
+  /freshness                          minutes since each configured city's last reading
+
+/today, /trend and /freshness are answered from the in-memory hot window
+(the last HOT_WINDOW_DAYS days, see hot_window.py) without touching SQLite.
+Their answers depend on the clock as well as the data (the current day,
+minutes since the last reading), so they are computed on every request and
+are not cached or ETagged. /latest reads the window too (SQLite only for
+cities with nothing in it) but is cached like the other endpoints.
+
+Responses carry an ETag and Last-Modified derived from the database's data
+version, and are kept in an in-process LRU cache keyed by that version, so
+many concurrent readers cost one SQLite query per distinct request per change.
+"""
+
+import base64
+import json
+import queue
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from anomaly import get_anomaly_counts
+from hot_window import get_hot_window
+from run_ledger import timestamp_to_epoch
+from settings import DB_PATH, QUERY_API_HOST, QUERY_API_PORT, QUERY_API_THREADS, QUERY_CACHE_ENTRIES
+from storage import connect, count_duplicate_readings, ensure_schema, get_connection, table_exists
+from sharding import city_db_path, database_paths, federated_connection, sharding_enabled
+from spatial import get_index, region_summary
+from weather_batch import canonical_timestamp
+
+MAX_PAGE_SIZE = 5000
+MAX_RESAMPLE_POINTS = 100000
+
+
+class DataVersion:
+    """
+    Tracks changes to the database and its shards. PRAGMA data_version on a
+    long-lived connection changes whenever another connection commits, so
+    polling it is a cheap way to learn that cached responses are out of date.
+    """
+
+    def __init__(self, db_name):
+        self.db_name = db_name
+        self.conns = {}
+        self.lock = threading.Lock()
+        self.boot_id = uuid.uuid4().hex[:8]
+        self.counter = 0
+        self.last_seen = None
+        self.modified = time.time()
+
+    def current(self):
+        """Return (version_token, last_modified_epoch)"""
+        with self.lock:
+            seen = []
+            for path in [self.db_name] + database_paths()[1:]:
+                conn = self.conns.get(path)
+                if conn is None:
+                    conn = self.conns[path] = connect(path, readonly=True, check_same_thread=False)
+                seen.append((path, conn.execute("PRAGMA data_version").fetchone()[0]))
+            if seen != self.last_seen:
+                self.last_seen = seen
+                self.counter += 1
+                self.modified = time.time()
+            return f"{self.boot_id}-{self.counter}", self.modified
+
+
+class ResponseCache:
+    """Thread-safe LRU cache with single-flight loading of missing entries"""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.loading = {}
+        self.lock = threading.Lock()
+
+    def get_or_load(self, key, loader):
+        while True:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key]
+                event = self.loading.get(key)
+                if event is None:
+                    event = self.loading[key] = threading.Event()
+                    break
+            # Someone else is already running this query: wait for their result
+            event.wait()
+
+        try:
+            value = loader()
+            with self.lock:
+                self.entries[key] = value
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+
+def encode_cursor(timestamp, fact_id):
+    return base64.urlsafe_b64encode(f"{timestamp}|{fact_id}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    timestamp, fact_id = base64.urlsafe_b64decode(cursor.encode()).decode().rsplit("|", 1)
+    return timestamp, int(fact_id)
+
+
+# --- queries --------------------------------------------------------------
+
+def _latest_from_db(conn, city=None):
+    if table_exists(conn, "last_ingest"):
+        sql = """
+            SELECT w.city, w.timestamp, w.temp, w.humidity, w.weather
+            FROM last_ingest li
+            JOIN weather_data w ON w.city = li.city AND w.timestamp = li.last_timestamp
+        """
+    else:
+        sql = """
+            SELECT city, MAX(timestamp), temp, humidity, weather
+            FROM weather_data w
+        """
+    args = []
+    if city:
+        sql += " WHERE w.city = ?"
+        args.append(city)
+    if not table_exists(conn, "last_ingest"):
+        sql += " GROUP BY city"
+    return conn.execute(sql, args).fetchall()
+
+
+def query_latest(conn, params, hot):
+    city = params.get("city")
+    rows = [(name, canonical_timestamp(epoch), temp, humidity, weather)
+            for name, epoch, temp, humidity, weather in hot.latest(city)]
+    # SQLite only for cities with nothing in the hot window
+    held = {row[0] for row in rows}
+    if city and not held:
+        rows = _latest_from_db(conn, city)
+    elif not city and (not table_exists(conn, "last_ingest")
+                       or conn.execute("SELECT COUNT(*) FROM last_ingest").fetchone()[0] > len(held)):
+        rows += [row for row in _latest_from_db(conn) if row[0] not in held]
+    return {"readings": [
+        {"city": c, "timestamp": ts, "temp": t, "humidity": h, "weather": w}
+        for c, ts, t, h, w in rows
+    ]}
+
+
+def query_series(conn, params):
+    city = params.get("city")
+    if not city:
+        raise ValueError("city is required")
+    limit = min(int(params.get("limit", 1000)), MAX_PAGE_SIZE)
+    start = params.get("start", "")
+    end = params.get("end", "9999")
+
+    # Keyset pagination: continue strictly after the last (timestamp, id) seen
+    after_ts, after_id = decode_cursor(params["cursor"]) if params.get("cursor") else ("", -1)
+    rows = conn.execute("""
+        SELECT id, timestamp, temp, humidity, weather
+        FROM weather_data
+        WHERE city = ? AND timestamp >= ? AND timestamp < ?
+          AND (timestamp > ? OR (timestamp = ? AND id > ?))
+        ORDER BY timestamp, id
+        LIMIT ?
+    """, (city, start, end, after_ts, after_ts, after_id, limit)).fetchall()
+
+    next_cursor = encode_cursor(rows[-1][1], rows[-1][0]) if len(rows) == limit else None
+    return {
+        "city": city,
+        "readings": [
+            {"timestamp": ts, "temp": t, "humidity": h, "weather": w}
+            for _, ts, t, h, w in rows
+        ],
+        "next_cursor": next_cursor,
+    }
+
+
+def query_daily(conn, params):
+    city = params.get("city")
+    start = params.get("start", "")
+    end = params.get("end", "9999")
+
+    # Recent days live in weather_data; older ones only survive in the rollups
+    parts = ["""
+        SELECT city, DATE(timestamp) AS date, COUNT(*) AS readings, COUNT(temp) AS temp_count,
+               SUM(temp) AS temp_sum, MIN(temp) AS temp_min, MAX(temp) AS temp_max
+        FROM weather_data GROUP BY city, DATE(timestamp)
+    """]
+    if table_exists(conn, "weather_hourly"):
+        parts.append("""
+            SELECT city, DATE(hour_epoch, 'unixepoch'), SUM(readings), SUM(temp_count),
+                   SUM(temp_sum), MIN(temp_min), MAX(temp_max)
+            FROM weather_hourly GROUP BY city, DATE(hour_epoch, 'unixepoch')
+        """)
+    if table_exists(conn, "weather_daily"):
+        parts.append("""
+            SELECT city, DATE(day_epoch, 'unixepoch'), SUM(readings), SUM(temp_count),
+                   SUM(temp_sum), MIN(temp_min), MAX(temp_max)
+            FROM weather_daily GROUP BY city, DATE(day_epoch, 'unixepoch')
+        """)
+    sql = f"""
+        SELECT city, date, SUM(readings), SUM(temp_sum) / NULLIF(SUM(temp_count), 0),
+               MIN(temp_min), MAX(temp_max)
+        FROM ({" UNION ALL ".join(parts)})
+        WHERE date >= ? AND date < ? {"AND city = ?" if city else ""}
+        GROUP BY city, date
+        ORDER BY city, date
+    """
+    args = [start, end] + ([city] if city else [])
+    return {"days": [
+        {"city": c, "date": d, "readings": n, "avg_temp": avg, "min_temp": lo, "max_temp": hi}
+        for c, d, n, avg, lo, hi in conn.execute(sql, args).fetchall()
+    ]}
+
+
+def query_quality(conn, params):
+    total, missing_temp, missing_humidity = conn.execute("""
+        SELECT
+            COUNT(*),
+            COUNT(CASE WHEN temp IS NULL THEN 1 END),
+            COUNT(CASE WHEN humidity IS NULL THEN 1 END)
+        FROM weather_data
+    """).fetchone()
+    outliers = sum(count for _, count in get_anomaly_counts(conn))
+    duplicates = count_duplicate_readings(conn)
+    return {
+        "total_records": total,
+        "missing_temp": missing_temp,
+        "missing_humidity": missing_humidity,
+        "outliers": outliers,
+        "duplicates": duplicates,
+    }
+
+
+def query_nearest(conn, params, spatial):
+    k = min(int(params.get("k", 5)), MAX_PAGE_SIZE)
+    nearest = spatial.nearest(float(params["lat"]), float(params["lon"]), k)
+    return {"cities": [
+        {"city": city, "lat": lat, "lon": lon, "distance_km": round(distance, 3)}
+        for distance, city, lat, lon in nearest
+    ]}
+
+
+def query_region(conn, params, spatial):
+    cities = spatial.within(float(params["min_lat"]), float(params["min_lon"]),
+                            float(params["max_lat"]), float(params["max_lon"]))
+    start = timestamp_to_epoch(params["start"]) if params.get("start") else None
+    end = timestamp_to_epoch(params["end"]) if params.get("end") else None
+    rows = region_summary(conn, cities, start, end)
+
+    def summary(readings, temp_count, temp_sum, temp_min, temp_max, humidity_count, humidity_sum):
+        return {
+            "readings": readings,
+            "avg_temp": temp_sum / temp_count if temp_count else None,
+            "min_temp": temp_min,
+            "max_temp": temp_max,
+            "avg_humidity": humidity_sum / humidity_count if humidity_count else None,
+        }
+
+    overall = [sum(r[1] for r in rows), sum(r[2] for r in rows), sum(r[3] or 0 for r in rows),
+               min((r[4] for r in rows if r[4] is not None), default=None),
+               max((r[5] for r in rows if r[5] is not None), default=None),
+               sum(r[6] for r in rows), sum(r[7] or 0 for r in rows)]
+    return {
+        "cities": [{"city": row[0], **summary(*row[1:])} for row in rows],
+        "cities_in_region": len(cities),
+        "summary": summary(*overall),
+    }
+
+
+def query_resample(conn, params):
+    from resample import read_series, resample
+
+    cities = [city for city in params.get("city", "").split(",") if city]
+    if not cities:
+        raise ValueError("city is required")
+    start = timestamp_to_epoch(params["start"]) if params.get("start") else None
+    end = timestamp_to_epoch(params["end"]) if params.get("end") else None
+    limit = int(params["limit"]) if params.get("limit") else None
+    grid = resample(read_series(conn, cities, start, end), params.get("freq", "hourly"),
+                    params.get("agg", "mean"), params.get("fill"), limit)
+    if len(grid["epoch"]) > MAX_RESAMPLE_POINTS:
+        raise ValueError(f"More than {MAX_RESAMPLE_POINTS} points; use a coarser freq or a shorter range")
+
+    def value(x):
+        return None if x != x else float(x)
+
+    series = {}
+    for i in range(len(grid["epoch"])):
+        series.setdefault(grid["city"][i], []).append({
+            "timestamp": canonical_timestamp(int(grid["epoch"][i])),
+            "readings": int(grid["readings"][i]),
+            "temp": value(grid["temp"][i]),
+            "humidity": value(grid["humidity"][i]),
+        })
+    return {"series": [{"city": city, "points": points} for city, points in series.items()]}
+
+
+def query_changes(conn, params):
+    from changes import read_feed
+
+    limit = min(int(params.get("limit", 1000)), MAX_PAGE_SIZE)
+    changes, cursor = read_feed(params.get("cursor"), limit)
+    return {"changes": changes, "next_cursor": cursor}
+
+
+def query_today(conn, params, hot):
+    low, high, readings = hot.today_summary(params.get("city"))
+    return {"date": datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+            "min_temp": low, "max_temp": high, "readings": readings}
+
+
+def query_trend(conn, params, hot):
+    days = int(params.get("days", 5))
+    return {"days": [{"date": date, "avg_temp": avg}
+                     for date, avg in hot.daily_trend(params.get("city"), days)]}
+
+
+def query_freshness(conn, params, hot):
+    return {"cities": [
+        {"city": city, "age_minutes": None if age is None else round(age, 1), "stale": stale}
+        for city, age, stale in hot.freshness()
+    ]}
+
+
+ROUTES = {
+    "/latest": query_latest,
+    "/series": query_series,
+    "/daily": query_daily,
+    "/quality": query_quality,
+    "/nearest": query_nearest,
+    "/region": query_region,
+    "/resample": query_resample,
+    "/changes": query_changes,
+    "/today": query_today,
+    "/trend": query_trend,
+    "/freshness": query_freshness,
+}
+
+# Single-city routes that read the city's own database (keyset cursors need its fact ids)
+CITY_ROUTES = {"/series"}
+
+# Routes that also get the server's spatial index
+SPATIAL_ROUTES = {"/nearest", "/region"}
+
+# Routes that also get the hot window, caught up to the data version first
+WINDOW_ROUTES = {"/latest"}
+
+# Routes answered from the hot window (given instead of a connection; never cached, see send_hot)
+HOT_ROUTES = {"/today", "/trend", "/freshness"}
+
+
+# --- HTTP server ----------------------------------------------------------
+
+class QueryHandler(BaseHTTPRequestHandler):
+    server_version = "WeatherQueryAPI/1.0"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        handler = ROUTES.get(url.path)
+        if handler is None:
+            return self.send_json(404, {"error": f"Unknown endpoint {url.path}"})
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        version, modified = self.server.data_version.current()
+        if url.path in HOT_ROUTES:
+            return self.send_hot(handler, params, version)
+
+        etag = f'W/"{version}"'
+        if self.not_modified(etag, modified):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        key = (url.path, tuple(sorted(params.items())), version)
+        city = params.get("city") if url.path in CITY_ROUTES else None
+        extra = (self.server.spatial,) if url.path in SPATIAL_ROUTES else ()
+        if url.path in WINDOW_ROUTES:
+            extra = (self.server.hot_window,)
+
+        def load():
+            if url.path in WINDOW_ROUTES:
+                self.server.hot_window.sync(version)
+            return json.dumps(handler(self.server.connection(city), params, *extra)).encode()
+
+        try:
+            body = self.server.cache.get_or_load(key, load)
+        except (ValueError, KeyError) as e:
+            return self.send_json(400, {"error": str(e)})
+        except sqlite3.Error as e:
+            return self.send_json(500, {"error": str(e)})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", formatdate(modified, usegmt=True))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_hot(self, handler, params, version):
+        """Answer a clock-dependent route from the hot window, bypassing the version cache"""
+        # Catch the window up with the change log once per data version (and at midnight)
+        self.server.hot_window.sync(version)
+        try:
+            payload = handler(None, params, self.server.hot_window)
+        except (ValueError, KeyError) as e:
+            return self.send_json(400, {"error": str(e)})
+        self.send_json(200, payload, {"Cache-Control": "no-store"})
+
+    def not_modified(self, etag, modified):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return etag in [tag.strip() for tag in if_none_match.split(",")]
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+                return int(modified) <= since.timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        print(f"[{timestamp}] {self.address_string()} {format % args}")
+
+
+class QueryServer(ThreadingHTTPServer):
+    """
+    Requests are handed to a fixed set of worker threads instead of a new
+    thread each, so the per-thread pooled connections (with their attached
+    shards and TEMP views) are built once per worker, not once per request
+    """
+    daemon_threads = True
+
+    def __init__(self, address, db_name, cache_entries=QUERY_CACHE_ENTRIES, threads=QUERY_API_THREADS):
+        super().__init__(address, QueryHandler)
+        self.db_name = db_name
+        # Migrates an older database to the current schema before serving it read-only
+        ensure_schema(db_name)
+        self.data_version = DataVersion(db_name)
+        self.cache = ResponseCache(cache_entries)
+        # Built now so the first region/nearest request doesn't pay for it
+        self.spatial = get_index(db_name)
+        self.spatial.refresh()
+        self.hot_window = get_hot_window(db_name)
+        # Bounded: when every worker is busy, accepting waits instead of queueing without limit
+        self.requests = queue.Queue(threads)
+        for index in range(threads):
+            threading.Thread(target=self.serve_requests, name=f"query-api-{index}", daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.requests.put((request, client_address))
+
+    def serve_requests(self):
+        while True:
+            # Handles errors and closes the socket, as ThreadingMixIn's per-request threads do
+            self.process_request_thread(*self.requests.get())
+
+    def connection(self, city=None):
+        """This worker's pooled read-only connection (federated across shards)"""
+        if city and sharding_enabled():
+            return get_connection(city_db_path(city), readonly=True)
+        return federated_connection(self.db_name)
+
+
+def serve(db_name=DB_PATH, host=QUERY_API_HOST, port=QUERY_API_PORT):
+    server = QueryServer((host, port), db_name)
+    print(f"🌐 Serving {db_name} on http://{host}:{port} (read-only)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Query API stopped")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve(sys.argv[1] if len(sys.argv) > 1 else DB_PATH)
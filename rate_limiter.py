@@ -0,0 +1,181 @@
+"""
+API Rate Limiting and Request Scheduling
+Keeps OpenWeather calls under the per-minute and per-day quotas:
+- TokenBucket: per-minute limiter stored in SQLite, shared by every worker thread and process
+- DailyQuota: call counter persisted in SQLite so it survives cron restarts
+- plan_requests(): orders cities by priority/staleness and spreads them over the window
+"""
+
+import threading
+import time
+from datetime import datetime, timezone
+
+from storage import get_connection
+
+
+class TokenBucket:
+    """
+    Token bucket stored in the `api_bucket` table: `rate` tokens per second,
+    bursts up to `capacity`. Every thread and process on the same database
+    draws from the one bucket, so several ETL workers together stay under
+    the per-minute limit instead of each getting its own
+    """
+
+    def __init__(self, db_name, rate, capacity, name="api"):
+        self.db_name = db_name
+        self.rate = rate
+        self.capacity = capacity
+        self.name = name
+        conn = get_connection(self.db_name)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS api_bucket (
+                name TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL,
+                blocked_until REAL NOT NULL DEFAULT 0
+            )
+        """)
+        conn.execute("INSERT OR IGNORE INTO api_bucket (name, tokens, updated) VALUES (?, ?, ?)",
+                     (name, capacity, time.time()))
+        conn.commit()
+
+    def _take(self):
+        """Take a token if one is available. Returns 0, or the seconds to wait before trying again"""
+        conn = get_connection(self.db_name)
+        # Wall-clock time, since the bucket is shared across processes
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tokens, updated, blocked_until = conn.execute(
+                "SELECT tokens, updated, blocked_until FROM api_bucket WHERE name = ?", (self.name,)
+            ).fetchone()
+            tokens = min(self.capacity, tokens + max(0.0, now - updated) * self.rate)
+            if now >= blocked_until and tokens >= 1:
+                tokens, wait = tokens - 1, 0
+            else:
+                wait = max(blocked_until - now, (1 - tokens) / self.rate)
+            conn.execute("UPDATE api_bucket SET tokens = ?, updated = ? WHERE name = ?",
+                         (tokens, max(now, updated), self.name))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return wait
+
+    def acquire(self, timeout=None):
+        """Block until a token is available. Returns False if timeout expires first"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._take()
+            if wait == 0:
+                return True
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Stop handing out tokens for a while (e.g. after a 429 response), in every process"""
+        conn = get_connection(self.db_name)
+        with conn:
+            conn.execute("""
+                UPDATE api_bucket SET blocked_until = MAX(blocked_until, ?), tokens = 0 WHERE name = ?
+            """, (time.time() + seconds, self.name))
+
+
+class DailyQuota:
+    """Per-UTC-day API call counter stored in the `api_quota` table"""
+
+    def __init__(self, db_name, limit):
+        self.db_name = db_name
+        self.limit = limit
+        self.lock = threading.Lock()
+        conn = get_connection(self.db_name)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS api_quota (
+                day TEXT PRIMARY KEY,
+                calls INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        conn.commit()
+
+    @staticmethod
+    def today():
+        return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+    def try_consume(self, calls=1):
+        """Atomically count `calls` against today's quota. False if it would exceed it"""
+        conn = get_connection(self.db_name)
+        with self.lock, conn:
+            # The WHERE clause makes check-and-increment a single atomic statement,
+            # so several processes sharing the database cannot overshoot the limit
+            day = self.today()
+            conn.execute("INSERT OR IGNORE INTO api_quota (day, calls) VALUES (?, 0)", (day,))
+            cursor = conn.execute("""
+                UPDATE api_quota SET calls = calls + ?
+                WHERE day = ? AND calls + ? <= ?
+            """, (calls, day, calls, self.limit))
+            return cursor.rowcount == 1
+
+    def used_today(self):
+        conn = get_connection(self.db_name)
+        row = conn.execute("SELECT calls FROM api_quota WHERE day = ?", (self.today(),)).fetchone()
+        return row[0] if row else 0
+
+
+class ApiRateLimiter:
+    """Per-minute token bucket plus daily quota, both persisted so every worker process shares them"""
+
+    def __init__(self, db_name, calls_per_minute, calls_per_day):
+        self.bucket = TokenBucket(db_name, rate=calls_per_minute / 60.0, capacity=max(1, calls_per_minute // 6))
+        self.quota = DailyQuota(db_name, calls_per_day)
+
+    def acquire(self, timeout=None):
+        """Wait for a per-minute token, then reserve one call from the daily quota"""
+        if not self.bucket.acquire(timeout):
+            return False
+        return self.quota.try_consume()
+
+    def backoff(self, retry_after=60):
+        """Called when the API answers 429: pause every worker (in every process), not just this one"""
+        self.bucket.pause(retry_after)
+
+
+def plan_requests(cities, last_epochs, priorities=None, window_seconds=600,
+                  stale_after_seconds=1800, now=None, due_offsets=None):
+    """
+    Decide when each city is fetched inside one scheduling window.
+
+    Stale cities (never seen, or older than stale_after_seconds) go first at
+    offset 0, highest priority first. The remaining cities are spread evenly
+    across the window so the API sees a steady trickle instead of a burst,
+    unless due_offsets ({city: [offset, ...]}, from adaptive polling) gives
+    their poll times explicitly; then only those cities are planned.
+
+    Returns a list of (offset_seconds, city) sorted by offset.
+    """
+    priorities = priorities or {}
+    now = time.time() if now is None else now
+
+    def age(city):
+        last = last_epochs.get(city)
+        return float("inf") if last is None else now - last
+
+    if due_offsets is not None:
+        cities = [c for c in cities if c in due_offsets]
+    ordered = sorted(cities, key=lambda c: (-priorities.get(c, 0), -age(c)))
+    stale = [c for c in ordered if age(c) >= stale_after_seconds]
+    fresh = [c for c in ordered if age(c) < stale_after_seconds]
+
+    plan = [(0.0, city) for city in stale]
+    if due_offsets is not None:
+        for city in stale:
+            plan.extend((offset, city) for offset in due_offsets[city][1:])
+        for city in fresh:
+            plan.extend((offset, city) for offset in due_offsets[city])
+    elif fresh:
+        step = window_seconds / len(fresh)
+        plan.extend((i * step, city) for i, city in enumerate(fresh))
+    return sorted(plan, key=lambda item: item[0])
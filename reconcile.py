@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+CSV / SQLite Reconciliation
+Every reading is written to weather_data.csv and to SQLite, and either write
+can fail on its own. This compares the two stores without a row-by-row diff:
+
+1. Stream each store once and fold its rows into per-(city, UTC day)
+   digests: row count plus the sum of each row's hash (order independent,
+   so neither side needs sorting)
+2. Compare the digests; only mismatching days are read again, row by row
+3. Repair with bulk writes: rows only in the CSV are inserted into SQLite in
+   one batch, rows only in SQLite are appended to the CSV. Rows present on
+   both sides with different values are reported, not changed.
+
+Days older than the raw retention cutoff are skipped: compaction has rolled
+their readings into weather_hourly, so the CSV would always look ahead of
+SQLite there, and copying the rows back would count them twice.
+"""
+
+import sys
+
+from backfill import read_csv_rows
+from retention import EPOCH_SQL, raw_cutoff_epoch
+from settings import CSV_PATH, DB_PATH
+from sharding import federated_connection
+from storage import ensure_schema
+from weather_batch import WeatherBatch, canonical_timestamp
+
+BUCKET_SECONDS = 86400
+
+
+def first_live_bucket(now=None):
+    """First bucket entirely newer than the raw retention cutoff (older ones may be rolled up)"""
+    return -(-raw_cutoff_epoch(now) // BUCKET_SECONDS)
+
+
+def bucket_digests(rows, min_bucket=None):
+    """
+    {(city, bucket): (rows, hash_sum)} for (epoch, city, temp, humidity, weather)
+    tuples, skipping buckets before min_bucket. Uses Python's built-in tuple
+    hash (~10x faster than hashlib here); its per-process string seed is fine
+    because digests are only compared within one run
+    """
+    digests = {}
+    for row in rows:
+        key = (row[1], row[0] // BUCKET_SECONDS)
+        if min_bucket is not None and key[1] < min_bucket:
+            continue
+        count, total = digests.get(key, (0, 0))
+        digests[key] = (count + 1, total + hash(row))
+    return digests
+
+
+# Only rows the CSV can represent (read_csv_rows skips rows without temp or humidity)
+COMPARABLE_SQL = "timestamp IS NOT NULL AND city IS NOT NULL AND temp IS NOT NULL AND humidity IS NOT NULL"
+
+
+def sqlite_rows(conn, city=None, start_epoch=None, end_epoch=None):
+    """(epoch, city, temp, humidity, weather) from weather_data, optionally one city's time range"""
+    if city is None:
+        return conn.execute(f"""
+            SELECT {EPOCH_SQL}, city, temp, humidity, COALESCE(weather, '') FROM weather_data
+            WHERE {COMPARABLE_SQL}
+        """)
+    # Index range on the ISO timestamp, widened a day for offsets; exact filter on the epoch
+    return conn.execute(f"""
+        SELECT * FROM (
+            SELECT {EPOCH_SQL} AS epoch, city, temp, humidity, COALESCE(weather, '') FROM weather_data
+            WHERE city = ? AND timestamp >= date(?, '-1 day') AND timestamp < date(?, '+1 day')
+              AND {COMPARABLE_SQL}
+        ) WHERE epoch >= ? AND epoch < ?
+    """, (city, canonical_timestamp(start_epoch), canonical_timestamp(end_epoch), start_epoch, end_epoch))
+
+
+def diff_bucket(csv_rows, db_rows):
+    """
+    Row-level diff of one bucket keyed by (city, epoch).
+    Returns (only_in_csv, only_in_db, conflicts)
+    """
+    csv_by_key = {(row[1], row[0]): row for row in csv_rows}
+    db_by_key = {(row[1], row[0]): row for row in db_rows}
+    only_csv = [row for key, row in csv_by_key.items() if key not in db_by_key]
+    only_db = [row for key, row in db_by_key.items() if key not in csv_by_key]
+    conflicts = [(row, db_by_key[key]) for key, row in csv_by_key.items()
+                 if key in db_by_key and row != db_by_key[key]]
+    return only_csv, only_db, conflicts
+
+
+def reconcile(csv_path=CSV_PATH, repair=True):
+    """
+    Compare the CSV with SQLite (every shard) and, if repair is set, copy
+    missing rows across. Returns a summary dict.
+    """
+    from etl_production import load_to_csv, load_to_sqlite
+
+    ensure_schema(DB_PATH)
+    conn = federated_connection()
+    min_bucket = first_live_bucket()
+    csv_digests = bucket_digests(read_csv_rows(csv_path), min_bucket)
+    db_digests = bucket_digests(sqlite_rows(conn), min_bucket)
+    mismatched = sorted(key for key in csv_digests.keys() | db_digests.keys()
+                        if csv_digests.get(key) != db_digests.get(key))
+    summary = {"buckets": len(csv_digests.keys() | db_digests.keys()), "mismatched": len(mismatched),
+               "added_to_sqlite": 0, "added_to_csv": 0, "conflicts": [],
+               "since": canonical_timestamp(min_bucket * BUCKET_SECONDS)[:10]}
+    if not mismatched:
+        return summary
+
+    # Drill down: one more pass over the CSV, keeping only rows of mismatching buckets
+    wanted = set(mismatched)
+    csv_buckets = {}
+    for row in read_csv_rows(csv_path):
+        key = (row[1], row[0] // BUCKET_SECONDS)
+        if key in wanted:
+            csv_buckets.setdefault(key, []).append(row)
+
+    missing_in_db, missing_in_csv = WeatherBatch(), WeatherBatch()
+    for city, bucket in mismatched:
+        start = bucket * BUCKET_SECONDS
+        db_rows = sqlite_rows(conn, city, start, start + BUCKET_SECONDS).fetchall()
+        only_csv, only_db, conflicts = diff_bucket(csv_buckets.get((city, bucket), []), db_rows)
+        for row in only_csv:
+            missing_in_db.append(*row)
+        for row in sorted(only_db):
+            missing_in_csv.append(*row)
+        summary["conflicts"].extend(conflicts)
+
+    if repair and len(missing_in_db):
+        if load_to_sqlite(missing_in_db):
+            summary["added_to_sqlite"] = len(missing_in_db)
+    if repair and len(missing_in_csv):
+        if load_to_csv(missing_in_csv, csv_path):
+            summary["added_to_csv"] = len(missing_in_csv)
+    summary["missing_in_sqlite"] = len(missing_in_db)
+    summary["missing_in_csv"] = len(missing_in_csv)
+    return summary
+
+
+def print_summary(summary):
+    print(f"🔎 {summary['buckets']} city-days compared since {summary['since']} "
+          f"(older days are rolled up), {summary['mismatched']} mismatched")
+    if summary["mismatched"]:
+        print(f"   Missing in SQLite: {summary['missing_in_sqlite']} (added {summary['added_to_sqlite']})")
+        print(f"   Missing in CSV: {summary['missing_in_csv']} (added {summary['added_to_csv']})")
+    for csv_row, db_row in summary["conflicts"][:10]:
+        print(f"   ⚠️ {csv_row[1]} {canonical_timestamp(csv_row[0])}: CSV {csv_row[2:]} vs SQLite {db_row[2:]}")
+    if len(summary["conflicts"]) > 10:
+        print(f"   ... and {len(summary['conflicts']) - 10} more conflicts")
+
+
+if __name__ == "__main__":
+    print_summary(reconcile(sys.argv[1] if len(sys.argv) > 1 else CSV_PATH))
@@ -0,0 +1,167 @@
+"""
+Resampling to Regular Time Grids
+Readings arrive with jitter and gaps; trends and moving averages need evenly
+spaced points. resample() turns irregular series into a UTC-aligned grid
+(10 min, hourly, daily or any step in seconds) for many cities and years in
+one call:
+
+- the series is read straight into WeatherBatch columns (no row dicts)
+- rows are sorted once by (city, time); each grid slot is a run of rows, so
+  aggregation is bincount / reduceat over whole arrays
+- each city's grid spans its first to last slot; empty slots are NaN unless
+  filled by forward-fill or linear interpolation, optionally limited to
+  `limit` consecutive slots (interpolation never crosses cities)
+"""
+
+import json
+
+import numpy as np
+
+from retention import EPOCH_SQL
+from weather_batch import WeatherBatch, HUMIDITY_MISSING, canonical_timestamp
+
+FREQUENCIES = {"10min": 600, "hourly": 3600, "1h": 3600, "daily": 86400, "1d": 86400}
+AGGREGATIONS = ("mean", "min", "max", "first", "last", "sum", "count")
+FILLS = ("linear", "ffill")
+FIELDS = ("temp", "humidity")
+
+
+def step_seconds(freq):
+    """Grid step for a frequency name or a number of seconds"""
+    if freq in FREQUENCIES:
+        return FREQUENCIES[freq]
+    try:
+        step = int(freq)
+    except (TypeError, ValueError):
+        raise ValueError(f"Unknown frequency {freq!r} (use {', '.join(FREQUENCIES)} or seconds)")
+    if step <= 0:
+        raise ValueError("Frequency must be positive")
+    return step
+
+
+def read_series(conn, cities=None, start_epoch=None, end_epoch=None):
+    """Readings for the given cities (None = all) in [start_epoch, end_epoch) as a WeatherBatch"""
+    where = ["timestamp IS NOT NULL", "city IS NOT NULL"]
+    params = []
+    if cities:
+        where.append("city IN (SELECT value FROM json_each(?))")
+        params.append(json.dumps(list(cities)))
+    if start_epoch is not None:
+        where.append("timestamp >= ?")
+        params.append(canonical_timestamp(start_epoch)[:19])
+    if end_epoch is not None:
+        where.append("timestamp < ?")
+        params.append(canonical_timestamp(end_epoch)[:19])
+    batch = WeatherBatch()
+    for epoch, city, temp, humidity in conn.execute(f"""
+        SELECT {EPOCH_SQL}, city, temp, humidity FROM weather_data WHERE {" AND ".join(where)}
+    """, params):
+        batch.append(epoch, city, temp, humidity, None)
+    return batch
+
+
+def _aggregate(values, group_ids, starts, groups, agg):
+    """One value per group for rows sorted by group, ignoring NaNs"""
+    valid = ~np.isnan(values)
+    count = np.bincount(group_ids, weights=valid, minlength=groups)
+    if agg == "count":
+        return count
+    with np.errstate(invalid="ignore", divide="ignore"):
+        if agg in ("mean", "sum"):
+            total = np.bincount(group_ids, weights=np.where(valid, values, 0.0), minlength=groups)
+            result = total / count if agg == "mean" else total
+        elif agg == "min":
+            result = np.fmin.reduceat(values, starts)
+        elif agg == "max":
+            result = np.fmax.reduceat(values, starts)
+        else:
+            # first/last valid row of each group; index len(values) points at a NaN pad
+            padded = np.append(values, np.nan)
+            positions = np.arange(len(values))
+            if agg == "first":
+                picks = np.minimum.reduceat(np.where(valid, positions, len(values)), starts)
+            else:
+                picks = np.maximum.reduceat(np.where(valid, positions, -1), starts)
+                picks[picks < 0] = len(values)
+            result = padded[picks]
+    return np.where(count > 0, result, np.nan)
+
+
+def _fill(grid, slot_start, slot_end, method, limit):
+    """Fill NaN slots in place without crossing from one city's grid into another's"""
+    positions = np.arange(len(grid))
+    valid = ~np.isnan(grid)
+    prev = np.maximum.accumulate(np.where(valid, positions, -1))
+    fill = ~valid & (prev >= slot_start)
+    if limit is not None:
+        fill &= positions - prev <= limit
+    if method == "ffill":
+        grid[fill] = grid[prev[fill]]
+        return fill
+    following = np.minimum.accumulate(np.where(valid, positions, len(grid))[::-1])[::-1]
+    fill &= following <= slot_end
+    before, after = prev[fill], following[fill]
+    weight = (positions[fill] - before) / (after - before)
+    grid[fill] = grid[before] + (grid[after] - grid[before]) * weight
+    return fill
+
+
+def resample(batch, freq="hourly", agg="mean", fill=None, limit=None, fields=FIELDS):
+    """
+    Regular grid for every city in the batch. Returns columns as arrays:
+    city, epoch (slot start), readings (rows in the slot), one array per
+    field, and "<field>_filled" masks for slots filled by interpolation.
+    """
+    if agg not in AGGREGATIONS:
+        raise ValueError(f"Unknown aggregation {agg!r} (use {', '.join(AGGREGATIONS)})")
+    if fill is not None and fill not in FILLS:
+        raise ValueError(f"Unknown fill {fill!r} (use {', '.join(FILLS)})")
+    step = step_seconds(freq)
+    columns = batch.to_numpy()
+    empty = {"city": np.array([], dtype=object), "epoch": np.array([], dtype=np.int64),
+             "readings": np.array([], dtype=np.int64)}
+    if not len(batch):
+        return {**empty, **{field: np.array([]) for field in fields}}
+
+    # Sort once by (city, time); consecutive rows with the same (city, slot) form a group
+    order = np.lexsort((columns["epoch"], columns["city_code"]))
+    city = columns["city_code"][order]
+    slot = columns["epoch"][order] // step
+    new_group = np.ones(len(order), dtype=bool)
+    new_group[1:] = (city[1:] != city[:-1]) | (slot[1:] != slot[:-1])
+    starts = np.flatnonzero(new_group)
+    group_ids = np.cumsum(new_group) - 1
+    group_city, group_slot = city[starts], slot[starts]
+
+    # Each city's grid runs from its first to its last slot; grids are laid end to end
+    city_starts = np.flatnonzero(np.r_[True, group_city[1:] != group_city[:-1]])
+    city_ends = np.r_[city_starts[1:], len(starts)] - 1
+    first_slot, last_slot = group_slot[city_starts], group_slot[city_ends]
+    sizes = last_slot - first_slot + 1
+    offsets = np.r_[0, np.cumsum(sizes)[:-1]]
+    total = int(sizes.sum())
+    grid_owner = np.repeat(np.arange(len(sizes)), sizes)
+    grid_slot = np.arange(total) - offsets[grid_owner] + first_slot[grid_owner]
+    group_owner = np.repeat(np.arange(len(sizes)), city_ends - city_starts + 1)
+    group_pos = offsets[group_owner] + group_slot - first_slot[group_owner]
+
+    names = np.array(batch.cities, dtype=object)
+    readings = np.zeros(total, dtype=np.int64)
+    readings[group_pos] = np.diff(np.r_[starts, len(order)])
+    result = {
+        "city": names[group_city[city_starts]][grid_owner],
+        "epoch": grid_slot * step,
+        "readings": readings,
+    }
+    slot_start = offsets[grid_owner]
+    slot_end = slot_start + sizes[grid_owner] - 1
+    for field in fields:
+        values = columns[field][order].astype(np.float64)
+        if field == "humidity":
+            values[columns["humidity"][order] == HUMIDITY_MISSING] = np.nan
+        grid = np.zeros(total) if agg == "count" else np.full(total, np.nan)
+        grid[group_pos] = _aggregate(values, group_ids, starts, len(starts), agg)
+        if fill and agg != "count":
+            result[f"{field}_filled"] = _fill(grid, slot_start, slot_end, fill, limit)
+        result[field] = grid
+    return result
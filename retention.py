@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Retention and Downsampling
+Keeps weather.db from growing forever with three tiers:
+- raw readings for RETENTION_RAW_DAYS         (weather_data)
+- hourly rollups for RETENTION_HOURLY_DAYS     (weather_hourly)
+- daily rollups for RETENTION_DAILY_DAYS       (weather_daily, None = forever)
+
+Compaction works in bounded batches, each in its own short transaction, so
+the cron ETL never waits long for the write lock. Freed pages are returned
+to the filesystem with incremental vacuum instead of a full VACUUM.
+"""
+
+import sys
+import time
+from datetime import datetime, timezone
+
+from settings import (DB_PATH, RETENTION_RAW_DAYS, RETENTION_HOURLY_DAYS, RETENTION_DAILY_DAYS,
+                      RETENTION_ARCHIVE_RAW, RETENTION_BATCH_ROWS, VACUUM_PAGES_PER_STEP, CHANGE_LOG_DAYS)
+from storage import ensure_schema, table_exists
+
+# Unix seconds of a stored ISO timestamp (handles +00:00 and fractional seconds)
+EPOCH_SQL = "CAST(strftime('%s', substr(timestamp, 1, 19)) AS INTEGER)"
+
+
+def raw_cutoff_epoch(now=None):
+    """
+    Readings older than this may already be rolled up and deleted, so they
+    must never be compared against or written back into weather_data
+    """
+    return int(time.time() if now is None else now) - RETENTION_RAW_DAYS * 86400
+
+
+def log_message(message):
+    """Add timestamp to all log messages"""
+    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {message}")
+
+
+def ensure_rollup_tables(conn):
+    """Create the hourly and daily rollup tables"""
+    for table, bucket in (("weather_hourly", "hour_epoch"), ("weather_daily", "day_epoch")):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                city TEXT NOT NULL,
+                {bucket} INTEGER NOT NULL,
+                weather TEXT NOT NULL DEFAULT '',
+                readings INTEGER NOT NULL,
+                temp_count INTEGER NOT NULL,
+                temp_sum REAL,
+                temp_min REAL,
+                temp_max REAL,
+                humidity_count INTEGER NOT NULL,
+                humidity_sum REAL,
+                PRIMARY KEY (city, {bucket}, weather)
+            )
+        """)
+    conn.commit()
+
+
+def rollup_upsert(target, bucket, bucket_expr, source, where):
+    """SQL that folds `source` rows matching `where` into a rollup table"""
+    if source == "weather_data":
+        measures = """
+            COUNT(*), COUNT(temp), SUM(temp), MIN(temp), MAX(temp),
+            COUNT(humidity), SUM(humidity)
+        """
+    else:
+        measures = """
+            SUM(readings), SUM(temp_count), SUM(temp_sum), MIN(temp_min), MAX(temp_max),
+            SUM(humidity_count), SUM(humidity_sum)
+        """
+    return f"""
+        INSERT INTO {target} (city, {bucket}, weather, readings, temp_count, temp_sum,
+                              temp_min, temp_max, humidity_count, humidity_sum)
+        SELECT city, {bucket_expr}, COALESCE(weather, ''), {measures}
+        FROM {source}
+        WHERE {where}
+        GROUP BY 1, 2, 3
+        ON CONFLICT (city, {bucket}, weather) DO UPDATE SET
+            readings = readings + excluded.readings,
+            temp_count = temp_count + excluded.temp_count,
+            temp_sum = COALESCE(temp_sum, 0) + COALESCE(excluded.temp_sum, 0),
+            temp_min = MIN(COALESCE(temp_min, excluded.temp_min), COALESCE(excluded.temp_min, temp_min)),
+            temp_max = MAX(COALESCE(temp_max, excluded.temp_max), COALESCE(excluded.temp_max, temp_max)),
+            humidity_count = humidity_count + excluded.humidity_count,
+            humidity_sum = COALESCE(humidity_sum, 0) + COALESCE(excluded.humidity_sum, 0)
+    """
+
+
+def compact_raw(conn, cutoff_epoch, batch_rows, pause=0.0, archive=RETENTION_ARCHIVE_RAW):
+    """
+    Roll raw rows older than the cutoff into weather_hourly, then remove them
+    (keeping a compressed copy in ts_blocks first when archive is set).
+    Rows without a city stay raw: the rollups are keyed by city
+    """
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS compact_batch (id INTEGER PRIMARY KEY)")
+    cutoff = datetime.fromtimestamp(cutoff_epoch, timezone.utc).replace(tzinfo=None).isoformat()
+    upsert = rollup_upsert("weather_hourly", "hour_epoch", f"{EPOCH_SQL} / 3600 * 3600",
+                           "weather_data", "id IN (SELECT id FROM compact_batch) AND city IS NOT NULL")
+    total = 0
+    while True:
+        with conn:
+            conn.execute("DELETE FROM compact_batch")
+            conn.execute("""
+                INSERT INTO compact_batch
+                SELECT id FROM weather_fact
+                WHERE timestamp < ? AND city_id IS NOT NULL
+                ORDER BY timestamp
+                LIMIT ?
+            """, (cutoff, batch_rows))
+            moved = conn.execute("SELECT COUNT(*) FROM compact_batch").fetchone()[0]
+            if moved == 0:
+                break
+            conn.execute(upsert)
+            if archive:
+                archive_batch(conn)
+            conn.execute("DELETE FROM weather_fact WHERE id IN (SELECT id FROM compact_batch)")
+        total += moved
+        # Give the ETL writer a chance to grab the lock between batches
+        time.sleep(pause)
+    return total
+
+
+def archive_batch(conn):
+    """Keep a compressed copy of the current batch in ts_blocks before deleting it"""
+    from timeseries_codec import ensure_block_table, write_blocks
+    from run_ledger import timestamp_to_epoch
+
+    ensure_block_table(conn)
+    rows = conn.execute("""
+        SELECT city, id, timestamp, temp, humidity, weather
+        FROM weather_data
+        WHERE id IN (SELECT id FROM compact_batch)
+          AND city IS NOT NULL AND timestamp IS NOT NULL AND temp IS NOT NULL
+          AND humidity IS NOT NULL AND weather IS NOT NULL
+    """).fetchall()
+    by_city = {}
+    for city, fact_id, ts, temp, humidity, weather in rows:
+        by_city.setdefault(city, []).append((timestamp_to_epoch(ts), fact_id, temp, humidity, weather))
+    for city, city_rows in by_city.items():
+        write_blocks(conn, city, city_rows)
+
+
+def compact_hourly(conn, cutoff_epoch, batch_rows, pause=0.0):
+    """Roll hourly rollups older than the cutoff into weather_daily, then remove them"""
+    upsert = rollup_upsert("weather_daily", "day_epoch", "hour_epoch / 86400 * 86400",
+                           "weather_hourly", "rowid IN (SELECT id FROM compact_batch)")
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS compact_batch (id INTEGER PRIMARY KEY)")
+    total = 0
+    while True:
+        with conn:
+            conn.execute("DELETE FROM compact_batch")
+            conn.execute("""
+                INSERT INTO compact_batch
+                SELECT rowid FROM weather_hourly WHERE hour_epoch < ? LIMIT ?
+            """, (cutoff_epoch, batch_rows))
+            moved = conn.execute("SELECT COUNT(*) FROM compact_batch").fetchone()[0]
+            if moved == 0:
+                break
+            conn.execute(upsert)
+            conn.execute("DELETE FROM weather_hourly WHERE rowid IN (SELECT id FROM compact_batch)")
+        total += moved
+        time.sleep(pause)
+    return total
+
+
+def expire_daily(conn, cutoff_epoch, batch_rows):
+    """Delete daily rollups (and daily quantile sketches and cached condition runs) older than the cutoff"""
+    total = 0
+    while True:
+        with conn:
+            deleted = conn.execute("""
+                DELETE FROM weather_daily WHERE rowid IN (
+                    SELECT rowid FROM weather_daily WHERE day_epoch < ? LIMIT ?
+                )
+            """, (cutoff_epoch, batch_rows)).rowcount
+            conn.execute("DELETE FROM sketch_daily WHERE day_epoch < ?", (cutoff_epoch,))
+            if table_exists(conn, "condition_runs"):
+                conn.execute("DELETE FROM condition_runs WHERE day_epoch < ?", (cutoff_epoch,))
+        total += deleted
+        if deleted < batch_rows:
+            return total
+
+
+def enable_incremental_vacuum(conn):
+    """
+    Switch the database to auto_vacuum=INCREMENTAL. Existing databases need
+    one full VACUUM for the change to take effect; after that it never runs again.
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+        return False
+    log_message("🧹 Enabling incremental vacuum (one-time full VACUUM)")
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+def incremental_vacuum(conn, pages_per_step, pause=0.0):
+    """Release free pages a few at a time so no single step holds the lock for long"""
+    released = 0
+    while True:
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if free == 0:
+            return released
+        conn.execute(f"PRAGMA incremental_vacuum({int(pages_per_step)})")
+        released += min(free, pages_per_step)
+        time.sleep(pause)
+
+
+def run_compaction(db_name=DB_PATH, batch_rows=RETENTION_BATCH_ROWS, pause=0.05):
+    """Apply every retention tier once"""
+    from changes import prune_changes
+    from sketches import compact_sketches
+
+    conn = ensure_schema(db_name)
+    ensure_rollup_tables(conn)
+    enable_incremental_vacuum(conn)
+    now = int(time.time())
+
+    raw = compact_raw(conn, raw_cutoff_epoch(now), batch_rows, pause)
+    log_message(f"📦 Rolled up {raw} raw readings older than {RETENTION_RAW_DAYS} days")
+
+    hourly = compact_hourly(conn, now - RETENTION_HOURLY_DAYS * 86400, batch_rows, pause)
+    log_message(f"📦 Rolled up {hourly} hourly rows older than {RETENTION_HOURLY_DAYS} days")
+
+    sketches = compact_sketches(conn, now - RETENTION_HOURLY_DAYS * 86400)
+    log_message(f"📦 Merged {sketches} hourly quantile sketches into daily ones")
+
+    pruned = prune_changes(conn, now - CHANGE_LOG_DAYS * 86400)
+    log_message(f"✂️ Pruned {pruned} change log entries older than {CHANGE_LOG_DAYS} days")
+
+    if RETENTION_DAILY_DAYS is not None:
+        daily = expire_daily(conn, now - RETENTION_DAILY_DAYS * 86400, batch_rows)
+        log_message(f"🗑️ Deleted {daily} daily rows older than {RETENTION_DAILY_DAYS} days")
+
+    pages = incremental_vacuum(conn, VACUUM_PAGES_PER_STEP, pause)
+    log_message(f"🧹 Released {pages} free pages")
+
+
+def run_compaction_all():
+    """Apply retention to weather.db and every shard"""
+    from sharding import database_paths
+    for db_name in database_paths():
+        log_message(f"🗄️ Compacting {db_name}")
+        run_compaction(db_name)
+
+
+def main():
+    if len(sys.argv) > 1:
+        run_compaction(sys.argv[1])
+    else:
+        run_compaction_all()
+
+
+if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        from profiling import profile_run
+        with profile_run("compact"):
+            main()
+    else:
+        main()
@@ -0,0 +1,161 @@
+"""
+ETL Run Ledger
+Records every ETL run in `etl_runs` and keeps a per-city `last_ingest` row,
+so freshness and "last update" checks are primary-key lookups instead of
+scans over weather_data.
+"""
+
+import os
+from datetime import datetime, timezone
+
+
+def utc_now():
+    """Current UTC time without microseconds"""
+    return datetime.now(timezone.utc).replace(microsecond=0)
+
+
+def new_run_id():
+    """Short random id shared by all ledger rows of one run"""
+    return os.urandom(6).hex()
+
+
+def timestamp_to_epoch(timestamp):
+    """Convert a stored ISO timestamp (with or without +00:00) to Unix seconds"""
+    dt = datetime.fromisoformat(timestamp)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def ensure_ledger_tables(conn):
+    """Create ledger tables and seed last_ingest from existing data once"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS etl_runs (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT NOT NULL,
+            city TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            duration_s REAL,
+            rows_written INTEGER DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'running',
+            message TEXT
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_etl_runs_started ON etl_runs (started_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS last_ingest (
+            city TEXT PRIMARY KEY,
+            last_timestamp TEXT NOT NULL,
+            last_epoch INTEGER NOT NULL,
+            rows_total INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT NOT NULL
+        )
+    """)
+
+    # Databases created before the ledger existed: seed it with one scan
+    has_rows = conn.execute("SELECT 1 FROM last_ingest LIMIT 1").fetchone()
+    has_data = conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'weather_data'"
+    ).fetchone()
+    if not has_rows and has_data:
+        seeded = conn.execute("""
+            SELECT city, MAX(timestamp), COUNT(*)
+            FROM weather_data
+            WHERE city IS NOT NULL AND timestamp IS NOT NULL
+            GROUP BY city
+        """).fetchall()
+        now = utc_now().isoformat()
+        conn.executemany("""
+            INSERT OR IGNORE INTO last_ingest (city, last_timestamp, last_epoch, rows_total, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(city, ts, timestamp_to_epoch(ts), count, now) for city, ts, count in seeded])
+    conn.commit()
+
+
+def start_run(conn, city, run_id=None):
+    """Open a ledger row for one city in a run. Returns (row id, run_id)"""
+    run_id = run_id or new_run_id()
+    cursor = conn.execute("""
+        INSERT INTO etl_runs (run_id, city, started_at, status)
+        VALUES (?, ?, ?, 'running')
+    """, (run_id, city, datetime.now(timezone.utc).isoformat()))
+    conn.commit()
+    return cursor.lastrowid, run_id
+
+
+def finish_run(conn, ledger_id, status, rows_written=0, message=None):
+    """Close a ledger row with its final status and duration"""
+    finished = datetime.now(timezone.utc)
+    started = conn.execute(
+        "SELECT started_at FROM etl_runs WHERE id = ?", (ledger_id,)
+    ).fetchone()
+    duration = None
+    if started:
+        duration = (finished - datetime.fromisoformat(started[0])).total_seconds()
+    conn.execute("""
+        UPDATE etl_runs
+        SET finished_at = ?, duration_s = ?, rows_written = ?, status = ?, message = ?
+        WHERE id = ?
+    """, (finished.isoformat(), duration, rows_written, status, message, ledger_id))
+    conn.commit()
+
+
+def record_ingest(conn, city, timestamp, rows=1):
+    """
+    Update last_ingest for a city. Call inside the same transaction as the
+    weather_data insert so the two never disagree.
+    """
+    conn.execute("""
+        INSERT INTO last_ingest (city, last_timestamp, last_epoch, rows_total, updated_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT(city) DO UPDATE SET
+            last_timestamp = CASE WHEN excluded.last_epoch >= last_ingest.last_epoch
+                                  THEN excluded.last_timestamp ELSE last_ingest.last_timestamp END,
+            last_epoch = MAX(excluded.last_epoch, last_ingest.last_epoch),
+            rows_total = last_ingest.rows_total + excluded.rows_total,
+            updated_at = excluded.updated_at
+    """, (city, timestamp, timestamp_to_epoch(timestamp), rows, utc_now().isoformat()))
+
+
+def get_last_ingest(conn, city=None):
+    """
+    Return (city, last_timestamp, last_epoch) for one city,
+    or for the most recently updated city when city is None
+    """
+    if city is not None:
+        return conn.execute("""
+            SELECT city, last_timestamp, last_epoch FROM last_ingest WHERE city = ?
+        """, (city,)).fetchone()
+    return conn.execute("""
+        SELECT city, last_timestamp, last_epoch FROM last_ingest
+        ORDER BY last_epoch DESC LIMIT 1
+    """).fetchone()
+
+
+def get_stale_cities(conn, max_age_minutes):
+    """Cities whose last write is older than max_age_minutes, with their age in minutes"""
+    now = utc_now().timestamp()
+    rows = conn.execute("""
+        SELECT city, (? - last_epoch) / 60.0 AS age_minutes
+        FROM last_ingest
+        WHERE last_epoch < ?
+        ORDER BY age_minutes DESC
+    """, (now, now - max_age_minutes * 60)).fetchall()
+    return rows
+
+
+def get_run_latency_trend(conn, days=7):
+    """Daily run count, average and worst duration, and failures for the last N days"""
+    return conn.execute("""
+        SELECT
+            DATE(started_at) as date,
+            COUNT(*) as runs,
+            AVG(duration_s) as avg_duration,
+            MAX(duration_s) as max_duration,
+            SUM(CASE WHEN status != 'success' THEN 1 ELSE 0 END) as failures
+        FROM etl_runs
+        WHERE started_at >= datetime('now', ?)
+        GROUP BY DATE(started_at)
+        ORDER BY date DESC
+    """, (f"-{int(days)} days",)).fetchall()
@@ -0,0 +1,117 @@
+"""
+Pipeline settings with sensible defaults
+Any value here can be overridden by defining the same name in config.py
+"""
+
+import os
+
+import config
+
+# Project root (/usr/local/weather-etl in production). Derived from this file's
+# location so cron, the CLI and imports from elsewhere all agree without sys.path tricks
+BASE_PATH = getattr(config, "BASE_PATH", os.path.dirname(os.path.abspath(__file__)))
+OUTPUT_DIR = os.path.join(BASE_PATH, "output")
+
+# Production database and raw CSV written by the ETL
+DB_PATH = getattr(config, "DB_PATH", os.path.join(OUTPUT_DIR, "weather.db"))
+CSV_PATH = getattr(config, "CSV_PATH", os.path.join(OUTPUT_DIR, "weather_data.csv"))
+
+# Sharded storage: spread weather_data over this many files in SHARD_DIR by city
+# hash so cities load in parallel (0 = everything in DB_PATH). At most 9, since
+# federated reads attach every shard to one connection
+SHARD_COUNT = getattr(config, "SHARD_COUNT", 0)
+SHARD_DIR = getattr(config, "SHARD_DIR", os.path.join(OUTPUT_DIR, "shards"))
+
+# Threads used to query shards concurrently
+QUERY_WORKERS = getattr(config, "QUERY_WORKERS", 4)
+
+# Reports written by --profile (one .txt/.json pair per entry point, plus the previous run's)
+PROFILE_DIR = getattr(config, "PROFILE_DIR", os.path.join(OUTPUT_DIR, "profiles"))
+
+# Per-city dashboards and the overview are written here, drawn by this many processes
+DASHBOARD_DIR = getattr(config, "DASHBOARD_DIR", os.path.join(OUTPUT_DIR, "dashboards"))
+DASHBOARD_WORKERS = getattr(config, "DASHBOARD_WORKERS", os.cpu_count() or 1)
+
+# Timezone used when showing timestamps on the dashboard (data is stored in UTC)
+LOCAL_TIMEZONE = getattr(config, "LOCAL_TIMEZONE", "Asia/Jerusalem")
+
+# A city counts as stale when its last successful write is older than this
+STALE_AFTER_MINUTES = getattr(config, "STALE_AFTER_MINUTES", 30)
+
+# Cities to collect. Defaults to the single CITY from config.py
+CITIES = getattr(config, "CITIES", [config.CITY])
+
+# Higher number = fetched earlier in each window. Cities not listed get 0
+CITY_PRIORITIES = getattr(config, "CITY_PRIORITIES", {})
+
+# OpenWeather quotas (free plan: 60 calls/minute, 1,000,000 calls/month)
+API_CALLS_PER_MINUTE = getattr(config, "API_CALLS_PER_MINUTE", 60)
+API_CALLS_PER_DAY = getattr(config, "API_CALLS_PER_DAY", 30000)
+
+# Length of one scheduling window (the cron interval) and number of extraction threads
+SCHEDULE_WINDOW_SECONDS = getattr(config, "SCHEDULE_WINDOW_SECONDS", 600)
+EXTRACT_WORKERS = getattr(config, "EXTRACT_WORKERS", 4)
+
+# Adaptive polling: each city's interval is learned within these bounds.
+# Keep POLL_MAX_SECONDS below the freshness SLA (STALE_AFTER_MINUTES)
+ADAPTIVE_POLLING = getattr(config, "ADAPTIVE_POLLING", True)
+POLL_MIN_SECONDS = getattr(config, "POLL_MIN_SECONDS", 300)
+POLL_MAX_SECONDS = getattr(config, "POLL_MAX_SECONDS", 1200)
+
+# Lease-based workers: cities are hashed into WORK_SHARDS shards, leases last
+# WORK_LEASE_SECONDS unless renewed, and each city is written at most once per
+# WORK_INTERVAL_SECONDS (the shortest adaptive poll interval)
+WORK_SHARDS = getattr(config, "WORK_SHARDS", 64)
+WORK_LEASE_SECONDS = getattr(config, "WORK_LEASE_SECONDS", 60)
+WORK_INTERVAL_SECONDS = getattr(config, "WORK_INTERVAL_SECONDS", POLL_MIN_SECONDS)
+
+# Two readings further apart than this leave a gap in a city's series.
+# Refills poll at most GAP_REFILL_MAX_CALLS cities per run (on top of the regular schedule)
+GAP_THRESHOLD_SECONDS = getattr(config, "GAP_THRESHOLD_SECONDS",
+                                2 * max(SCHEDULE_WINDOW_SECONDS, POLL_MAX_SECONDS))
+GAP_REFILL_MAX_CALLS = getattr(config, "GAP_REFILL_MAX_CALLS", 10)
+
+# Validation only rejects physically impossible temperatures (°C); anything
+# unusual but possible is scored by the streaming anomaly detector instead
+TEMP_MIN_POSSIBLE = getattr(config, "TEMP_MIN_POSSIBLE", -90)
+TEMP_MAX_POSSIBLE = getattr(config, "TEMP_MAX_POSSIBLE", 60)
+
+# A reading is an anomaly when its robust z-score for that city and hour of
+# day exceeds this, once the hour has at least ANOMALY_MIN_SAMPLES readings
+ANOMALY_Z_THRESHOLD = getattr(config, "ANOMALY_Z_THRESHOLD", 3.5)
+ANOMALY_MIN_SAMPLES = getattr(config, "ANOMALY_MIN_SAMPLES", 20)
+
+# Retention tiers: raw readings -> hourly rollups -> daily rollups (None = keep forever)
+RETENTION_RAW_DAYS = getattr(config, "RETENTION_RAW_DAYS", 30)
+RETENTION_HOURLY_DAYS = getattr(config, "RETENTION_HOURLY_DAYS", 365)
+RETENTION_DAILY_DAYS = getattr(config, "RETENTION_DAILY_DAYS", None)
+
+# Centroids per quantile sketch (t-digest); more = tighter percentiles, bigger sketches
+SKETCH_COMPRESSION = getattr(config, "SKETCH_COMPRESSION", 200)
+
+# Change feed: entries kept this many days, page size, and the directory where
+# listeners bind notification sockets (None = no notifications, consumers poll)
+CHANGE_LOG_DAYS = getattr(config, "CHANGE_LOG_DAYS", 7)
+CHANGES_PAGE_SIZE = getattr(config, "CHANGES_PAGE_SIZE", 1000)
+CHANGES_NOTIFY_DIR = getattr(config, "CHANGES_NOTIFY_DIR", None)
+
+# Also keep expired raw readings as compressed ts_blocks instead of dropping them
+RETENTION_ARCHIVE_RAW = getattr(config, "RETENTION_ARCHIVE_RAW", False)
+
+# Compaction batch size (rows per transaction) and pages released per vacuum step
+RETENTION_BATCH_ROWS = getattr(config, "RETENTION_BATCH_ROWS", 5000)
+VACUUM_PAGES_PER_STEP = getattr(config, "VACUUM_PAGES_PER_STEP", 256)
+
+# Cell size of the in-memory city grid used for region and nearest-city lookups
+SPATIAL_CELL_DEGREES = getattr(config, "SPATIAL_CELL_DEGREES", 1.0)
+
+# Days of readings the daemon and query API keep in memory per city (today's
+# summary, the 5-day trend and freshness are answered from there)
+HOT_WINDOW_DAYS = getattr(config, "HOT_WINDOW_DAYS", 5)
+
+# Local read-only query API
+QUERY_API_HOST = getattr(config, "QUERY_API_HOST", "127.0.0.1")
+QUERY_API_PORT = getattr(config, "QUERY_API_PORT", 8765)
+QUERY_CACHE_ENTRIES = getattr(config, "QUERY_CACHE_ENTRIES", 256)
+# Long-lived request threads; each keeps its read-only (federated) connections open
+QUERY_API_THREADS = getattr(config, "QUERY_API_THREADS", 8)
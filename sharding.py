@@ -0,0 +1,191 @@
+"""
+Per-City Shards
+Optional storage mode (SHARD_COUNT > 0) that spreads weather_data across
+several database files by a stable hash of the city name. SQLite allows one
+writer per file, so cities in different shards load in parallel.
+
+weather.db keeps everything that is not per-city history (run ledger, API
+quota, poll state). Readers get the shards back as one database:
+- federated_connection(): weather.db with every shard ATTACHed and TEMP views
+  named like the sharded tables, so existing SQL runs unchanged
+- fan_out(): run a function against every shard on a thread pool and merge
+"""
+
+import os
+import threading
+import zlib
+
+from settings import DB_PATH, SHARD_COUNT, SHARD_DIR, QUERY_WORKERS
+from storage import connect, get_connection, ensure_schema, table_exists
+
+# SQLite's default limit on ATTACHed databases per connection
+MAX_ATTACHED = 10
+
+# Tables that live in the shards; the federated connection unions each one
+SHARDED_TABLES = ["weather_data", "last_ingest", "weather_hourly", "weather_daily", "sketch_hourly", "sketch_daily",
+                  "condition_runs"]
+
+_local = threading.local()
+
+
+def _reset_after_fork():
+    global _local
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def sharding_enabled():
+    return SHARD_COUNT > 0
+
+
+def shard_index(city, shard_count=SHARD_COUNT):
+    """Stable shard number for a city (crc32, unlike hash(), is the same in every process)"""
+    return zlib.crc32(city.strip().lower().encode()) % shard_count
+
+
+def shard_path(index):
+    return os.path.join(SHARD_DIR, f"weather_{index:02d}.db")
+
+
+def city_db_path(city):
+    """Database file that holds this city's readings (weather.db for readings without a city)"""
+    if not sharding_enabled() or city is None:
+        return DB_PATH
+    return shard_path(shard_index(city))
+
+
+def existing_shards():
+    """Shard files created so far"""
+    if not sharding_enabled():
+        return []
+    return [path for path in map(shard_path, range(SHARD_COUNT)) if os.path.exists(path)]
+
+
+def database_paths():
+    """Every database file that can hold readings (weather.db first)"""
+    return [DB_PATH] + existing_shards()
+
+
+def fan_out(query, paths=None, workers=QUERY_WORKERS):
+    """
+    Call query(conn) on each database with its own read-only connection and
+    return the results in path order. Shards are queried concurrently
+    (sqlite3 releases the GIL while a statement runs).
+    """
+    paths = paths or database_paths()
+    if len(paths) == 1:
+        return [query(get_connection(paths[0], readonly=True))]
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=min(workers, len(paths))) as pool:
+        return list(pool.map(lambda path: query(get_connection(path, readonly=True)), paths))
+
+
+def _table_columns(conn, schema, table):
+    return [row[1] for row in conn.execute(f"PRAGMA {schema}.table_info({table})")]
+
+
+def _create_federated_views(conn, schemas):
+    for table in SHARDED_TABLES:
+        sources = [s for s in schemas if _table_columns(conn, s, table)]
+        if not sources:
+            continue
+        columns = ", ".join(_table_columns(conn, sources[0], table))
+        union = " UNION ALL ".join(f"SELECT {columns} FROM {s}.{table}" for s in sources)
+        if table == "last_ingest":
+            # A city written before sharding was enabled has a row in weather.db too
+            union = f"""
+                SELECT city, last_timestamp, MAX(last_epoch) AS last_epoch,
+                       SUM(rows_total) AS rows_total, MAX(updated_at) AS updated_at
+                FROM ({union}) GROUP BY city
+            """
+        conn.execute(f"CREATE TEMP VIEW {table} AS {union}")
+
+
+def federated_connection(db_name=DB_PATH):
+    """
+    Read-only connection where weather_data, last_ingest and the rollups
+    cover every shard (plus rows written to weather.db before sharding).
+    Without sharding this is just the pooled read-only connection.
+    """
+    if not sharding_enabled():
+        return get_connection(db_name, readonly=True)
+    if SHARD_COUNT >= MAX_ATTACHED:
+        raise ValueError(f"SHARD_COUNT must be below {MAX_ATTACHED} for federated queries")
+
+    federated = getattr(_local, "federated", None)
+    if federated is None:
+        federated = _local.federated = {}
+    shards = tuple(existing_shards())
+    key = os.path.abspath(db_name)
+    cached = federated.get(key)
+    if cached is not None and cached[0] == shards:
+        return cached[1]
+    if cached is not None:
+        # A new shard appeared since this connection was built
+        cached[1].close()
+
+    conn = connect(db_name, readonly=True)
+    schemas = ["main"]
+    for index, path in enumerate(shards):
+        conn.execute(f"ATTACH DATABASE ? AS shard{index}", (f"file:{path}?mode=ro",))
+        schemas.append(f"shard{index}")
+    _create_federated_views(conn, schemas)
+    federated[key] = (shards, conn)
+    return conn
+
+
+def migrate_to_shards(db_name=DB_PATH, batch_size=5000):
+    """
+    Move existing weather_data rows from weather.db into their city's shard.
+    Rows without a city can't be routed to a shard; they stay in weather.db,
+    which federated queries read alongside the shards
+    """
+    from dimensions import get_interner, INSERT_WEATHER_FACT_SQL
+    from run_ledger import record_ingest
+    from sketches import move_sketches
+    from transitions import ensure_transition_tables, move_condition_runs
+
+    if not sharding_enabled():
+        raise ValueError("Set SHARD_COUNT in config.py before migrating")
+    source = ensure_schema(db_name)
+    cities = [city for (city,) in source.execute("SELECT DISTINCT city FROM weather_data WHERE city IS NOT NULL")]
+    moved = 0
+    for city in cities:
+        target_name = city_db_path(city)
+        target = ensure_schema(target_name)
+        rows = source.execute(
+            "SELECT timestamp, city, temp, humidity, weather FROM weather_data WHERE city = ? ORDER BY timestamp",
+            (city,),
+        ).fetchall()
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            fact_rows = get_interner(target_name).fact_rows(target, batch)
+            # Copy first, delete second: a crash in between leaves duplicates, never a loss
+            with target:
+                target.executemany(INSERT_WEATHER_FACT_SQL, fact_rows)
+                record_ingest(target, city, batch[-1][0], rows=len(batch))
+        with source:
+            source.execute("""
+                DELETE FROM weather_fact WHERE city_id = (SELECT id FROM dim_city WHERE name = ?)
+            """, (city,))
+            source.execute("DELETE FROM last_ingest WHERE city = ?", (city,))
+        if table_exists(source, "condition_runs"):
+            ensure_transition_tables(target)
+        # Target commits first (inner context), then the source drops its copy
+        with source, target:
+            move_sketches(source, target, city)
+            if table_exists(source, "condition_runs"):
+                move_condition_runs(source, target, city)
+        moved += len(rows)
+    return moved
+
+
+if __name__ == "__main__":
+    moved = migrate_to_shards()
+    print(f"✅ Moved {moved} rows into {SHARD_COUNT} shards under {SHARD_DIR}")
+    kept = ensure_schema(DB_PATH).execute("SELECT COUNT(*) FROM weather_data WHERE city IS NULL").fetchone()[0]
+    if kept:
+        print(f"   {kept} rows without a city stay in {DB_PATH}")
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+Mergeable Quantile Sketches
+SQLite has no percentile functions, so medians and p95s would mean pulling
+every reading into Python. Instead each (city, hour) keeps a small t-digest
+per measure, updated in the same transaction that inserts the readings:
+
+    sketch_hourly  (city, hour_epoch, temp, humidity)   recent hours
+    sketch_daily   (city, day_epoch, temp, humidity)    older hours, merged per day
+
+A digest is a sorted list of centroids (mean, weight) plus the exact min and
+max. Digests merge by pooling centroids and recompressing, so a percentile
+over any window and any set of cities is answered from the sketches alone,
+long after retention has dropped the raw readings.
+
+An hour holds a few readings, well under SKETCH_COMPRESSION centroids, so
+hourly digests are exact and ingest stays pure Python; NumPy is only loaded
+to compress large merges (daily rollups and queries).
+"""
+
+import bisect
+import json
+import math
+import sys
+import time
+from array import array
+
+from retention import EPOCH_SQL
+from settings import DB_PATH, SKETCH_COMPRESSION
+
+MEASURES = ("temp", "humidity")
+
+
+class QuantileSketch:
+    """t-digest over one measure; see the module docstring"""
+
+    __slots__ = ("means", "weights", "low", "high")
+
+    def __init__(self):
+        self.means = array("f")
+        self.weights = array("f")
+        self.low = math.inf
+        self.high = -math.inf
+
+    @classmethod
+    def from_bytes(cls, blob):
+        sketch = cls()
+        if blob:
+            values = array("f")
+            values.frombytes(blob)
+            centroids = (len(values) - 2) // 2
+            sketch.low, sketch.high = values[0], values[1]
+            sketch.means = values[2:2 + centroids]
+            sketch.weights = values[2 + centroids:]
+        return sketch
+
+    def to_bytes(self):
+        if not self.means:
+            return None
+        return (array("f", (self.low, self.high)) + self.means + self.weights).tobytes()
+
+    @property
+    def count(self):
+        return sum(self.weights)
+
+    def add(self, value, compression=SKETCH_COMPRESSION):
+        """Add one value (None and NaN are ignored)"""
+        if value is None or value != value:
+            return
+        index = bisect.bisect_right(self.means, value)
+        self.means.insert(index, value)
+        self.weights.insert(index, 1.0)
+        self.low = min(self.low, value)
+        self.high = max(self.high, value)
+        if len(self.means) > compression:
+            self.compress(compression)
+
+    def compress(self, compression=SKETCH_COMPRESSION):
+        """
+        Merge neighbouring centroids so each spans at most one unit of the
+        k1 scale (k = compression / 2pi * asin(2q - 1)): centroids stay small
+        near the tails, where precision matters for p1/p99
+        """
+        import numpy as np
+
+        means = np.asarray(self.means, dtype=np.float64)
+        weights = np.asarray(self.weights, dtype=np.float64)
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        q = (np.cumsum(weights) - weights / 2) / weights.sum()
+        k = np.floor(compression / (2 * math.pi) * np.arcsin(2 * q - 1))
+        new_group = np.r_[True, k[1:] != k[:-1]]
+        groups = np.cumsum(new_group) - 1
+        merged_weights = np.bincount(groups, weights=weights)
+        self.means = array("f", np.bincount(groups, weights=weights * means) / merged_weights)
+        self.weights = array("f", merged_weights)
+
+    @classmethod
+    def merged(cls, sketches, compression=SKETCH_COMPRESSION):
+        """One sketch covering all the given sketches"""
+        result = cls()
+        for sketch in sketches:
+            result.means += sketch.means
+            result.weights += sketch.weights
+            result.low = min(result.low, sketch.low)
+            result.high = max(result.high, sketch.high)
+        if len(result.means) > compression:
+            result.compress(compression)
+        elif result.means:
+            order = sorted(range(len(result.means)), key=result.means.__getitem__)
+            result.means = array("f", (result.means[i] for i in order))
+            result.weights = array("f", (result.weights[i] for i in order))
+        return result
+
+    def quantiles(self, qs):
+        """Estimated values at the given quantiles (0..1), interpolating between centroid centres"""
+        import numpy as np
+
+        if not self.means:
+            return [None] * len(qs)
+        weights = np.asarray(self.weights, dtype=np.float64)
+        total = weights.sum()
+        centres = np.cumsum(weights) - weights / 2
+        positions = np.r_[0.0, centres, total]
+        values = np.r_[self.low, np.asarray(self.means, dtype=np.float64), self.high]
+        return [float(v) for v in np.interp(np.asarray(qs, dtype=np.float64) * total, positions, values)]
+
+
+def ensure_sketch_tables(conn):
+    """Create the sketch tables and seed them from existing readings once"""
+    for table, bucket in (("sketch_hourly", "hour_epoch"), ("sketch_daily", "day_epoch")):
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                city TEXT NOT NULL,
+                {bucket} INTEGER NOT NULL,
+                temp BLOB,
+                humidity BLOB,
+                PRIMARY KEY (city, {bucket})
+            ) WITHOUT ROWID
+        """)
+
+    # Databases that have readings but no sketches yet: build them with one scan
+    has_sketches = conn.execute(
+        "SELECT 1 FROM sketch_hourly UNION ALL SELECT 1 FROM sketch_daily LIMIT 1"
+    ).fetchone()
+    if not has_sketches:
+        from weather_batch import WeatherBatch
+
+        batch = WeatherBatch.from_rows(conn.execute(f"""
+            SELECT {EPOCH_SQL}, city, temp, humidity, NULL FROM weather_data
+            WHERE city IS NOT NULL AND timestamp IS NOT NULL
+        """))
+        update_sketches(conn, batch)
+    conn.commit()
+
+
+def update_sketches(conn, batch):
+    """Fold a WeatherBatch into the hourly sketches (inside the caller's transaction)"""
+    hours = {}
+    for i, (epoch, city) in enumerate(zip(batch.epochs, batch.city_codes)):
+        if city >= 0:
+            hours.setdefault((batch.cities[city], epoch // 3600 * 3600), []).append(i)
+    for (city, hour), rows in hours.items():
+        stored = conn.execute(
+            "SELECT temp, humidity FROM sketch_hourly WHERE city = ? AND hour_epoch = ?", (city, hour)
+        ).fetchone() or (None, None)
+        temp, humidity = (QuantileSketch.from_bytes(blob) for blob in stored)
+        for i in rows:
+            temp.add(batch.temp(i))
+            humidity.add(batch.humidity_at(i))
+        conn.execute("""
+            INSERT INTO sketch_hourly (city, hour_epoch, temp, humidity) VALUES (?, ?, ?, ?)
+            ON CONFLICT (city, hour_epoch) DO UPDATE SET temp = excluded.temp, humidity = excluded.humidity
+        """, (city, hour, temp.to_bytes(), humidity.to_bytes()))
+
+
+def compact_sketches(conn, cutoff_epoch):
+    """Merge hourly sketches older than the cutoff into daily ones, then remove them"""
+    days = {}
+    with conn:
+        for city, hour, temp, humidity in conn.execute("""
+            SELECT city, hour_epoch, temp, humidity FROM sketch_hourly WHERE hour_epoch < ?
+            UNION ALL
+            SELECT city, day_epoch, temp, humidity FROM sketch_daily
+            WHERE day_epoch IN (SELECT DISTINCT hour_epoch / 86400 * 86400 FROM sketch_hourly
+                                WHERE hour_epoch < ?)
+        """, (cutoff_epoch, cutoff_epoch)):
+            parts = days.setdefault((city, hour // 86400 * 86400), ([], []))
+            parts[0].append(QuantileSketch.from_bytes(temp))
+            parts[1].append(QuantileSketch.from_bytes(humidity))
+        conn.executemany("""
+            INSERT OR REPLACE INTO sketch_daily (city, day_epoch, temp, humidity) VALUES (?, ?, ?, ?)
+        """, [(city, day, QuantileSketch.merged(temps).to_bytes(), QuantileSketch.merged(humidities).to_bytes())
+              for (city, day), (temps, humidities) in days.items()])
+        moved = conn.execute("DELETE FROM sketch_hourly WHERE hour_epoch < ?", (cutoff_epoch,)).rowcount
+    return moved
+
+
+def move_sketches(source, target, city):
+    """Move one city's sketches to another database, merging with any it has (for shard migration)"""
+    for table, bucket in (("sketch_hourly", "hour_epoch"), ("sketch_daily", "day_epoch")):
+        moved = []
+        for key, temp, humidity in source.execute(
+            f"SELECT {bucket}, temp, humidity FROM {table} WHERE city = ?", (city,)
+        ).fetchall():
+            existing = target.execute(
+                f"SELECT temp, humidity FROM {table} WHERE city = ? AND {bucket} = ?", (city, key)
+            ).fetchone() or (None, None)
+            moved.append((city, key) + tuple(
+                QuantileSketch.merged([QuantileSketch.from_bytes(ours), QuantileSketch.from_bytes(theirs)]).to_bytes()
+                for ours, theirs in zip((temp, humidity), existing)
+            ))
+        target.executemany(f"INSERT OR REPLACE INTO {table} VALUES (?, ?, ?, ?)", moved)
+        source.execute(f"DELETE FROM {table} WHERE city = ?", (city,))
+
+
+def window_sketches(conn, measure="temp", cities=None, start_epoch=None, end_epoch=None):
+    """
+    {city: QuantileSketch} for [start_epoch, end_epoch). Hourly sketches are
+    selected by hour, daily ones by the day they start
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"Unknown measure {measure!r} (use {', '.join(MEASURES)})")
+    filters = "AND bucket >= ? AND bucket < ?"
+    params = [start_epoch if start_epoch is not None else -2 ** 62,
+              end_epoch if end_epoch is not None else 2 ** 62]
+    if cities:
+        filters += " AND city IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(cities)))
+    parts = {}
+    for city, blob in conn.execute(f"""
+        SELECT city, {measure} FROM (
+            SELECT city, hour_epoch AS bucket, {measure} FROM sketch_hourly
+            UNION ALL
+            SELECT city, day_epoch, {measure} FROM sketch_daily
+        ) WHERE {measure} IS NOT NULL {filters}
+    """, params):
+        parts.setdefault(city, []).append(QuantileSketch.from_bytes(blob))
+    return {city: QuantileSketch.merged(sketches) for city, sketches in sorted(parts.items())}
+
+
+def percentiles(conn, quantiles=(0.5, 0.95), measure="temp", cities=None, start_epoch=None, end_epoch=None):
+    """[(city, readings, [value per quantile]), ...] plus an "All cities" row when there are several"""
+    sketches = window_sketches(conn, measure, cities, start_epoch, end_epoch)
+    rows = [(city, int(sketch.count), sketch.quantiles(quantiles)) for city, sketch in sketches.items()]
+    if len(sketches) > 1:
+        overall = QuantileSketch.merged(sketches.values())
+        rows.append(("All cities", int(overall.count), overall.quantiles(quantiles)))
+    return rows
+
+
+def print_percentiles(rows, quantiles=(0.5, 0.95), measure="temp"):
+    unit = "°C" if measure == "temp" else "%"
+    labels = ", ".join(f"p{q * 100:g}" for q in quantiles)
+    print(f"=== {measure.upper()} PERCENTILES ({labels}) ===")
+    if not rows:
+        print("   No sketches yet")
+    for city, count, values in rows:
+        shown = ", ".join(f"{value:.1f}{unit}" for value in values)
+        print(f"   {city}: {shown} ({count} readings)")
+
+
+if __name__ == "__main__":
+    from sharding import federated_connection
+    from storage import ensure_schema
+
+    ensure_schema(DB_PATH)
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    start = int(time.time()) - days * 86400 if days else None
+    print_percentiles(percentiles(federated_connection(), start_epoch=start))
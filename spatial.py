@@ -0,0 +1,229 @@
+"""
+Spatial Index over City Coordinates
+An in-memory lat/lon grid of every city in dim_city (coordinates come from
+the API's `coord` block), for bounding-box and nearest-city lookups without
+touching SQLite. The index is built once and refreshed incrementally: a
+refresh only re-reads dim_city when PRAGMA data_version says a database
+changed, and only moves the cities whose coordinates changed.
+
+Region aggregates are pushed down to SQL: one GROUP BY over the raw readings
+and the hourly/daily rollups for just the cities in the box.
+"""
+
+import json
+import math
+import threading
+from datetime import datetime, timezone
+
+from settings import DB_PATH, SPATIAL_CELL_DEGREES
+from storage import connect, table_exists
+
+KM_PER_DEGREE = 111.195
+EARTH_RADIUS_KM = 6371.0
+HALF_CIRCUMFERENCE_KM = math.pi * EARTH_RADIUS_KM
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres"""
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+class CityGrid:
+    """Uniform lat/lon grid: row -> {col: cities}, plus city -> (lat, lon)"""
+
+    def __init__(self, cell_degrees=SPATIAL_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.rows = int(math.ceil(180 / cell_degrees))
+        self.cols = int(math.ceil(360 / cell_degrees))
+        self.cells = {}
+        self.points = {}
+
+    def __len__(self):
+        return len(self.points)
+
+    def _cell(self, lat, lon):
+        row = min(int((lat + 90) // self.cell_degrees), self.rows - 1)
+        col = int(((lon + 180) % 360) // self.cell_degrees)
+        return row, col
+
+    def upsert(self, city, lat, lon):
+        """Add a city or move it to new coordinates"""
+        old = self.points.get(city)
+        if old == (lat, lon):
+            return False
+        if old is not None:
+            self.remove(city)
+        self.points[city] = (lat, lon)
+        row, col = self._cell(lat, lon)
+        self.cells.setdefault(row, {}).setdefault(col, []).append(city)
+        return True
+
+    def remove(self, city):
+        row, col = self._cell(*self.points.pop(city))
+        self.cells[row][col].remove(city)
+        if not self.cells[row][col]:
+            del self.cells[row][col]
+            if not self.cells[row]:
+                del self.cells[row]
+
+    def within(self, min_lat, min_lon, max_lat, max_lon):
+        """
+        Cities inside the box. min_lon > max_lon means the box crosses the
+        antimeridian (e.g. 170 .. -170).
+        """
+        if min_lon > max_lon:
+            return (self.within(min_lat, min_lon, max_lat, 180.0)
+                    + self.within(min_lat, -180.0, max_lat, max_lon))
+        row_lo, col_lo = self._cell(max(min_lat, -90.0), min_lon)
+        row_hi = self._cell(min(max_lat, 90.0), min_lon)[0]
+        col_hi = self._cell(min_lat, max_lon)[1] if max_lon < 180 else self.cols - 1
+
+        candidates = []
+        width = col_hi - col_lo + 1
+        for row in range(row_lo, row_hi + 1):
+            cols = self.cells.get(row)
+            if not cols:
+                continue
+            # Sparse rows: walk the occupied cells instead of every column in the box
+            if len(cols) < width:
+                for col, cities in cols.items():
+                    if col_lo <= col <= col_hi:
+                        candidates.extend(cities)
+            else:
+                for col in range(col_lo, col_hi + 1):
+                    candidates.extend(cols.get(col, ()))
+        return [city for city in candidates
+                if min_lat <= self.points[city][0] <= max_lat
+                and min_lon <= self.points[city][1] <= max_lon]
+
+    def nearest(self, lat, lon, k=1):
+        """
+        The k closest cities as [(distance_km, city), ...]. Searches a box of
+        growing radius; every city within radius r lies inside the box
+        built for r, so the first radius that yields k hits is exact.
+        """
+        if not self.points:
+            return []
+        # Start a little beyond the radius that holds k cities if they were spread evenly
+        radius = max(self.cell_degrees * KM_PER_DEGREE,
+                     3 * EARTH_RADIUS_KM * math.sqrt(k / len(self.points)))
+        while True:
+            dlat = radius / KM_PER_DEGREE
+            cos_lat = math.cos(math.radians(min(abs(lat) + dlat, 90.0)))
+            if cos_lat < 1e-9 or dlat / cos_lat >= 180:
+                min_lon, max_lon = -180.0, 180.0
+            else:
+                dlon = dlat / cos_lat
+                min_lon = (lon - dlon + 180) % 360 - 180
+                max_lon = (lon + dlon + 180) % 360 - 180
+            found = sorted(
+                (haversine_km(lat, lon, *self.points[city]), city)
+                for city in self.within(lat - dlat, min_lon, lat + dlat, max_lon)
+            )
+            hits = [item for item in found if item[0] <= radius]
+            if len(hits) >= k or radius >= HALF_CIRCUMFERENCE_KM:
+                return hits[:k] if len(hits) >= k else found[:k]
+            radius *= 2
+
+
+class SpatialIndex:
+    """CityGrid kept in sync with dim_city in weather.db and every shard"""
+
+    def __init__(self, db_name=DB_PATH, cell_degrees=SPATIAL_CELL_DEGREES):
+        self.db_name = db_name
+        self.grid = CityGrid(cell_degrees)
+        self.conns = {}
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        """Apply coordinate changes from any database that changed since the last refresh"""
+        from sharding import database_paths
+
+        moved = 0
+        with self.lock:
+            for path in [self.db_name] + database_paths()[1:]:
+                conn = self.conns.get(path)
+                if conn is None:
+                    conn = self.conns[path] = connect(path, readonly=True, check_same_thread=False)
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if self.versions.get(path) == version:
+                    continue
+                self.versions[path] = version
+                if not table_exists(conn, "dim_city"):
+                    continue
+                for city, lat, lon in conn.execute(
+                    "SELECT name, lat, lon FROM dim_city WHERE lat IS NOT NULL AND lon IS NOT NULL"
+                ):
+                    moved += self.grid.upsert(city, lat, lon)
+        return moved
+
+    def within(self, min_lat, min_lon, max_lat, max_lon):
+        self.refresh()
+        return self.grid.within(min_lat, min_lon, max_lat, max_lon)
+
+    def nearest(self, lat, lon, k=1):
+        self.refresh()
+        return [(distance, city, *self.grid.points[city])
+                for distance, city in self.grid.nearest(lat, lon, k)]
+
+
+def get_index(db_name=DB_PATH):
+    """The process-wide SpatialIndex for a database (built on first use)"""
+    index = _indexes.get(db_name)
+    if index is None:
+        with _indexes_lock:
+            index = _indexes.get(db_name)
+            if index is None:
+                index = _indexes[db_name] = SpatialIndex(db_name)
+    return index
+
+
+def _iso(epoch, default):
+    if epoch is None:
+        return default
+    return datetime.fromtimestamp(epoch, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def region_summary(conn, cities, start_epoch, end_epoch):
+    """
+    Per-city aggregates for [start_epoch, end_epoch) from raw readings and the
+    rollup tables, computed in SQL (None = unbounded). Returns
+    [(city, readings, temp_count, temp_sum, temp_min, temp_max, humidity_count, humidity_sum)].
+    """
+    if not cities:
+        return []
+    names = json.dumps(sorted(cities))
+    parts = ["""
+        SELECT city, COUNT(*) AS readings, COUNT(temp) AS temp_count, SUM(temp) AS temp_sum,
+               MIN(temp) AS temp_min, MAX(temp) AS temp_max,
+               COUNT(humidity) AS humidity_count, SUM(humidity) AS humidity_sum
+        FROM weather_data
+        WHERE city IN (SELECT value FROM json_each(:cities))
+          AND timestamp >= :start_iso AND timestamp < :end_iso
+        GROUP BY city
+    """]
+    for table, bucket in (("weather_hourly", "hour_epoch"), ("weather_daily", "day_epoch")):
+        if table_exists(conn, table):
+            parts.append(f"""
+                SELECT city, SUM(readings), SUM(temp_count), SUM(temp_sum),
+                       MIN(temp_min), MAX(temp_max), SUM(humidity_count), SUM(humidity_sum)
+                FROM {table}
+                WHERE city IN (SELECT value FROM json_each(:cities))
+                  AND {bucket} >= COALESCE(:start, {bucket}) AND {bucket} < COALESCE(:end, {bucket} + 1)
+                GROUP BY city
+            """)
+    return conn.execute(f"""
+        SELECT city, SUM(readings), SUM(temp_count), SUM(temp_sum), MIN(temp_min), MAX(temp_max),
+               SUM(humidity_count), SUM(humidity_sum)
+        FROM ({" UNION ALL ".join(parts)})
+        GROUP BY city
+        ORDER BY city
+    """, {"cities": names, "start": start_epoch, "end": end_epoch,
+          "start_iso": _iso(start_epoch, ""), "end_iso": _iso(end_epoch, "9999")}).fetchall()
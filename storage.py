@@ -0,0 +1,147 @@
+"""
+Shared SQLite Access
+Every module gets its connections from here instead of calling sqlite3.connect
+with its own path and settings:
+- one pooled connection per thread, per database, per mode (read-write / read-only)
+- standard PRAGMAs: WAL, synchronous=NORMAL, mmap, page cache, busy timeout
+- a larger per-connection statement cache, so repeated queries skip re-preparing
+- read-only connections for dashboards and analytics, which never block the writer in WAL mode
+
+Pooled connections live for the whole thread: callers must not close them.
+A forked child starts with an empty pool (SQLite handles must not cross a fork).
+"""
+
+import os
+import sqlite3
+import threading
+
+from settings import DB_PATH
+
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 64 * 1024
+MMAP_SIZE = 256 * 1024 * 1024
+STATEMENT_CACHE = 256
+
+_local = threading.local()
+_schema_ready = set()
+_schema_lock = threading.Lock()
+
+# Called with every new connection (profiling installs its SQL timers this way)
+_connect_hooks = []
+
+# Class of new connections (profiling swaps in one that times each statement)
+connection_factory = sqlite3.Connection
+
+
+def apply_pragmas(conn, readonly=False):
+    """Standard per-connection settings"""
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+    conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    conn.execute("PRAGMA temp_store = MEMORY")
+    if not readonly:
+        # WAL is stored in the database file, so setting it once is enough;
+        # repeating it on an already-WAL database is a no-op
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+
+
+def connect(db_name=DB_PATH, readonly=False, check_same_thread=True):
+    """Open a new, unpooled connection with the standard settings"""
+    if readonly:
+        conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True, factory=connection_factory,
+                               cached_statements=STATEMENT_CACHE,
+                               check_same_thread=check_same_thread)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(db_name)), exist_ok=True)
+        conn = sqlite3.connect(db_name, factory=connection_factory, cached_statements=STATEMENT_CACHE,
+                               check_same_thread=check_same_thread)
+    apply_pragmas(conn, readonly)
+    for hook in _connect_hooks:
+        hook(conn)
+    return conn
+
+
+def add_connect_hook(hook):
+    """Call hook(conn) for every connection opened from now on, and for this thread's pooled ones"""
+    _connect_hooks.append(hook)
+    for conn in getattr(_local, "pool", {}).values():
+        hook(conn)
+
+
+def remove_connect_hook(hook):
+    _connect_hooks.remove(hook)
+
+
+def get_connection(db_name=DB_PATH, readonly=False):
+    """This thread's pooled connection for db_name (do not close it)"""
+    pool = getattr(_local, "pool", None)
+    if pool is None:
+        pool = _local.pool = {}
+    key = (os.path.abspath(db_name), readonly)
+    conn = pool.get(key)
+    if conn is None:
+        conn = pool[key] = connect(db_name, readonly)
+    return conn
+
+
+def _reset_after_fork():
+    global _local
+    _local = threading.local()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def close_all():
+    """Close this thread's pooled connections (e.g. before a worker thread exits)"""
+    pool = getattr(_local, "pool", {})
+    for conn in pool.values():
+        conn.close()
+    pool.clear()
+
+
+def table_exists(conn, name):
+    """True if a table or view exists (including the TEMP views of a federated connection)"""
+    return conn.execute("""
+        SELECT 1 FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?
+        UNION ALL
+        SELECT 1 FROM sqlite_temp_master WHERE type = 'view' AND name = ?
+    """, (name, name)).fetchone() is not None
+
+
+def count_duplicate_readings(conn, city=None):
+    """Readings that repeat another reading's (city, timestamp), for one city or all of them"""
+    return conn.execute(f"""
+        SELECT COALESCE(SUM(readings - 1), 0) FROM (
+            SELECT COUNT(*) AS readings FROM weather_data
+            {"WHERE city = ?" if city else ""}
+            GROUP BY city, timestamp
+        )
+    """, (city,) if city else ()).fetchone()[0]
+
+
+def ensure_schema(db_name=DB_PATH):
+    """
+    Create the star schema (weather_data view over weather_fact and its
+    dimensions), the run ledger, quantile sketches and change log, once per
+    process per database.
+    Returns this thread's read-write connection.
+    """
+    from dimensions import ensure_star_schema
+    from changes import ensure_change_log
+    from run_ledger import ensure_ledger_tables
+    from sketches import ensure_sketch_tables
+
+    conn = get_connection(db_name)
+    key = os.path.abspath(db_name)
+    if key in _schema_ready:
+        return conn
+    with _schema_lock:
+        if key not in _schema_ready:
+            ensure_star_schema(conn)
+            ensure_ledger_tables(conn)
+            ensure_sketch_tables(conn)
+            ensure_change_log(conn)
+            _schema_ready.add(key)
+    return conn
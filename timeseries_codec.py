@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""
+Compact Time-Series Blocks for Cold Data
+Moves old weather_data rows into compressed per-city blocks (`ts_blocks`):
+- timestamps: delta-of-delta, zigzag varints (regular 10-minute data is ~1 byte/row)
+- temperature: delta of centi-degrees when exact, otherwise XOR of float64 bits
+- humidity and weather condition: run-length encoded
+Each block row stores its city and time range, so the (city, start, end)
+index is the block index used for time-range seeks.
+"""
+
+import struct
+import sys
+import time
+
+import numpy as np
+
+MAGIC = b"WTS1"
+TEMP_SCALED = 0
+TEMP_XOR = 1
+DEFAULT_BLOCK_ROWS = 1024
+
+
+# --- varint helpers -------------------------------------------------------
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def read_varint(buf, pos):
+    result = shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def read_varints(buf, pos, n):
+    """
+    n consecutive varints starting at pos, decoded with array operations
+    instead of a Python loop per value. Returns (uint64 array, next position)
+    """
+    if n == 0:
+        return np.empty(0, dtype=np.uint64), pos
+    data = np.frombuffer(buf, dtype=np.uint8, offset=pos)[:n * 10]
+    # A byte below 0x80 ends a varint; each byte holds 7 bits, least significant group first
+    ends = np.flatnonzero(data < 0x80)[:n]
+    if len(ends) < n:
+        raise ValueError("Truncated weather time-series block")
+    stop = int(ends[-1]) + 1
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 7 * (np.arange(stop) - np.repeat(starts, ends - starts + 1))
+    groups = (data[:stop] & 0x7F).astype(np.uint64) << shifts.astype(np.uint64)
+    return np.add.reduceat(groups, starts), pos + stop
+
+
+def unzigzag_array(values):
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def write_string(out, text):
+    data = text.encode("utf-8")
+    write_varint(out, len(data))
+    out.extend(data)
+
+
+def read_string(buf, pos):
+    length, pos = read_varint(buf, pos)
+    return bytes(buf[pos:pos + length]).decode("utf-8"), pos + length
+
+
+def run_lengths(values):
+    """Collapse a sequence into [(value, run_length), ...]"""
+    runs = []
+    for value in values:
+        if runs and runs[-1][0] == value:
+            runs[-1][1] += 1
+        else:
+            runs.append([value, 1])
+    return runs
+
+
+# --- block encode/decode --------------------------------------------------
+
+def encode_block(epochs, temps, humidities, conditions):
+    """Encode one city's rows (sorted by epoch) into a compressed block"""
+    count = len(epochs)
+    out = bytearray(MAGIC)
+    write_varint(out, count)
+    if count == 0:
+        return bytes(out)
+
+    # Timestamps: first value, first delta, then delta-of-delta
+    write_varint(out, zigzag(epochs[0]))
+    prev, prev_delta = epochs[0], 0
+    for epoch in epochs[1:]:
+        delta = epoch - prev
+        write_varint(out, zigzag(delta - prev_delta))
+        prev, prev_delta = epoch, delta
+
+    # Temperature: API values have at most two decimals, so centi-degree
+    # deltas are exact and tiny. Anything else falls back to XOR encoding
+    scaled = [round(t * 100) for t in temps]
+    if all(s / 100 == t for s, t in zip(scaled, temps)):
+        out.append(TEMP_SCALED)
+        prev = 0
+        for value in scaled:
+            write_varint(out, zigzag(value - prev))
+            prev = value
+    else:
+        out.append(TEMP_XOR)
+        prev = 0
+        for t in temps:
+            bits = struct.unpack("<q", struct.pack("<d", t))[0] & 0xFFFFFFFFFFFFFFFF
+            xor = bits ^ prev
+            trailing = (xor & -xor).bit_length() - 1 if xor else 0
+            out.append(trailing)
+            write_varint(out, xor >> trailing)
+            prev = bits
+
+    # Humidity: (value, run) pairs
+    runs = run_lengths(humidities)
+    write_varint(out, len(runs))
+    for value, run in runs:
+        write_varint(out, value)
+        write_varint(out, run)
+
+    # Conditions: block-local dictionary, then (code, run) pairs
+    vocab = sorted(set(conditions))
+    codes = {name: i for i, name in enumerate(vocab)}
+    write_varint(out, len(vocab))
+    for name in vocab:
+        write_string(out, name)
+    runs = run_lengths(codes[c] for c in conditions)
+    write_varint(out, len(runs))
+    for code, run in runs:
+        write_varint(out, code)
+        write_varint(out, run)
+
+    return bytes(out)
+
+
+def decode_block(payload):
+    """
+    Decode a block into NumPy arrays:
+    {"epoch": int64, "temp": float64, "humidity": int64, "weather": str}
+    """
+    buf = memoryview(payload)
+    if bytes(buf[:4]) != MAGIC:
+        raise ValueError("Not a weather time-series block")
+    count, pos = read_varint(buf, 4)
+    if count == 0:
+        return {
+            "epoch": np.empty(0, dtype=np.int64),
+            "temp": np.empty(0, dtype=np.float64),
+            "humidity": np.empty(0, dtype=np.int64),
+            "weather": np.empty(0, dtype=str),
+        }
+
+    # Timestamps: integrate delta-of-delta twice
+    first, pos = read_varint(buf, pos)
+    dods, pos = read_varints(buf, pos, count - 1)
+    epochs = unzigzag(first) + np.cumsum(np.cumsum(np.concatenate(([0], unzigzag_array(dods)))))
+
+    mode = buf[pos]
+    pos += 1
+    if mode == TEMP_SCALED:
+        deltas, pos = read_varints(buf, pos, count)
+        temps = np.cumsum(unzigzag_array(deltas)) / 100.0
+    else:
+        # (trailing zeros byte, varint) pairs; the byte is below 64, so it reads as a one-byte varint
+        pairs, pos = read_varints(buf, pos, 2 * count)
+        bits = np.bitwise_xor.accumulate(pairs[1::2] << pairs[0::2])
+        temps = bits.view(np.float64)
+
+    run_count, pos = read_varint(buf, pos)
+    runs, pos = read_varints(buf, pos, 2 * run_count)
+    humidities = np.repeat(runs[0::2].astype(np.int64), runs[1::2].astype(np.int64))
+
+    vocab_size, pos = read_varint(buf, pos)
+    vocab = []
+    for _ in range(vocab_size):
+        name, pos = read_string(buf, pos)
+        vocab.append(name)
+    run_count, pos = read_varint(buf, pos)
+    runs, pos = read_varints(buf, pos, 2 * run_count)
+    codes, lengths = runs[0::2].astype(np.int64), runs[1::2].astype(np.int64)
+    weather = np.array(vocab)[np.repeat(codes, lengths)] if vocab else np.empty(0, dtype=str)
+
+    return {"epoch": epochs, "temp": temps, "humidity": humidities, "weather": weather}
+
+
+# --- SQLite storage -------------------------------------------------------
+
+def ensure_block_table(conn):
+    """Create ts_blocks and its (city, time range) block index"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ts_blocks (
+            id INTEGER PRIMARY KEY,
+            city TEXT NOT NULL,
+            start_epoch INTEGER NOT NULL,
+            end_epoch INTEGER NOT NULL,
+            row_count INTEGER NOT NULL,
+            payload BLOB NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_ts_blocks_range
+        ON ts_blocks (city, start_epoch, end_epoch)
+    """)
+    conn.commit()
+
+
+def write_blocks(conn, city, rows, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Encode rows [(epoch, id, temp, humidity, weather), ...] for one city into
+    ts_blocks. Runs in the caller's transaction and does not delete the source rows.
+    Returns bytes written.
+    """
+    rows = sorted(rows)
+    written = 0
+    for start in range(0, len(rows), block_rows):
+        chunk = rows[start:start + block_rows]
+        payload = encode_block(
+            [r[0] for r in chunk], [r[2] for r in chunk],
+            [int(r[3]) for r in chunk], [r[4] for r in chunk],
+        )
+        conn.execute("""
+            INSERT INTO ts_blocks (city, start_epoch, end_epoch, row_count, payload)
+            VALUES (?, ?, ?, ?, ?)
+        """, (city, chunk[0][0], chunk[-1][0], len(chunk), payload))
+        written += len(payload)
+    return written
+
+
+def archive_cold_data(conn, older_than_days=30, block_rows=DEFAULT_BLOCK_ROWS):
+    """
+    Move weather_data rows older than N days into compressed blocks. Runs
+    retention's raw compaction with archiving on, so the rows are also rolled
+    into weather_hourly before they are deleted (hourly and daily views keep
+    counting them). Each batch of at most block_rows rows is archived, rolled
+    up and deleted in one transaction.
+    Returns (rows_archived, bytes_written).
+    """
+    from retention import compact_raw, ensure_rollup_tables
+
+    ensure_block_table(conn)
+    ensure_rollup_tables(conn)
+
+    def stored_bytes():
+        return conn.execute("SELECT COALESCE(SUM(LENGTH(payload)), 0) FROM ts_blocks").fetchone()[0]
+
+    before = stored_bytes()
+    cutoff = int(time.time()) - int(older_than_days) * 86400
+    archived = compact_raw(conn, cutoff, block_rows, archive=True)
+    return archived, stored_bytes() - before
+
+
+def read_range(conn, city, start_epoch, end_epoch):
+    """
+    All archived readings for a city with start_epoch <= epoch < end_epoch,
+    as a dict of NumPy arrays (same layout as decode_block)
+    """
+    blocks = conn.execute("""
+        SELECT payload FROM ts_blocks
+        WHERE city = ? AND start_epoch < ? AND end_epoch >= ?
+        ORDER BY start_epoch
+    """, (city, end_epoch, start_epoch)).fetchall()
+
+    parts = [decode_block(payload) for (payload,) in blocks]
+    if not parts:
+        return decode_block(MAGIC + b"\x00")
+    merged = {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+    mask = (merged["epoch"] >= start_epoch) & (merged["epoch"] < end_epoch)
+    return {key: values[mask] for key, values in merged.items()}
+
+
+def main():
+    from settings import DB_PATH
+    from storage import ensure_schema
+
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    rows, size = archive_cold_data(ensure_schema(DB_PATH), older_than_days=days)
+    if rows:
+        print(f"🧊 Archived {rows} rows older than {days} days into {size} bytes "
+              f"({size / rows:.1f} bytes/row)")
+    else:
+        print(f"Nothing older than {days} days to archive")
+
+
+if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        from profiling import profile_run
+        with profile_run("archive"):
+            main()
+    else:
+        main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Condition Persistence and Transitions
+How long do rain spells last, and how often does Clear turn into Clouds?
+Answering that in SQL takes self-joins over every reading. Instead each
+city's ordered series is cut into runs of one condition in a single
+vectorized pass, and the runs are cached per day:
+
+    condition_runs  (city, day_epoch, start_epoch, end_epoch, condition, readings)
+
+A run ends when the condition changes, at midnight UTC (so every day is
+cached independently) or at a gap longer than GAP_THRESHOLD_SECONDS. Like
+export_daily, triggers mark the (city, day) of every inserted or updated
+reading in `condition_dirty_days`, and a refresh recomputes only those days.
+Deletes are not tracked: retention dropping raw readings keeps the runs, so
+spell and transition history outlives the raw data like the sketches do.
+
+Queries stitch the cached pieces back together: runs of the same condition
+that meet across midnight are merged, consecutive readings inside a run
+count as self-transitions (Clear -> Clear) and each change of condition
+between readings no further apart than the gap threshold as one transition.
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+from daily_export import DAY_ROWS_SQL
+from retention import EPOCH_SQL
+from settings import DB_PATH, GAP_THRESHOLD_SECONDS
+from storage import table_exists
+from weather_batch import NO_CODE, WeatherBatch
+
+
+def _create_transition_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS condition_runs (
+            city TEXT NOT NULL,
+            day_epoch INTEGER NOT NULL,
+            start_epoch INTEGER NOT NULL,
+            end_epoch INTEGER NOT NULL,     -- last reading of the run within the day
+            condition TEXT,
+            readings INTEGER NOT NULL,
+            PRIMARY KEY (city, day_epoch, start_epoch)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS condition_dirty_days (
+            city_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            PRIMARY KEY (city_id, day)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS condition_dirty_insert
+        AFTER INSERT ON weather_fact
+        WHEN NEW.city_id IS NOT NULL AND DATE(NEW.timestamp) IS NOT NULL
+        BEGIN
+            INSERT OR IGNORE INTO condition_dirty_days (city_id, day) VALUES (NEW.city_id, DATE(NEW.timestamp));
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS condition_dirty_update
+        AFTER UPDATE ON weather_fact
+        BEGIN
+            INSERT OR IGNORE INTO condition_dirty_days (city_id, day)
+            SELECT OLD.city_id, DATE(OLD.timestamp) WHERE OLD.city_id IS NOT NULL AND DATE(OLD.timestamp) IS NOT NULL;
+            INSERT OR IGNORE INTO condition_dirty_days (city_id, day)
+            SELECT NEW.city_id, DATE(NEW.timestamp) WHERE NEW.city_id IS NOT NULL AND DATE(NEW.timestamp) IS NOT NULL;
+        END
+    """)
+
+
+def ensure_transition_tables(conn):
+    """
+    Create the run cache and its dirty-day triggers. On first creation every
+    (city, day) already in weather_fact is marked dirty, so the first refresh
+    builds the whole cache.
+    """
+    if table_exists(conn, "condition_dirty_days"):
+        return False
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        _create_transition_tables(conn)
+        conn.execute("""
+            INSERT OR IGNORE INTO condition_dirty_days (city_id, day)
+            SELECT DISTINCT city_id, DATE(timestamp) FROM weather_fact
+            WHERE city_id IS NOT NULL AND DATE(timestamp) IS NOT NULL
+        """)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return True
+
+
+def split_runs(batch, day_epochs, gap_seconds=GAP_THRESHOLD_SECONDS):
+    """
+    Cut a WeatherBatch (sorted by city, then time) into runs in one pass.
+    day_epochs gives each row's day. Returns parallel arrays:
+    city code, day, start epoch, end epoch, condition code, readings
+    """
+    columns = batch.to_numpy()
+    cities, epochs, conditions = columns["city_code"], columns["epoch"], columns["condition_code"]
+    days = np.asarray(day_epochs, dtype=np.int64)
+    if not len(epochs):
+        return (np.empty(0, dtype=np.int64),) * 6
+    new_run = np.r_[True, (cities[1:] != cities[:-1]) | (days[1:] != days[:-1])
+                    | (conditions[1:] != conditions[:-1]) | (np.diff(epochs) > gap_seconds)]
+    starts = np.flatnonzero(new_run)
+    ends = np.r_[starts[1:], len(epochs)] - 1
+    return cities[starts], days[starts], epochs[starts], epochs[ends], conditions[starts], ends - starts + 1
+
+
+def refresh_transitions(conn, gap_seconds=GAP_THRESHOLD_SECONDS):
+    """Recompute the runs of the dirty (city, day) pairs of one database. Returns how many days"""
+    ensure_transition_tables(conn)
+    if conn.execute("SELECT 1 FROM condition_dirty_days LIMIT 1").fetchone() is None:
+        return 0
+    # Take the write lock before reading the dirty set, so no writer can slip a day in between
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        batch, day_epochs = WeatherBatch(), []
+        for day_epoch, epoch, city, weather in conn.execute(f"""
+            SELECT CAST(strftime('%s', d.day) AS INTEGER), {EPOCH_SQL}, c.name, w.name
+            FROM condition_dirty_days d
+            CROSS JOIN weather_fact f ON f.city_id = d.city_id AND {DAY_ROWS_SQL}
+            JOIN dim_city c ON c.id = f.city_id
+            LEFT JOIN dim_condition w ON w.id = f.condition_id
+            ORDER BY f.city_id, f.timestamp
+        """):
+            batch.append(epoch, city, None, None, weather)
+            day_epochs.append(day_epoch)
+        days = conn.execute("SELECT COUNT(*) FROM condition_dirty_days").fetchone()[0]
+        conn.execute("""
+            DELETE FROM condition_runs WHERE (city, day_epoch) IN (
+                SELECT c.name, CAST(strftime('%s', d.day) AS INTEGER)
+                FROM condition_dirty_days d JOIN dim_city c ON c.id = d.city_id
+            )
+        """)
+        city_codes, run_days, starts, ends, condition_codes, readings = split_runs(batch, day_epochs, gap_seconds)
+        conn.executemany("INSERT INTO condition_runs VALUES (?, ?, ?, ?, ?, ?)", [
+            (batch.cities[city], int(day), int(start), int(end),
+             None if condition == NO_CODE else batch.conditions[condition], int(count))
+            for city, day, start, end, condition, count
+            in zip(city_codes, run_days, starts, ends, condition_codes, readings)
+        ])
+        conn.execute("DELETE FROM condition_dirty_days")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return days
+
+
+def refresh_all_transitions():
+    """refresh_transitions() on weather.db and every shard. Returns the days recomputed"""
+    from sharding import database_paths
+    from storage import ensure_schema
+    return sum(refresh_transitions(ensure_schema(path)) for path in database_paths())
+
+
+def move_condition_runs(source, target, city):
+    """Move one city's cached runs to another database (for shard migration; target tables must exist)"""
+    rows = source.execute("SELECT * FROM condition_runs WHERE city = ?", (city,)).fetchall()
+    target.executemany("INSERT OR REPLACE INTO condition_runs VALUES (?, ?, ?, ?, ?, ?)", rows)
+    source.execute("DELETE FROM condition_runs WHERE city = ?", (city,))
+
+
+def condition_analytics(conn, cities=None, start_epoch=None, end_epoch=None, gap_seconds=GAP_THRESHOLD_SECONDS):
+    """
+    {city: {"conditions": [...], "counts": matrix, "probabilities": matrix,
+    "spells": {condition: {"spells", "mean_hours", "median_hours", "max_hours"}}}}
+    for the cached runs of days in [start_epoch, end_epoch). counts[i][j] is how
+    often condition i was followed by condition j; a spell lasts from its first
+    reading to the next condition's first (or to its last reading before a gap)
+    """
+    filters = "WHERE day_epoch >= ? AND day_epoch < ?"
+    params = [start_epoch // 86400 * 86400 if start_epoch is not None else -2 ** 62,
+              end_epoch if end_epoch is not None else 2 ** 62]
+    if cities:
+        filters += " AND city IN (SELECT value FROM json_each(?))"
+        params.append(json.dumps(list(cities)))
+    batch, run_ends, run_readings = WeatherBatch(), [], []
+    if table_exists(conn, "condition_runs"):
+        for city, start, end, condition, readings in conn.execute(f"""
+            SELECT city, start_epoch, end_epoch, condition, readings FROM condition_runs
+            {filters} ORDER BY city, start_epoch
+        """, params):
+            batch.append(start, city, None, None, condition)
+            run_ends.append(end)
+            run_readings.append(readings)
+    if not len(batch):
+        return {}
+
+    columns = batch.to_numpy()
+    cities_, starts, conditions = columns["city_code"], columns["epoch"], columns["condition_code"]
+    ends, readings = np.asarray(run_ends, dtype=np.int64), np.asarray(run_readings, dtype=np.int64)
+
+    # A run followed within the gap threshold by another run of the same city is contiguous with it
+    contiguous = (cities_[1:] == cities_[:-1]) & (starts[1:] - ends[:-1] <= gap_seconds)
+    # Pieces of one spell split at midnight: same condition, contiguous
+    joins = contiguous & (conditions[1:] == conditions[:-1])
+    spell_ids = np.cumsum(np.r_[True, ~joins]) - 1
+    first = np.flatnonzero(np.r_[True, ~joins])
+    last = np.r_[first[1:], len(starts)] - 1
+    spell_city, spell_condition, spell_start = cities_[first], conditions[first], starts[first]
+    spell_readings = np.bincount(spell_ids, weights=readings).astype(np.int64)
+    # A spell followed by a contiguous one lasts until that one starts
+    followed = np.r_[contiguous, False][last]
+    spell_end = np.where(followed, np.r_[starts[1:], 0][last], ends[last])
+    hours = (spell_end - spell_start) / 3600
+
+    # Transitions: readings - 1 self-transitions per spell, plus one per contiguous spell change
+    n_conditions = len(batch.conditions)
+    known = spell_condition != NO_CODE
+    change = np.flatnonzero(followed & known & np.r_[known[1:], False])
+    result = {}
+    for code, city in enumerate(batch.cities):
+        mine = spell_city == code
+        counts = np.zeros((n_conditions, n_conditions), dtype=np.int64)
+        np.add.at(counts, (spell_condition[mine & known],) * 2, spell_readings[mine & known] - 1)
+        moves = change[spell_city[change] == code]
+        np.add.at(counts, (spell_condition[moves], spell_condition[moves + 1]), 1)
+        used = np.flatnonzero(counts.sum(axis=0) + counts.sum(axis=1)
+                              + np.bincount(spell_condition[mine & known], minlength=n_conditions))
+        counts = counts[np.ix_(used, used)]
+        totals = counts.sum(axis=1, keepdims=True)
+        probabilities = np.where(totals > 0, counts / np.maximum(totals, 1), np.nan)
+        spells = {}
+        for condition in used:
+            durations = hours[mine & (spell_condition == condition)]
+            spells[batch.conditions[condition]] = {
+                "spells": len(durations),
+                "mean_hours": float(durations.mean()),
+                "median_hours": float(np.median(durations)),
+                "max_hours": float(durations.max()),
+            }
+        result[city] = {
+            "conditions": [batch.conditions[i] for i in used],
+            "counts": counts,
+            "probabilities": probabilities,
+            "spells": spells,
+        }
+    return dict(sorted(result.items()))
+
+
+def print_condition_analytics(results):
+    print("=== CONDITION PERSISTENCE AND TRANSITIONS ===")
+    if not results:
+        print("   No condition runs yet")
+    for city, stats in results.items():
+        print(f"\n   {city}")
+        for condition, spell in sorted(stats["spells"].items(), key=lambda item: -item[1]["spells"]):
+            print(f"   {condition}: {spell['spells']} spells, mean {spell['mean_hours']:.1f}h, "
+                  f"median {spell['median_hours']:.1f}h, longest {spell['max_hours']:.1f}h")
+        names = stats["conditions"]
+        width = max(len(name) for name in names) + 2
+        print("   " + " " * width + "".join(f"{name[:8]:>9}" for name in names))
+        for name, row in zip(names, stats["probabilities"]):
+            cells = "".join("        -" if p != p else f"{p:>9.2f}" for p in row)
+            print(f"   {name:<{width}}{cells}")
+
+
+def main():
+    from sharding import federated_connection
+
+    refresh_all_transitions()
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else None
+    start = int(time.time()) - days * 86400 if days else None
+    print_condition_analytics(condition_analytics(federated_connection(DB_PATH), start_epoch=start))
+
+
+if __name__ == "__main__":
+    if "--profile" in sys.argv[1:]:
+        sys.argv.remove("--profile")
+        from profiling import profile_run
+        with profile_run("transitions"):
+            main()
+    else:
+        main()
@@ -0,0 +1,215 @@
+"""
+Columnar Weather Readings
+WeatherBatch holds readings as parallel typed arrays instead of one dict per
+reading: epoch seconds (int64), temperature (float64, NaN = missing),
+humidity (int32) and small integer codes for city and condition, interned
+once per batch. A million readings take about 28 MB instead of several
+hundred, and appending one allocates nothing but the array slots.
+
+WeatherRecord is a __slots__ view of one row. It reads like the old dict
+(record["temp"], "city" in record, dict(record)), so code written for a
+single reading keeps working.
+"""
+
+import math
+from array import array
+from collections.abc import Mapping
+from datetime import datetime, timezone
+
+from run_ledger import timestamp_to_epoch
+
+FIELDS = ("timestamp", "city", "temp", "humidity", "weather")
+
+# Sentinels for missing values in the integer columns
+HUMIDITY_MISSING = -2 ** 31
+NO_CODE = -1
+
+
+def canonical_timestamp(epoch):
+    """Timestamp format written by the production ETL"""
+    return datetime.fromtimestamp(epoch, timezone.utc).replace(tzinfo=None).isoformat() + "+00:00"
+
+
+class WeatherBatch:
+    """Readings as columns; see the module docstring"""
+
+    __slots__ = ("epochs", "temps", "humidity", "city_codes", "condition_codes",
+                 "cities", "conditions", "_city_index", "_condition_index")
+
+    def __init__(self, cities=None, conditions=None):
+        self.epochs = array("q")
+        self.temps = array("d")
+        self.humidity = array("i")
+        self.city_codes = array("i")
+        self.condition_codes = array("i")
+        # Code -> name lists and their reverse maps (shared by batches made with take())
+        self.cities, self._city_index = cities or ([], {})
+        self.conditions, self._condition_index = conditions or ([], {})
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Batch from (epoch, city, temp, humidity, weather) tuples"""
+        batch = cls()
+        for row in rows:
+            batch.append(*row)
+        return batch
+
+    @classmethod
+    def from_dicts(cls, readings):
+        """Batch from reading dicts with an ISO "timestamp" (the pre-batch format)"""
+        batch = cls()
+        for data in readings:
+            batch.append(timestamp_to_epoch(data["timestamp"]), data.get("city"), data.get("temp"),
+                         data.get("humidity"), data.get("weather"))
+        return batch
+
+    def _code(self, names, index, name):
+        if name is None:
+            return NO_CODE
+        code = index.get(name)
+        if code is None:
+            code = index[name] = len(names)
+            names.append(name)
+        return code
+
+    def append(self, epoch, city, temp, humidity, weather):
+        """Add one reading. Returns its row index"""
+        self.epochs.append(epoch)
+        self.temps.append(math.nan if temp is None else temp)
+        self.humidity.append(HUMIDITY_MISSING if humidity is None else humidity)
+        self.city_codes.append(self._code(self.cities, self._city_index, city))
+        self.condition_codes.append(self._code(self.conditions, self._condition_index, weather))
+        return len(self.epochs) - 1
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return WeatherRecord(self, index)
+
+    def __iter__(self):
+        return (WeatherRecord(self, i) for i in range(len(self)))
+
+    def city(self, index):
+        code = self.city_codes[index]
+        return None if code == NO_CODE else self.cities[code]
+
+    def condition(self, index):
+        code = self.condition_codes[index]
+        return None if code == NO_CODE else self.conditions[code]
+
+    def temp(self, index):
+        value = self.temps[index]
+        return None if value != value else value
+
+    def humidity_at(self, index):
+        value = self.humidity[index]
+        return None if value == HUMIDITY_MISSING else value
+
+    def rows(self):
+        """Yield (timestamp, city, temp, humidity, weather) tuples, e.g. for csv.writer"""
+        for i in range(len(self)):
+            yield (canonical_timestamp(self.epochs[i]), self.city(i), self.temp(i),
+                   self.humidity_at(i), self.condition(i))
+
+    def take(self, indices):
+        """New batch with the given rows (sharing this batch's code tables)"""
+        batch = WeatherBatch((self.cities, self._city_index), (self.conditions, self._condition_index))
+        for i in indices:
+            batch.epochs.append(self.epochs[i])
+            batch.temps.append(self.temps[i])
+            batch.humidity.append(self.humidity[i])
+            batch.city_codes.append(self.city_codes[i])
+            batch.condition_codes.append(self.condition_codes[i])
+        return batch
+
+    def split_by_city(self, key):
+        """{key(city): WeatherBatch} for the cities in this batch (e.g. key = target database)"""
+        groups = {}
+        for i, code in enumerate(self.city_codes):
+            name = None if code == NO_CODE else self.cities[code]
+            groups.setdefault(key(name), []).append(i)
+        if len(groups) == 1:
+            return {target: self for target in groups}
+        return {target: self.take(indices) for target, indices in groups.items()}
+
+    def city_summary(self):
+        """[(city, rows, newest_epoch), ...] for the cities in this batch"""
+        counts, newest = {}, {}
+        for epoch, code in zip(self.epochs, self.city_codes):
+            counts[code] = counts.get(code, 0) + 1
+            if epoch > newest.get(code, epoch - 1):
+                newest[code] = epoch
+        return [(self.cities[code], counts[code], newest[code]) for code in counts if code != NO_CODE]
+
+    def to_numpy(self):
+        """Zero-copy NumPy views of the numeric columns"""
+        import numpy as np
+        return {
+            "epoch": np.frombuffer(self.epochs, dtype=np.int64),
+            "temp": np.frombuffer(self.temps, dtype=np.float64),
+            "humidity": np.frombuffer(self.humidity, dtype=np.int32),
+            "city_code": np.frombuffer(self.city_codes, dtype=np.int32),
+            "condition_code": np.frombuffer(self.condition_codes, dtype=np.int32),
+        }
+
+
+class WeatherRecord(Mapping):
+    """Read-only view of one row of a WeatherBatch, usable like the old reading dict"""
+
+    __slots__ = ("batch", "index")
+
+    def __init__(self, batch, index):
+        self.batch = batch
+        self.index = index
+
+    @property
+    def epoch(self):
+        return self.batch.epochs[self.index]
+
+    @property
+    def timestamp(self):
+        return canonical_timestamp(self.batch.epochs[self.index])
+
+    @property
+    def city(self):
+        return self.batch.city(self.index)
+
+    @property
+    def temp(self):
+        return self.batch.temp(self.index)
+
+    @property
+    def humidity(self):
+        return self.batch.humidity_at(self.index)
+
+    @property
+    def weather(self):
+        return self.batch.condition(self.index)
+
+    def __getitem__(self, key):
+        if key not in FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(FIELDS)
+
+    def __len__(self):
+        return len(FIELDS)
+
+    def __repr__(self):
+        return f"WeatherRecord({dict(self)!r})"
+
+
+def as_batch(data):
+    """WeatherBatch for a batch, a single record or a reading dict"""
+    if isinstance(data, WeatherBatch):
+        return data
+    if isinstance(data, WeatherRecord):
+        return data.batch if len(data.batch) == 1 else data.batch.take([data.index])
+    return WeatherBatch.from_dicts([data])
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+weather-etl: one command for every pipeline task
+
+    weather-etl run [--city NAME ...]     one ETL window (what cron runs)
+    weather-etl daemon [--serve]          ETL windows back to back + daily retention
+    weather-etl clean                     clean the raw CSV into weather_data_clean
+    weather-etl analyze                   SQL analysis report + CSV export
+    weather-etl dashboard [--output PNG]  six-panel dashboard (--city NAME, or --all for every city)
+    weather-etl backfill [CSV]            load CSV rows missing from SQLite
+    weather-etl compact                   apply retention tiers
+    weather-etl serve                     read-only HTTP query API
+    weather-etl forecast [--city NAME ...] load the 5 day / 3 hour forecast
+    weather-etl score-forecasts           forecast-vs-actual error per city and lead time
+    weather-etl reconcile [--dry-run]     compare the CSV with SQLite and copy missing rows
+    weather-etl gaps [--refill]           find holes in each city's series and plan (or run) refills
+    weather-etl percentiles [--days N]    temperature/humidity percentiles from the quantile sketches
+    weather-etl changes [--follow]        change feed as JSON lines (--cursor C to resume)
+    weather-etl transitions [--days N]    condition spell lengths and transition matrices per city
+    weather-etl worker [--id NAME]        lease-based ETL worker (start several to share the cities)
+
+Any command takes --profile first (weather-etl --profile analyze) to write a
+CPU / allocation / SQL report to output/profiles/<command>.txt.
+
+Install with:  ln -s /usr/local/weather-etl/weather_etl.py /usr/local/bin/weather-etl
+
+Every subcommand imports its dependencies inside its handler, so `run`
+never loads pandas, NumPy or matplotlib and starts in tens of milliseconds.
+"""
+
+import argparse
+import sys
+
+
+def cmd_run(args):
+    from etl_production import run_etl
+    return 0 if run_etl(args.city or None) else 1
+
+
+def cmd_daemon(args):
+    from daemon import run_daemon
+    run_daemon(serve_api=args.serve, compact_daily=not args.no_compact)
+    return 0
+
+
+def cmd_clean(args):
+    from load_and_clean import main
+    main(args.full)
+    return 0
+
+
+def cmd_analyze(args):
+    from analyze_weather_data import main
+    main()
+    return 0
+
+
+def cmd_dashboard(args):
+    if args.all:
+        from dashboard import render_all_dashboards
+        from settings import DASHBOARD_DIR
+        render_all_dashboards(args.output or DASHBOARD_DIR, force=args.force)
+        return 0
+    from dashboard import render_dashboard
+    render_dashboard(args.output, args.city)
+    return 0
+
+
+def cmd_backfill(args):
+    from backfill import backfill_from_csv
+    from settings import CSV_PATH
+    source = args.csv or CSV_PATH
+    rows = backfill_from_csv(source)
+    print(f"✅ Backfilled {rows} rows from {source}")
+    return 0
+
+
+def cmd_compact(args):
+    from retention import run_compaction_all
+    run_compaction_all()
+    return 0
+
+
+def cmd_serve(args):
+    from query_api import serve
+    from settings import DB_PATH, QUERY_API_HOST, QUERY_API_PORT
+    serve(DB_PATH, args.host or QUERY_API_HOST, args.port or QUERY_API_PORT)
+    return 0
+
+
+def cmd_forecast(args):
+    from forecast import run_forecast_etl
+    return 0 if run_forecast_etl(args.city or None) else 1
+
+
+def cmd_score_forecasts(args):
+    from forecast import print_scores, score_forecasts
+    print_scores(score_forecasts())
+    return 0
+
+
+def cmd_reconcile(args):
+    from reconcile import print_summary, reconcile
+    from settings import CSV_PATH
+    summary = reconcile(args.csv or CSV_PATH, repair=not args.dry_run)
+    print_summary(summary)
+    return 1 if summary["conflicts"] else 0
+
+
+def cmd_gaps(args):
+    from gaps import detect_gaps, plan_refill, print_plan, refill
+    print(f"🕳️ {len(detect_gaps())} new gap(s) found")
+    plan = plan_refill()
+    print_plan(plan)
+    if args.refill:
+        rows, polled = refill(plan)
+        print(f"🔧 Replayed {rows} CSV rows, polled {polled} cities")
+    return 0
+
+
+def cmd_percentiles(args):
+    import time
+    from settings import DB_PATH
+    from sharding import federated_connection
+    from sketches import percentiles, print_percentiles
+    from storage import ensure_schema
+    ensure_schema(DB_PATH)
+    quantiles = tuple(q / 100 for q in args.p or (50, 95))
+    start = int(time.time()) - args.days * 86400 if args.days else None
+    rows = percentiles(federated_connection(), quantiles, args.measure, args.city, start_epoch=start)
+    print_percentiles(rows, quantiles, args.measure)
+    return 0
+
+
+def cmd_transitions(args):
+    import time
+    from settings import DB_PATH
+    from sharding import federated_connection
+    from transitions import condition_analytics, print_condition_analytics, refresh_all_transitions
+    refresh_all_transitions()
+    start = int(time.time()) - args.days * 86400 if args.days else None
+    print_condition_analytics(condition_analytics(federated_connection(DB_PATH), args.city, start_epoch=start))
+    return 0
+
+
+def cmd_changes(args):
+    import json
+    from changes import follow, read_feed
+    from settings import DB_PATH
+    from storage import ensure_schema
+    ensure_schema(DB_PATH)
+
+    def emit(changes, cursor):
+        for change in changes:
+            print(json.dumps(change))
+        print(f"# next cursor: {cursor}", file=sys.stderr, flush=True)
+
+    try:
+        if args.follow:
+            follow(emit, args.cursor, name="cli")
+        else:
+            emit(*read_feed(args.cursor, args.limit))
+    except ValueError as e:
+        # Malformed cursor, or one retention has already pruned past
+        print(f"❌ {e}", file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def cmd_worker(args):
+    from workers import LeaseWorker, lease_status
+    if args.status:
+        for worker, shards, age in lease_status():
+            print(f"   {worker}: {shards} shard(s), heartbeat {age:.0f}s ago")
+        return 0
+    LeaseWorker(args.id).run(once=args.once)
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="weather-etl", description="Weather ETL pipeline")
+    parser.add_argument("--profile", action="store_true",
+                        help="write a CPU, memory and SQL profile to output/profiles/<command>.txt")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run one ETL window")
+    run.add_argument("--city", action="append", help="only these cities (repeatable)")
+    run.set_defaults(handler=cmd_run)
+
+    daemon = commands.add_parser("daemon", help="run ETL windows continuously")
+    daemon.add_argument("--serve", action="store_true", help="also serve the query API")
+    daemon.add_argument("--no-compact", action="store_true", help="skip daily retention")
+    daemon.set_defaults(handler=cmd_daemon)
+
+    clean = commands.add_parser("clean", help="clean the rows appended to the raw CSV since the last run")
+    clean.add_argument("--full", action="store_true", help="clean the whole CSV again and replace the table")
+    clean.set_defaults(handler=cmd_clean)
+    commands.add_parser("analyze", help="SQL analysis report").set_defaults(handler=cmd_analyze)
+
+    dashboard = commands.add_parser("dashboard", help="show or save the dashboard")
+    dashboard.add_argument("--output", help="save to this PNG instead of opening a window "
+                                            "(with --all: the output directory)")
+    dashboard.add_argument("--city", help="only this city")
+    dashboard.add_argument("--all", action="store_true",
+                           help="write a dashboard per city plus an overview, redrawing only changed cities")
+    dashboard.add_argument("--force", action="store_true", help="with --all: redraw everything")
+    dashboard.set_defaults(handler=cmd_dashboard)
+
+    backfill = commands.add_parser("backfill", help="load CSV rows missing from SQLite")
+    backfill.add_argument("csv", nargs="?", help="CSV file (default: output/weather_data.csv)")
+    backfill.set_defaults(handler=cmd_backfill)
+
+    commands.add_parser("compact", help="apply retention tiers").set_defaults(handler=cmd_compact)
+
+    serve = commands.add_parser("serve", help="serve the read-only query API")
+    serve.add_argument("--host")
+    serve.add_argument("--port", type=int)
+    serve.set_defaults(handler=cmd_serve)
+
+    forecast = commands.add_parser("forecast", help="load the 5 day / 3 hour forecast")
+    forecast.add_argument("--city", action="append", help="only these cities (repeatable)")
+    forecast.set_defaults(handler=cmd_forecast)
+
+    commands.add_parser("score-forecasts", help="score forecasts against observations").set_defaults(
+        handler=cmd_score_forecasts)
+
+    reconcile = commands.add_parser("reconcile", help="compare the CSV with SQLite and repair missing rows")
+    reconcile.add_argument("csv", nargs="?", help="CSV file (default: output/weather_data.csv)")
+    reconcile.add_argument("--dry-run", action="store_true", help="report differences without writing")
+    reconcile.set_defaults(handler=cmd_reconcile)
+
+    gaps = commands.add_parser("gaps", help="detect gaps since the last check and plan refills")
+    gaps.add_argument("--refill", action="store_true",
+                      help="replay gap rows from the CSV and poll cities whose series stopped")
+    gaps.set_defaults(handler=cmd_gaps)
+
+    pct = commands.add_parser("percentiles", help="percentiles from the quantile sketches")
+    pct.add_argument("--city", action="append", help="only these cities (repeatable)")
+    pct.add_argument("--days", type=int, help="only the last N days (default: everything kept)")
+    pct.add_argument("--measure", choices=["temp", "humidity"], default="temp")
+    pct.add_argument("-p", type=float, action="append", help="percentile (repeatable, default 50 and 95)")
+    pct.set_defaults(handler=cmd_percentiles)
+
+    trans = commands.add_parser("transitions", help="condition spell lengths and transition matrices")
+    trans.add_argument("--city", action="append", help="only these cities (repeatable)")
+    trans.add_argument("--days", type=int, help="only the last N days (default: everything kept)")
+    trans.set_defaults(handler=cmd_transitions)
+
+    changes = commands.add_parser("changes", help="print the change feed after a cursor")
+    changes.add_argument("--cursor", help="resume after this cursor (default: from the start, "
+                                          "or from now with --follow)")
+    changes.add_argument("--limit", type=int, default=1000)
+    changes.add_argument("--follow", action="store_true", help="keep printing new changes")
+    changes.set_defaults(handler=cmd_changes)
+
+    worker = commands.add_parser("worker", help="lease-based ETL worker")
+    worker.add_argument("--id", help="worker name (default: host:pid)")
+    worker.add_argument("--once", action="store_true", help="run one window, then release the leases")
+    worker.add_argument("--status", action="store_true", help="show live workers and their leases")
+    worker.set_defaults(handler=cmd_worker)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.profile:
+        from profiling import profile_run
+        with profile_run(args.command):
+            return args.handler(args)
+    return args.handler(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
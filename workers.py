@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+Lease-Based ETL Workers
+One run_etl() process tops out at a few hundred cities per window. Any number
+of worker processes can split the work instead, coordinating through three
+tables in weather.db:
+
+    work_workers  (worker, heartbeat_at)                 who is alive
+    work_leases   (shard, worker, generation, expires_at)
+    work_claims   (city, interval_start, worker, generation, status)
+
+Cities are hashed into WORK_SHARDS shards. Each worker leases its fair share
+(shards / live workers) and renews the leases from a heartbeat thread; a
+worker that dies stops renewing, its leases expire after WORK_LEASE_SECONDS
+and the others take the shards over (the generation number goes up, which
+fences out the old owner). Workers that hold more than their share release
+the extra shards, so new workers get work without a restart.
+
+Before polling a city a worker claims (city, interval) in the same
+transaction that checks its lease. The lease is checked again inside the
+transaction that writes the reading (fencing): the claim is marked done there
+only if the shard is still held at the claimed generation, otherwise the
+write is rolled back. A claim that is done, or a city whose last_ingest
+already falls in the interval, is never polled again, so each city is
+written once per WORK_INTERVAL_SECONDS however leases move. The per-minute
+and per-day API limits are stored in weather.db (see rate_limiter.py), so
+workers together stay within them.
+
+All workers must see the same weather.db, so run them on one host (SQLite
+locking is not reliable over network filesystems).
+"""
+
+import math
+import os
+import socket
+import sys
+import threading
+import time
+
+from etl_production import log_message, run_city_etl, run_etl
+from settings import (CITIES, DB_PATH, SCHEDULE_WINDOW_SECONDS, WORK_SHARDS, WORK_LEASE_SECONDS,
+                      WORK_INTERVAL_SECONDS)
+from sharding import city_db_path, shard_index
+from storage import ensure_schema, get_connection
+
+
+def ensure_work_tables(conn, shards=WORK_SHARDS):
+    """Create the coordination tables and one lease row per shard"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS work_workers (
+            worker TEXT PRIMARY KEY,
+            started_at REAL NOT NULL,
+            heartbeat_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS work_leases (
+            shard INTEGER PRIMARY KEY,
+            worker TEXT,
+            generation INTEGER NOT NULL DEFAULT 0,
+            expires_at REAL NOT NULL DEFAULT 0
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS work_claims (
+            city TEXT NOT NULL,
+            interval_start INTEGER NOT NULL,
+            worker TEXT NOT NULL,
+            generation INTEGER NOT NULL,
+            status TEXT NOT NULL,           -- running / done / failed
+            claimed_at REAL NOT NULL,
+            PRIMARY KEY (city, interval_start)
+        ) WITHOUT ROWID
+    """)
+    conn.executemany("INSERT OR IGNORE INTO work_leases (shard) VALUES (?)", [(s,) for s in range(shards)])
+    conn.commit()
+
+
+class LeaseLost(Exception):
+    """Raised inside a write transaction when the worker no longer holds the city's claim"""
+
+
+def city_shard(city, shards=WORK_SHARDS):
+    return shard_index(city, shards)
+
+
+def written_since(city, epoch):
+    """True if the city already has a reading at or after epoch"""
+    row = get_connection(city_db_path(city), readonly=True).execute(
+        "SELECT MAX(last_epoch) FROM last_ingest WHERE city = ?", (city,)
+    ).fetchone()
+    return row[0] is not None and row[0] >= epoch
+
+
+class LeaseWorker:
+    """One worker process; see the module docstring"""
+
+    def __init__(self, worker_id=None, db_name=DB_PATH, shards=WORK_SHARDS,
+                 lease_seconds=WORK_LEASE_SECONDS, interval_seconds=WORK_INTERVAL_SECONDS):
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self.db_name = db_name
+        self.shards = shards
+        self.lease_seconds = lease_seconds
+        self.interval_seconds = interval_seconds
+        self.held = {}          # shard -> generation
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        ensure_work_tables(ensure_schema(db_name), shards)
+
+    def _transaction(self):
+        conn = get_connection(self.db_name)
+        conn.execute("BEGIN IMMEDIATE")
+        return conn
+
+    def rebalance(self, now=None):
+        """Renew this worker's leases, release extras and take free or expired shards up to a fair share"""
+        now = time.time() if now is None else now
+        conn = self._transaction()
+        try:
+            conn.execute("""
+                INSERT INTO work_workers (worker, started_at, heartbeat_at) VALUES (?, ?, ?)
+                ON CONFLICT (worker) DO UPDATE SET heartbeat_at = excluded.heartbeat_at
+            """, (self.worker_id, now, now))
+            live = conn.execute("SELECT COUNT(*) FROM work_workers WHERE heartbeat_at > ?",
+                                (now - self.lease_seconds,)).fetchone()[0]
+            fair = math.ceil(self.shards / max(live, 1))
+
+            mine = dict(conn.execute("""
+                SELECT shard, generation FROM work_leases WHERE worker = ? AND expires_at > ? ORDER BY shard
+            """, (self.worker_id, now)).fetchall())
+            for shard in sorted(mine)[fair:]:
+                conn.execute("UPDATE work_leases SET worker = NULL, expires_at = 0 WHERE shard = ?", (shard,))
+                del mine[shard]
+            conn.executemany("UPDATE work_leases SET expires_at = ? WHERE shard = ?",
+                             [(now + self.lease_seconds, shard) for shard in mine])
+
+            free = conn.execute("""
+                SELECT shard, worker FROM work_leases
+                WHERE (worker IS NULL OR expires_at <= ?) AND shard < ?
+                ORDER BY shard LIMIT ?
+            """, (now, self.shards, max(0, fair - len(mine)))).fetchall()
+            for shard, previous in free:
+                generation = conn.execute("""
+                    UPDATE work_leases SET worker = ?, generation = generation + 1, expires_at = ?
+                    WHERE shard = ? RETURNING generation
+                """, (self.worker_id, now + self.lease_seconds, shard)).fetchone()[0]
+                mine[shard] = generation
+                if previous and previous != self.worker_id:
+                    log_message(f"♻️ {self.worker_id} took over shard {shard} from {previous}")
+            conn.execute("DELETE FROM work_workers WHERE heartbeat_at < ?", (now - 10 * self.lease_seconds,))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        with self.lock:
+            self.held = mine
+        return mine
+
+    def heartbeat(self, now=None):
+        """Extend the leases still held. Returns the shards lost since the last call"""
+        now = time.time() if now is None else now
+        with self.lock:
+            held = dict(self.held)
+        conn = get_connection(self.db_name)
+        with conn:
+            conn.execute("UPDATE work_workers SET heartbeat_at = ? WHERE worker = ?", (now, self.worker_id))
+            lost = [shard for shard, generation in held.items() if conn.execute("""
+                UPDATE work_leases SET expires_at = ? WHERE shard = ? AND worker = ? AND generation = ?
+            """, (now + self.lease_seconds, shard, self.worker_id, generation)).rowcount == 0]
+        if lost:
+            with self.lock:
+                for shard in lost:
+                    self.held.pop(shard, None)
+            log_message(f"⚠️ {self.worker_id} lost shard(s) {lost}")
+        return lost
+
+    def _heartbeat_loop(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            try:
+                self.heartbeat()
+            except Exception as e:
+                log_message(f"⚠️ Heartbeat failed: {e}")
+
+    def cities(self, cities=None):
+        with self.lock:
+            held = set(self.held)
+        return [city for city in (cities or CITIES) if city_shard(city, self.shards) in held]
+
+    def claim(self, city, now=None):
+        """
+        Claim this interval's poll of a city. Returns the interval start, or
+        None if the lease is gone, the poll is done, or another live owner has it
+        """
+        now = time.time() if now is None else now
+        interval_start = int(now) // self.interval_seconds * self.interval_seconds
+        shard = city_shard(city, self.shards)
+        with self.lock:
+            generation = self.held.get(shard)
+        if generation is None:
+            return None
+        conn = self._transaction()
+        try:
+            # Fencing: the lease must still be ours, at the generation we were given
+            owned = conn.execute("""
+                SELECT 1 FROM work_leases WHERE shard = ? AND worker = ? AND generation = ? AND expires_at > ?
+            """, (shard, self.worker_id, generation, now)).fetchone()
+            # Any other claim on this interval is from an earlier owner of the shard, fenced out above
+            existing = conn.execute(
+                "SELECT status FROM work_claims WHERE city = ? AND interval_start = ?", (city, interval_start)
+            ).fetchone() if owned else None
+            if not owned or existing == ("done",):
+                conn.rollback()
+                return None
+            status = "done" if written_since(city, interval_start) else "running"
+            conn.execute("""
+                INSERT OR REPLACE INTO work_claims (city, interval_start, worker, generation, status, claimed_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (city, interval_start, self.worker_id, generation, status, now))
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        if status == "done":
+            # A previous owner's write committed before it died; don't write the interval twice
+            return None
+        return interval_start
+
+    def _coordination_schema(self, conn):
+        """Schema name of weather.db on a write connection (attached when the city lives in a shard)"""
+        path = os.path.abspath(self.db_name)
+        for _, name, filename in conn.execute("PRAGMA database_list"):
+            if filename and os.path.abspath(filename) == path:
+                return name
+        conn.execute("ATTACH DATABASE ? AS coordination", (path,))
+        return "coordination"
+
+    def fence(self, city, interval_start):
+        """
+        insert_batch fence for a claimed city: marks the claim done in the write
+        transaction if the shard is still ours at the claim's generation, and
+        raises LeaseLost (rolling the write back) if it is not
+        """
+        shard = city_shard(city, self.shards)
+
+        def check(conn):
+            schema = self._coordination_schema(conn)
+            # The UPDATE takes weather.db's write lock until the reading commits,
+            # so no other worker can take the shard over in between
+            fenced = conn.execute(f"""
+                UPDATE {schema}.work_claims SET status = 'done'
+                WHERE city = ? AND interval_start = ? AND worker = ? AND status = 'running'
+                  AND generation = (SELECT generation FROM {schema}.work_leases
+                                    WHERE shard = ? AND worker = ? AND expires_at > ?)
+            """, (city, interval_start, self.worker_id, shard, self.worker_id, time.time())).rowcount == 0
+            if fenced:
+                raise LeaseLost(f"{self.worker_id} no longer holds shard {shard}; not writing {city}")
+        return check
+
+    def finish(self, city, interval_start, success):
+        """Record a failed poll so the city can be retried (successful ones were marked done by the fence)"""
+        if success:
+            return
+        conn = get_connection(self.db_name)
+        with conn:
+            conn.execute("""
+                UPDATE work_claims SET status = 'failed'
+                WHERE city = ? AND interval_start = ? AND worker = ? AND status = 'running'
+            """, (city, interval_start, self.worker_id))
+
+    def poll(self, city, limiter=None, run_id=None):
+        """run_city_etl for a claimed city (used as run_etl's poll function)"""
+        interval_start = self.claim(city)
+        if interval_start is None:
+            return True
+        success = run_city_etl(city, limiter, run_id, fence=self.fence(city, interval_start))
+        self.finish(city, interval_start, success)
+        return success
+
+    def release(self):
+        """Give up every lease (on shutdown) so other workers can take the shards at once"""
+        conn = get_connection(self.db_name)
+        with conn:
+            conn.execute("UPDATE work_leases SET worker = NULL, expires_at = 0 WHERE worker = ?", (self.worker_id,))
+            conn.execute("DELETE FROM work_workers WHERE worker = ?", (self.worker_id,))
+        with self.lock:
+            self.held = {}
+
+    def prune_claims(self, older_than_seconds=86400):
+        conn = get_connection(self.db_name)
+        with conn:
+            conn.execute("DELETE FROM work_claims WHERE interval_start < ?", (time.time() - older_than_seconds,))
+
+    def run(self, once=False):
+        """Rebalance, run one ETL window over this worker's cities, repeat"""
+        log_message(f"👷 Worker {self.worker_id} starting ({self.shards} shards)")
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        heartbeat.start()
+        try:
+            while True:
+                window_start = time.monotonic()
+                self.rebalance()
+                cities = self.cities()
+                log_message(f"📋 {self.worker_id}: {len(self.held)} shard(s), {len(cities)} cities")
+                if cities:
+                    run_etl(cities, poll=self.poll)
+                self.prune_claims()
+                if once:
+                    return
+                elapsed = time.monotonic() - window_start
+                time.sleep(max(0, SCHEDULE_WINDOW_SECONDS - elapsed))
+        except KeyboardInterrupt:
+            log_message(f"🛑 Worker {self.worker_id} stopped")
+        finally:
+            self.stopped.set()
+            self.release()
+
+
+def lease_status(db_name=DB_PATH):
+    """[(worker, shards held, seconds since heartbeat), ...] for live workers"""
+    conn = ensure_schema(db_name)
+    ensure_work_tables(conn)
+    now = time.time()
+    return conn.execute("""
+        SELECT w.worker, COUNT(l.shard), ? - w.heartbeat_at
+        FROM work_workers w
+        LEFT JOIN work_leases l ON l.worker = w.worker AND l.expires_at > ?
+        GROUP BY w.worker
+        ORDER BY w.worker
+    """, (now, now)).fetchall()
+
+
+if __name__ == "__main__":
+    LeaseWorker(sys.argv[1] if len(sys.argv) > 1 else None).run()